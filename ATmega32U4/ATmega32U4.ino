@@ -32,6 +32,8 @@ void sampleEnd();
 unsigned long sampleSize();
 
 void dataReset();
+void writeJsonFrame();
+void writeBinaryFrame();
 double byte2Voltage(byte voltage);
 double byte2Float(byte voltage);
 const int ringSize = 1000;
@@ -39,6 +41,10 @@ const int ringSize = 1000;
 volatile bool hasStarted = false;
 volatile bool hasEnded = false;
 
+// Frame format; the host sends 'B' for compact binary frames or 'J' for JSON text.
+volatile bool binaryFrames = false;
+const byte frameMagic[] = { 0xA5, 0x5A, 'L', 'M' };
+
 struct Datum
 {
 	byte voltage = 0;
@@ -96,6 +102,14 @@ ISR(ADC_vect)
 
 void loop()
 {
+  if ( Serial.available() > 0 ) {
+    int command = Serial.read();
+    if ( command == 'B' ) {
+      binaryFrames = true;
+    } else if ( command == 'J' ) {
+      binaryFrames = false;
+    }
+  }
 }
 
 void sampleStart()
@@ -117,12 +131,25 @@ void sampleEnd()
 	sampleRateKHz = getSampleRate();
 	sampleDuration = (endTime - startTime) * 0.001;
 	startSample = ringSize - sampleSize();
-  // Write a JSON format data object to the tty.
-  // Serial.print( String( "{\n  \042values\042: [\n    " ) + String(byte2Voltage(dataBuffer.peek().voltage), 4) );
 	ATOMIC_BLOCK(ATOMIC_RESTORESTATE)
 	{
-		Serial.print( String( "    \n    \n" )
-		+ String( "\n{\n  \042values\042: [\n    1.0000" ) );
+		if ( binaryFrames == true ) {
+			writeBinaryFrame();
+		} else {
+			writeJsonFrame();
+		}
+		Serial.flush();
+	}
+  // Reset and continue.
+  dataReset();
+}
+
+void writeJsonFrame()
+{
+  // Write a JSON format data object to the tty.
+  // Serial.print( String( "{\n  \042values\042: [\n    " ) + String(byte2Voltage(dataBuffer.peek().voltage), 4) );
+  Serial.print( String( "    \n    \n" )
+  + String( "\n{\n  \042values\042: [\n    1.0000" ) );
     dataBuffer.each([&](const Datum&m)
     // while( !dataBuffer.is_empty() )
       {
@@ -131,17 +158,42 @@ void sampleEnd()
       }
     );
     Serial.print( String("\n  ],\n  \042sample_size\042: ")
-		+ String( sampleSize() , DEC )
-		+ ",\n  \042ring_size\042: " + ringSize + ",\n  \042start_sample\042: "
-		+ String( startSample, DEC ) + ",\n" + String("  \042sample_rate_khz\042: ")
-		+ String(sampleRateKHz, 4) + ",\n  \042sample_duration_ms\042: "
-		+ String( sampleDuration, 4 ) + ",\n  \042meter_id\042: "
-		+ String( meterId, DEC )
-		+ "\n}\n"  );
-		Serial.flush();
-	}
-  // Reset and continue.
-  dataReset();
+  + String( sampleSize() , DEC )
+  + ",\n  \042ring_size\042: " + ringSize + ",\n  \042start_sample\042: "
+  + String( startSample, DEC ) + ",\n" + String("  \042sample_rate_khz\042: ")
+  + String(sampleRateKHz, 4) + ",\n  \042sample_duration_ms\042: "
+  + String( sampleDuration, 4 ) + ",\n  \042meter_id\042: "
+  + String( meterId, DEC )
+  + "\n}\n"  );
+}
+
+void writeBinaryFrame()
+{
+  // Write the raw ADC bytes behind a fixed little-endian header; see FRAME_HEADER in read_terminal.py.
+  uint16_t count = dataBuffer.length() + 1;
+  uint16_t ring = ringSize;
+  uint32_t size = sampleSize();
+  int16_t start = startSample;
+  float rate = sampleRateKHz;
+  float duration = sampleDuration;
+  byte meter = meterId;
+  byte checksum = 0xFF;
+  Serial.write( frameMagic, sizeof(frameMagic) );
+  Serial.write( (byte *) &count, sizeof(count) );
+  Serial.write( (byte *) &ring, sizeof(ring) );
+  Serial.write( (byte *) &size, sizeof(size) );
+  Serial.write( (byte *) &start, sizeof(start) );
+  Serial.write( (byte *) &rate, sizeof(rate) );
+  Serial.write( (byte *) &duration, sizeof(duration) );
+  Serial.write( meter );
+  Serial.write( 0xFF );  // The leading 1.0000 marker of the JSON frame.
+  dataBuffer.each([&](const Datum&m)
+    {
+      Serial.write( m.voltage );
+      checksum += m.voltage;
+    }
+  );
+  Serial.write( checksum );
 }
 
 double byte2Voltage(byte voltage)
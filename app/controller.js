@@ -118,40 +118,16 @@ module.exports.dataCollectionIsRunning = function () {
   }
 }
 
+/* Returns the process ids of the Python children this window started: the data
+   collection run and the resident worker. */
 module.exports.pythonPids = function () {
-  let platform = os.platform()
-  let command = null
-  let pattern = null
   let pids = new Array(0)
-  let files = fs.readdirSync(path.join(__dirname, 'python'), {})
-  if (platform === 'darwin' || platform === 'linux') {
-    pattern = '"' + files.join('|') + '"'
-    command = 'pgrep -fd ' + '"," ' + pattern
-    try {
-      let output = _utf8ArrayToStr(execSync(command, {})).split(',')
-      for (let token of output) {
-        pids.push(parseInt(token))
-      }
-      return pids
-    } catch (e) {
-      /* When the command has no return it fails. */
-    }
-  } else if (platform === 'win32') {
-    pattern = '"' + files.join(' ') + '"'
-    command = 'WMIC path win32_process get Processid | find /i ' +
-    pattern + ' /c'
-    try {
-      let output = _utf8ArrayToStr(execSync(command, {})).split(' ')
-      for (let token of output) {
-        if (!isNaN(token)) {
-          pids.push(token)
-        }
-      }
-      return pids
-    } catch (e) {
-      console.log('controller.pythonPids:', e)
+  for (let child of [_collector, _worker]) {
+    if (child !== null) {
+      pids.push(child.pid)
     }
   }
+  return pids
 }
 
 module.exports.getPythonDepends = function () {
@@ -181,35 +157,113 @@ module.exports.getPythonDepends = function () {
 }
 
 module.exports.setLaserPwmConfig = function (host, user, password) {
+  controller.workerRequest('jq', {
+    host: host,
+    user: user,
+    password: password,
+    filter: '.config.laser | {path,polarity,duty,period}',
+    files: '/home/ubuntu/Development/cups_driver/src/CNC/CNC/Configs/pkm_config.json'
+  }, {
+    result: function (pwm) {
+      $('#period').html(pwm.period)
+      $('#duty-cycle').html(pwm.duty)
+      /* The firing time is a multiple of the period. The value also depends upon
+      the size of the light meter's ring buffer and it's sampling rate. As it happens,
+      seven periods fits nicely into a ring buffer of 1000 at 77 KHz. */
+      $('#firing-time').html(pwm.period * config.firingTimeFactor)
+    },
+    error: function (message) {
+      console.log('controller.setLaserPwmConfig:', message)
+    }
+  })
+}
+
+let _collector = null
+let _worker = null
+let _workerJobs = {}
+let _workerNextId = 1
+
+/* Returns the resident Python worker, starting it on first use. Training, prediction and JQ
+   requests are sent to it as JSON-RPC lines so the interpreter, numpy, scikit-learn and loaded
+   models are kept between jobs. */
+module.exports.pythonWorker = function () {
+  if (_worker !== null) {
+    return _worker
+  }
   let path = controller.getPythonPath()
   let pyDir = controller.getPythonAppDir()
-  let script = window.path.join(pyDir, 'jq.py')
-  let jq = spawn(path.pythonBin, [script, '-p', password, host, user,
-    '.config.laser | {path,polarity,duty,period}',
-    '/home/ubuntu/Development/cups_driver/src/CNC/CNC/Configs/pkm_config.json'
-  ], {
+  let script = window.path.join(pyDir, 'worker.py')
+  _worker = spawn(path.pythonBin, [script], {
     cwd: pyDir,
     env: {
       PATH: path.pythonPath + path.delimiter + process.env.PATH,
-      PYTHONIOENCODING: 'utf-8'
+      PYTHONIOENCODING: 'utf-8',
+      QT_QPA_PLATFORM: 'offscreen',
+      LASER_METER_TIMING: process.env.LASER_METER_TIMING || ''
     }
   })
-  jq.stdout.on('data', (data) => {
-    let pwm = JSON.parse(data)
-    $('#period').html(pwm.period)
-    $('#duty-cycle').html(pwm.duty)
-    /* The firing time is a multiple of the period. The value also depends upon
-    the size of the light meter's ring buffer and it's sampling rate. As it happens,
-    seven periods fits nicely into a ring buffer of 1000 at 77 KHz. */
-    $('#firing-time').html(pwm.period * config.firingTimeFactor)
+  let buffer = ''
+  _worker.stdout.on('data', (data) => {
+    buffer += _utf8ArrayToStr(data)
+    let lines = buffer.split('\n')
+    buffer = lines.pop()
+    lines.forEach((line) => {
+      let message = null
+      try {
+        message = JSON.parse(line)
+      } catch (SyntaxError) {
+        console.log('controller.pythonWorker: invalid message', line)
+        return
+      }
+      if (message.method === 'timing') {
+        console.log('timing', message.params)
+      } else if (message.method === 'progress') {
+        let job = _workerJobs[message.params.id]
+        if (job !== undefined && job.progress !== undefined) {
+          job.progress(message.params.message)
+        }
+      } else if (_workerJobs[message.id] !== undefined) {
+        let job = _workerJobs[message.id]
+        delete _workerJobs[message.id]
+        if (message.error !== undefined) {
+          job.error(message.error.message)
+        } else {
+          job.result(message.result)
+        }
+      }
+    })
   })
-  jq.stderr.on('data', (data) => {
+  _worker.stderr.on('data', (data) => {
     console.log(_utf8ArrayToStr(data))
   })
-  jq.on('close', (code) => {
-    console.log('controller.setLaserPwmConfig child ' +
-      `process exited with code ${code}`)
+  _worker.on('close', (code) => {
+    console.log(`controller.pythonWorker child process exited with code ${code}`)
+    _worker = null
+    Object.keys(_workerJobs).forEach((id) => {
+      _workerJobs[id].error(`Python worker exited with code ${code}.`)
+    })
+    _workerJobs = {}
   })
+  return _worker
+}
+
+/* Send a request to the Python worker. The callbacks are result(value), error(message) and
+   optionally progress(message). Returns the request id, which workerCancel accepts. */
+module.exports.workerRequest = function (method, params, callbacks) {
+  let id = _workerNextId++
+  _workerJobs[id] = callbacks
+  controller.pythonWorker().stdin.write(JSON.stringify({
+    jsonrpc: '2.0', id: id, method: method, params: params
+  }) + '\n')
+  return id
+}
+
+module.exports.workerCancel = function (id) {
+  if (_worker !== null) {
+    _worker.stdin.write(JSON.stringify({
+      jsonrpc: '2.0', id: _workerNextId++, method: 'cancel', params: {id: id}
+    }) + '\n')
+  }
 }
 
 module.exports.collectData = function (cfg, modelData) {
@@ -246,6 +300,7 @@ module.exports.collectData = function (cfg, modelData) {
       PYTHONIOENCODING: 'utf-8'
     }
   })
+  _collector = cd
   let json = ''
   cd.stdout.on('data', (data) => {
     data = _utf8ArrayToStr(data)
@@ -271,27 +326,36 @@ module.exports.collectData = function (cfg, modelData) {
   })
   cd.on('close', (code) => {
     console.log(`controller.collectData child process exited with code ${code}`)
+    _collector = null
     this.trainModel(cfg, modelData)
   })
 }
 
 module.exports.trainModel = function (cfg, modelData) {
-  let path = controller.getPythonPath()
-  let pyDir = controller.getPythonAppDir()
-  let script = window.path.join(pyDir, 'train_model.py')
-  let tm = spawn(path.pythonBin, [script, '-d', cfg['samples-dir']], {
-    cwd: pyDir,
-    env: {
-      PATH: controller.getPythonPath() + path.delimiter + process.env.PATH,
-      PYTHONIOENCODING: 'utf-8'
-    }
-  })
-  let json = ''
-  tm.stdout.on('data', (data) => {
-    data = _utf8ArrayToStr(data)
-    if (modelData.model === null) {
-      try {
-        json = JSON.parse(data)
+  let status = function (text) {
+    $('#train-status').append(text).scrollTop(
+      $('#train-status')[0].scrollHeight
+    )
+  }
+  let complete = function () {
+    // controller.dataCollectionIsRunning = false
+    model.saveModelData(cfg.formId, modelData, function () {
+      status('\n' +
+        '┌───────────────────┐\n' +
+        '│ Training Complete │\n' +
+        '└───────────────────┘\n')
+    })
+  }
+  status('\n' +
+    '┌──────────────────────┐\n' +
+    '│ Begin Model Training │\n' +
+    '└──────────────────────┘\n\n')
+  controller.workerRequest('train', {directory: cfg['samples-dir']}, {
+    progress: function (message) {
+      status(message + '\n')
+    },
+    result: function (json) {
+      if (modelData.model === null) {
         modelData.samples = json.samples
         modelData.model = json.model
         modelData['cross-validation-accuracy'] = json['cross-validation-accuracy']
@@ -299,54 +363,26 @@ module.exports.trainModel = function (cfg, modelData) {
         modelData['cross-validation-neighbors'] = json['cross-validation-neighbors']
         modelData['cross-validation-folds'] = json['cross-validation-folds']
         modelData['standard-error-estimate'] = json['standard-error-estimate']
-      } catch (SyntaxError) {
-        console.log('Failed to set modelData variables in controller.trainModel.')
-        $('#train-status').append(data).scrollTop(
-          $('#train-status')[0].scrollHeight
-        )
       }
+      complete()
+    },
+    error: function (message) {
+      console.log('controller.trainModel:', message)
+      status(message + '\n')
+      complete()
     }
   })
-  tm.stderr.on('data', (data) => {
-    $('#train-status').append(_utf8ArrayToStr(data)).scrollTop(
-      $('#train-status')[0].scrollHeight
-    )
-  })
-  tm.on('close', (code) => {
-    // controller.dataCollectionIsRunning = false
-    console.log(`controller.trainModel child process exited with code ${code}`)
-    model.saveModelData(cfg.formId, modelData, function () {
-      $('#train-status').append('\n' +
-        '┌───────────────────┐\n' +
-        '│ Training Complete │\n' +
-        '└───────────────────┘\n').scrollTop(
-        $('#train-status')[0].scrollHeight
-      )
-    })
-  })
 }
 
 module.exports.getModelPrediction = function (formId, modelData) {
-  let path = controller.getPythonPath()
-  let pyDir = controller.getPythonAppDir()
-  let script = window.path.join(pyDir, 'prediction.py')
-  let mp = spawn(path.pythonBin, [script, modelData['knn-model-id'],
-    modelData['sample-model-id'],
-    modelData['operator-id'],
-    '-d', app.getPath('userData')], {
-      cwd: pyDir,
-      env: {
-        PATH: controller.getPythonPath() + path.delimiter + process.env.PATH,
-        PYTHONIOENCODING: 'utf-8',
-        QT_QPA_PLATFORM: 'offscreen'
-      }
-    })
-  let json = ''
-  mp.stdout.on('data', (data) => {
-    data = _utf8ArrayToStr(data)
-    if (modelData['host-name'] === null) {
-      try {
-        json = JSON.parse(data)
+  controller.workerRequest('predict', {
+    model_id: modelData['knn-model-id'],
+    sample_id: modelData['sample-model-id'],
+    operator_id: modelData['operator-id'],
+    directory: app.getPath('userData')
+  }, {
+    result: function (json) {
+      if (modelData['host-name'] === null) {
         modelData['host-name'] = json['host-name']
         modelData['date'] = json.date
         modelData['error-proba-mean'] = json['error-proba-mean']
@@ -361,18 +397,12 @@ module.exports.getModelPrediction = function (formId, modelData) {
         modelData['mean-variance-chart'] = json['mean-variance-chart']
         view.displayCompareData(Object.assign({}, modelData))
         model.saveModelComparisonData(formId, modelData)
-      } catch (SyntaxError) {
-        console.log('Failed to set modelData variables in ' +
-          ' controller.getModelPrediction.')
       }
+    },
+    error: function (message) {
+      console.log('controller.getModelPrediction:', message)
     }
   })
-  mp.stderr.on('data', (data) => {
-    console.log(_utf8ArrayToStr(data))
-  })
-  mp.on('close', (code) => {
-    console.log(`controller.getModelPrediction child process exited with code ${code}`)
-  })
 }
 
 module.exports.getPythonPath = function () {
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+""" An event driven acquisition engine that overlaps laser firing, tty capture and disk writes.
+
+The tty is watched with the asyncio selector so the CPU idles while the meter is quiet. The laser host's
+session pool opens the next shot's SSH channel while the current sample is persisted by a background writer.
+"""
+
+import asyncio
+import sys
+from os import path, mkdir
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import timing
+from read_terminal import FrameError
+from shot_scheduler import FixedDelay
+
+
+class Shot:
+    """ The outcome of one laser firing and light meter capture. """
+    def __init__(self, target, command):
+        """
+        :param target: Where the sample is to be persisted.
+        :param command: The remote command that fires the laser.
+        """
+        self.target = target
+        self.command = command
+        self.status = 'pending'
+        self.exit_status = None
+        self.latency = None
+        self.elapsed = None
+        self.fired_at = None
+        self.captured_at = None
+        self.gap = None
+
+
+class FrameReader:
+    """ Deliver frames from a ReadTerminal to asyncio without blocking the event loop. """
+    def __init__(self, tty, loop):
+        """
+        :param tty: An open ReadTerminal.
+        :param loop: The asyncio event loop.
+        """
+        self.tty = tty
+        self.loop = loop
+        self.waiter = None
+        self.error = None
+        self.last_data = monotonic()
+        self.selectable = not sys.platform.startswith('win32') and hasattr(tty.dev, 'fileno')
+        if self.selectable:
+            loop.add_reader(tty.fileno(), self._readable)
+
+    def _readable(self):
+        """ Selector callback; move the waiting bytes into the frame decoder. """
+        try:
+            if self.tty.read_available() > 0:
+                self.last_data = monotonic()
+        except OSError as e:
+            if self.waiter is not None and not self.waiter.done():
+                self.waiter.set_exception(e)
+            return
+        self._deliver()
+
+    def _deliver(self):
+        if self.waiter is None or self.waiter.done():
+            return
+        while True:
+            try:
+                frame = self.tty.decoder.next_frame()
+            except FrameError as e:
+                # Often the remains of an earlier shot's frame; the waiting shot's own frame may follow it.
+                self.skipped(e)
+                continue
+            if frame is not None:
+                self.waiter.set_result(frame)
+            return
+
+    def skipped(self, error):
+        """ Log a frame that failed to decode and keep it in case no good frame arrives before the deadline. """
+        self.error = error
+        print('Skipped', error.msg, error.data, file=sys.stderr, flush=True)
+
+    async def next_frame(self, timeout):
+        """ Return the next frame that decodes.
+
+        :raises FrameError: When only undecodable frames arrived before the timeout.
+        :raises asyncio.TimeoutError: When no frame arrived at all.
+        """
+        self.error = None
+        if not self.selectable:
+            # Windows can not select on a serial port so block a worker thread instead.
+            deadline = monotonic() + timeout
+            while True:
+                try:
+                    frame = await self.loop.run_in_executor(None, self.tty.read_frame,
+                                                            max(0.0, deadline - monotonic()))
+                except FrameError as e:
+                    self.skipped(e)
+                    continue
+                finally:
+                    self.last_data = monotonic()
+                if frame is None:
+                    raise asyncio.TimeoutError() if self.error is None else self.error
+                return frame
+        self.waiter = self.loop.create_future()
+        self._deliver()
+        try:
+            return await asyncio.wait_for(self.waiter, timeout)
+        except asyncio.TimeoutError:
+            if self.error is not None:
+                raise self.error
+            raise
+        finally:
+            self.waiter = None
+
+    def drain(self):
+        """ Discard frames that arrived while no shot was waiting for them. Returns the count. """
+        stale = 0
+        while True:
+            try:
+                frame = self.tty.decoder.next_frame()
+            except FrameError:
+                frame = True
+            if frame is None:
+                return stale
+            stale += 1
+
+    def close(self):
+        if self.selectable:
+            self.loop.remove_reader(self.tty.fileno())
+
+
+class AcquisitionEngine:
+    """ Fire the laser and capture the light meter's response, one shot after another. """
+    def __init__(self, tty, rcmd, timeout=10.0, delay=2.0, scheduler=None):
+        """
+        :param tty: An open ReadTerminal connected to the light meter.
+        :param rcmd: A connected RemoteCommand, or SessionPool, for the laser host.
+        :param timeout: Seconds to wait for the meter's frame before giving up on a shot.
+        :param delay: Seconds to wait between shots when no scheduler is given.
+        :param scheduler: A shot_scheduler policy deciding the wait between shots. Defaults to FixedDelay(delay).
+        """
+        self.tty = tty
+        self.rcmd = rcmd
+        self.timeout = timeout
+        self.delay = delay
+        self.scheduler = FixedDelay(delay) if scheduler is None else scheduler
+        self.disk_executor = ThreadPoolExecutor(max_workers=1)
+
+    def run(self, shots, persist, progress=None, done=None):
+        """ Collect every shot and return the list of Shot outcomes.
+
+        :param shots: A list of (target, command) pairs.
+        :param persist: A function of (target, frame) run on the background writer.
+        :param progress: Optional function of (number, target) called as each shot begins.
+        :param done: Optional function of (shot) called once a shot is finished, and for a sample once it has
+            been persisted.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.collect(shots, persist, progress, done))
+        finally:
+            loop.close()
+
+    @staticmethod
+    def fired(shot, firing):
+        """ Record the outcome of a completed firing on shot. Returns whether the laser fired.
+
+        :param shot: The Shot being collected.
+        :param firing: The firing's CommandResult, or the exception it raised.
+        """
+        if shot.exit_status is not None:
+            return shot.exit_status == 0
+        shot.fired_at = monotonic()
+        if isinstance(firing, Exception):
+            shot.exit_status = -1
+            print('Firing command failed in', shot.target, firing, file=sys.stderr, flush=True)
+        else:
+            shot.exit_status = firing.exit_status
+            shot.latency = firing.elapsed
+            if not firing.ok:
+                print('Firing command exited with', firing.exit_status, 'in', shot.target,
+                      firing.stderr.decode(errors='replace'), file=sys.stderr, flush=True)
+        if shot.exit_status != 0:
+            shot.status = 'failed'
+        return shot.exit_status == 0
+
+    @staticmethod
+    def persisted(shot, write, done):
+        """ Report a shot as done once its sample write has finished. """
+        if write.cancelled() or write.exception() is not None:
+            shot.status = 'unwritten'
+        done(shot)
+
+    async def collect(self, shots, persist, progress=None, done=None):
+        """ Coroutine form of run() for sharing an event loop with other engines. """
+        loop = asyncio.get_event_loop()
+        reader = FrameReader(self.tty, loop)
+        outcomes = []
+        writes = []
+        capture_log = getattr(self.tty, 'capture', None)
+        try:
+            for number, (target, command) in enumerate(shots, start=1):
+                shot = Shot(target, command)
+                outcomes.append(shot)
+                if progress is not None:
+                    progress(number, target)
+                stale = reader.drain()
+                if stale > 0:
+                    print('Discarded', stale, 'stale frame(s) before', target, file=sys.stderr, flush=True)
+                if capture_log is not None:
+                    # Marks where replay_capture.py starts looking for this shot's frame.
+                    capture_log.note(event='shot', target=target)
+                start = monotonic()
+                firing = asyncio.wrap_future(self.rcmd.fire(command, timeout=self.timeout))
+                capture = asyncio.ensure_future(reader.next_frame(self.timeout))
+                await asyncio.wait([firing, capture], return_when=asyncio.FIRST_COMPLETED)
+                misfired = firing.done() and not self.fired(shot, firing.exception() or firing.result())
+                if misfired:
+                    # A failed firing produces no light; don't wait out the timeout for it.
+                    capture.cancel()
+                try:
+                    frame = await capture
+                    shot.captured_at = monotonic()
+                    if not firing.done():
+                        await asyncio.wait([firing])
+                        self.fired(shot, firing.exception() or firing.result())
+                    if shot.exit_status == 0:
+                        shot.status = 'ok'
+                        write = loop.run_in_executor(self.disk_executor, persist, target, frame)
+                        if done is not None:
+                            write.add_done_callback(lambda write, shot=shot: self.persisted(shot, write, done))
+                        writes.append(write)
+                except asyncio.CancelledError:
+                    if not misfired:
+                        raise
+                except asyncio.TimeoutError:
+                    shot.status = 'timeout'
+                    print('Timeout waiting', self.timeout, 'seconds for the light meter in', target,
+                          file=sys.stderr, flush=True)
+                except FrameError as e:
+                    shot.status = 'invalid'
+                    print('Unrecoverable', e.msg, 'in', target, e.data, file=sys.stderr, flush=True)
+                shot.elapsed = monotonic() - start
+                await asyncio.wait([firing])
+                self.fired(shot, firing.exception() or firing.result())
+                timing.record('shot', shot.elapsed, sample=target, status=shot.status)
+                if capture_log is not None:
+                    capture_log.note(event='done', target=target, status=shot.status)
+                if done is not None and shot.status != 'ok':
+                    done(shot)
+                if number < len(shots):
+                    shot.gap = await self.scheduler.wait(shot, reader)
+                    timing.record('shot.gap', shot.gap, sample=target)
+            await asyncio.gather(*writes)
+        finally:
+            reader.close()
+        return outcomes
+
+    def close(self):
+        self.disk_executor.shutdown(wait=True)
+
+
+def write_sample(target, frame):
+    """ Write a validated sample into its file. Runs on the acquisition engine's writer thread. """
+    with timing.span('disk.write', sample=target) as write:
+        folder = path.dirname(target)
+        if not path.isdir(folder):
+            mkdir(folder, mode=0o744)
+        text = frame.to_json()
+        with open(target, 'w') as f:
+            f.write(text)
+        write.bytes = len(text)
+
+
+def get_store_writer(store, locations):
+    """ Return a function appending validated samples to a run's sample store on the writer thread. """
+    def store_sample(target, frame):
+        duty, serial = locations[target]
+        with timing.span('disk.append', len(frame.raw), sample=target):
+            store.append(duty, serial, frame)
+    return store_sample
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+""" Active learning for collection runs: spend the remaining laser firings where the classifier is weakest.
+
+After each round of shots the KNN is cross validated on the samples collected so far. A duty cycle's weight
+is the share of its samples predicted as another duty plus the share of other duties' samples predicted as
+it, so both sides of a confused pair get more shots. The next round's shots are split in proportion to the
+weights. Collection stops once the cross validated accuracy reaches the target or no duty has room left.
+"""
+
+import json
+import time
+from math import floor
+from os import path
+from random import Random
+import numpy as np
+from sklearn.metrics import confusion_matrix
+from sklearn.model_selection import StratifiedKFold, cross_val_predict
+from sklearn.neighbors import KNeighborsClassifier
+
+ROUNDS_NAME = 'active_learning.log'
+
+
+def assess(X, y, duties, neighbors=5, folds=5):
+    """ Returns the cross validated accuracy of the KNN and the confusion matrix over duties.
+
+    :param X: The feature matrix of the samples collected so far.
+    :param y: Their duty cycles.
+    :param duties: Every duty cycle of the run, including those without samples yet.
+    :param neighbors: The number of neighbors of the KNN.
+    :param folds: The most cross validation folds; fewer are used while a duty has fewer samples.
+    :raises ValueError: When there are too few samples to cross validate.
+    """
+    y = np.asarray(y)
+    counts = np.unique(y, return_counts=True)[1]
+    if len(counts) < 2:
+        raise ValueError('Too few duty cycles collected to cross validate.')
+    cv = StratifiedKFold(n_splits=int(max(2, min(folds, counts.min()))))
+    try:
+        predict = cross_val_predict(KNeighborsClassifier(n_neighbors=neighbors), X, y, cv=cv)
+    except ValueError as e:
+        raise ValueError(' '.join(['Error computing cross_val_predict.', str(e)]))
+    return {
+        'samples': len(y),
+        'accuracy': float(np.mean(predict == y)),
+        'duties': list(duties),
+        'confusion': confusion_matrix(y, predict, labels=list(duties)).tolist()}
+
+
+def get_weights(assessment):
+    """ Returns the weight of each duty cycle. A duty without samples gets the largest weight, 1. """
+    confusion = np.asarray(assessment['confusion'], dtype=np.float64)
+    samples = confusion.sum(axis=1)
+    errors = samples - np.diag(confusion) + confusion.sum(axis=0) - np.diag(confusion)
+    weights = np.ones(len(samples))
+    collected = samples > 0
+    weights[collected] = np.minimum(1.0, errors[collected] / (2 * samples[collected]))
+    return dict(zip(assessment['duties'], weights.tolist()))
+
+
+def allocate(weights, room, batch):
+    """ Split batch shots across duty cycles in proportion to their weights.
+
+        Fractions of a shot go to the largest quotas first. A duty gets no more than its room, and shots a
+        full duty can not take go to the others.
+
+    :param weights: The weight of each duty cycle.
+    :param room: The number of shots each duty cycle can still take.
+    :param batch: The number of shots to split.
+    """
+    allocation = {duty: 0 for duty in weights}
+    left = batch
+    while left > 0:
+        open_duties = [duty for duty in weights if weights[duty] > 0 and allocation[duty] < room.get(duty, 0)]
+        if len(open_duties) == 0:
+            break
+        total = sum(weights[duty] for duty in open_duties)
+        quotas = {duty: left * weights[duty] / total for duty in open_duties}
+        shares = {duty: min(floor(quotas[duty]), room[duty] - allocation[duty]) for duty in open_duties}
+        if sum(shares.values()) == 0:
+            shares = {duty: 1 for duty in sorted(open_duties, key=lambda duty: quotas[duty], reverse=True)[:left]}
+        for duty, share in shares.items():
+            allocation[duty] += share
+            left -= share
+    return {duty: shots for duty, shots in allocation.items() if shots > 0}
+
+
+def get_room(plan, duties, limit):
+    """ Returns the number of shots each duty cycle can still take when limit are allowed per duty. """
+    planned = {duty: 0 for duty in duties}
+    for duty, serial in plan:
+        planned[duty] = planned.get(duty, 0) + 1
+    return {duty: max(0, limit - planned[duty]) for duty in duties}
+
+
+def plan_round(plan, allocation, random=1, seed=None):
+    """ Returns the (duty, serial) shots of an allocation, numbered after the serials already in plan.
+
+    :param plan: The shots planned so far.
+    :param allocation: The number of new shots of each duty cycle.
+    :param random: Whether to shuffle the shots.
+    :param seed: The shuffle seed.
+    """
+    last = {}
+    for duty, serial in plan:
+        last[duty] = max(last.get(duty, -1), serial)
+    shots = [(duty, last.get(duty, -1) + 1 + number)
+             for duty, count in sorted(allocation.items()) for number in range(count)]
+    if random == 1:
+        Random(seed).shuffle(shots)
+    return shots
+
+
+def record_round(directory, entry):
+    """ Append a round's assessment and allocation to the run's active learning log. """
+    entry = dict(entry, time=time.time())
+    with open(path.join(directory, ROUNDS_NAME), 'a') as f:
+        f.write(json.dumps(entry))
+        f.write('\n')
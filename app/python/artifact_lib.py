@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+""" Save and load model, sample and prediction artifacts with a selectable codec.
+
+    none  Uncompressed. Arrays are written so that loading memory-maps them instead of reading them.
+    fast  LZ4 when the lz4 module is installed, otherwise zlib at level 1.
+    xz    LZMA, the original format. Smallest and slowest to load.
+
+Loading does not need to know the codec; find_artifact() picks the most recently written copy present, whatever
+its codec, so an artifact saved again with another codec supersedes the older copies. Only copies written at the
+same time are picked by load speed: none, then fast, then xz.
+"""
+
+from os import path, stat
+import numpy as np
+from sklearn.externals import joblib
+
+try:
+    import lz4.frame
+    FAST_CODEC = ('lz4', 3, '.pkl.lz4')
+except ImportError:
+    FAST_CODEC = ('zlib', 1, '.pkl.z')
+
+""" Codec name: (joblib compressor, level, file extension). Listed in load speed order. """
+CODECS = {
+    'none': (None, 0, '.pkl'),
+    'fast': FAST_CODEC,
+    'xz': ('xz', 3, '.pkl.xz')
+}
+DEFAULT_CODEC = 'xz'
+ARRAY_EXTENSION = '.npy'
+
+
+def artifact_file(directory, name, codec=DEFAULT_CODEC, array=False):
+    """ Returns the path an artifact is stored at.
+
+    :param directory: The model directory.
+    :param name: The artifact name without extension, e.g. knn_model.
+    :param codec: One of CODECS.
+    :param array: Whether the artifact is a plain array; uncompressed arrays are stored as .npy files.
+    """
+    extension = ARRAY_EXTENSION if array and codec == 'none' else CODECS[codec][2]
+    return path.join(directory, ''.join([name, extension]))
+
+
+def artifact_name(filename):
+    """ Returns the directory and name of an artifact file, or None when it is not an artifact file. """
+    extensions = [ARRAY_EXTENSION] + [extension for compressor, level, extension in CODECS.values()]
+    for extension in sorted(extensions, key=len, reverse=True):
+        if filename.endswith(extension):
+            return path.dirname(filename), path.basename(filename)[:-len(extension)]
+    return None
+
+
+def artifact_files(directory, name):
+    """ Returns the paths of every saved copy of an artifact, newest first. """
+    files = []
+    for codec in CODECS:
+        for array in (True, False):
+            file = artifact_file(directory, name, codec, array)
+            if file not in files and path.isfile(file):
+                files.append(file)
+    # sorted() is stable, so copies saved at the same time stay in load speed order.
+    return sorted(files, key=lambda file: stat(file).st_mtime_ns, reverse=True)
+
+
+def find_artifact(directory, name):
+    """ Returns the path of the newest copy of an artifact, or None when there is none.
+
+        Retraining with another codec leaves the older copies behind; they are never preferred.
+    """
+    files = artifact_files(directory, name)
+    return files[0] if len(files) > 0 else None
+
+
+def dump_artifact(value, directory, name, codec=DEFAULT_CODEC):
+    """ Save an artifact and return its path. """
+    array = isinstance(value, np.ndarray)
+    filename = artifact_file(directory, name, codec, array)
+    if filename.endswith(ARRAY_EXTENSION):
+        np.save(filename, value)
+    else:
+        compressor, level, extension = CODECS[codec]
+        joblib.dump(value, filename, compress=(compressor, level) if compressor else 0)
+    return filename
+
+
+def load_artifact(filename, mmap=True):
+    """ Load an artifact saved by dump_artifact or the original .pkl.xz files.
+
+    :param mmap: Whether to memory-map the arrays of uncompressed artifacts read-only.
+    """
+    mmap_mode = 'r' if mmap else None
+    if filename.endswith(ARRAY_EXTENSION):
+        return np.load(filename, mmap_mode=mmap_mode)
+    # Compressed files are always read into memory; joblib ignores mmap_mode for them.
+    return joblib.load(filename, mmap_mode=mmap_mode if filename.endswith(CODECS['none'][2]) else None)
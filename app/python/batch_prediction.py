@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Score many sample runs against one or more models in one process, printing one JSON line per pair.
+
+Each model and sample artifact is loaded once. For each model the samples of every run are stacked and scored
+with a single predict_proba call; the class predictions are its argmax, as KNeighborsClassifier.predict
+computes them. The lines have the fields prediction.py prints, or knn-model-id, sample-model-id and error
+when a pair can not be scored. The exit status is 1 when no pair could be scored.
+"""
+
+import argparse
+import re
+import sys
+from json import JSONEncoder
+from os import path, getcwd, listdir
+from platform import node
+import numpy as np
+import timing
+from artifact_lib import CODECS, DEFAULT_CODEC, find_artifact, load_artifact
+from prediction import check_settings, get_model, get_result, get_samples, get_std_err_estimate, save_predict_proba
+
+
+def find_runs(directory):
+    """ Returns the IDs of the trained runs in directory, oldest first. """
+    return sorted((f for f in listdir(directory)
+                   if re.match(r'^\d+$', f) and find_artifact(path.join(directory, f), 'poly2d') is not None),
+                  key=int)
+
+
+def predict_batch(model_ids, sample_ids, operator_id, directory=getcwd(), host=node(), loader=load_artifact,
+                  codec=DEFAULT_CODEC, lut=True, save=True):
+    """ Score every sample run with every model. Yields a result dictionary per (model, sample) pair.
+
+    :param model_ids: Model ID numbers of the models.
+    :param sample_ids: Model ID numbers of the samples.
+    :param operator_id: Operator ID number for the person running the prediction.
+    :param directory: Base directory for the models.
+    :param host: The local hostname.
+    :param loader: The function loading an artifact file.
+    :param codec: The artifact_lib codec the prediction probabilities are saved with.
+    :param lut: Whether to predict with each model's lookup table when there is a current one.
+    :param save: Whether to save each pair's prediction probabilities with the model for the charts.
+    """
+    samples = {}
+    for sample_id in sample_ids:
+        try:
+            samples[sample_id] = get_samples(directory, sample_id, loader=loader)
+        except ValueError as e:
+            samples[sample_id] = e
+
+    for model_id in model_ids:
+        try:
+            knn, model_settings = get_model(directory, model_id, loader=loader, lut=lut)
+        except ValueError as e:
+            for sample_id in sample_ids:
+                yield {'knn-model-id': model_id, 'sample-model-id': sample_id, 'error': str(e)}
+            continue
+
+        scored = []
+        for sample_id in sample_ids:
+            try:
+                if isinstance(samples[sample_id], ValueError):
+                    raise samples[sample_id]
+                X, y, sample_settings = samples[sample_id]
+                check_settings(model_id, sample_id, model_settings, sample_settings)
+                scored.append(sample_id)
+            except ValueError as e:
+                yield {'knn-model-id': model_id, 'sample-model-id': sample_id, 'error': str(e)}
+        if len(scored) == 0:
+            continue
+
+        X = np.concatenate([samples[sample_id][0] for sample_id in scored])
+        with timing.span('model.predict_proba', sample=model_id, samples=len(X), runs=len(scored)):
+            predict_proba = knn.predict_proba(X)
+        predict = knn.classes_[predict_proba.argmax(axis=1)]
+        ends = np.cumsum([len(samples[sample_id][1]) for sample_id in scored])
+        for sample_id, proba, guess in zip(scored, np.split(predict_proba, ends[:-1]), np.split(predict, ends[:-1])):
+            y = samples[sample_id][1]
+            predict_proba_file = save_predict_proba(directory, model_id, sample_id, proba, codec) if save else None
+            yield get_result(model_id, sample_id, operator_id, directory, host, proba.sum(axis=0), np.mean(guess == y),
+                             get_std_err_estimate(guess, y), predict_proba_file)
+
+
+def parse_ids(text):
+    return [run_id for run_id in text.split(',') if run_id != '']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('operator_id', help='Operator ID number for the person running the prediction.')
+    parser.add_argument('-m', '--models', default=None, type=parse_ids,
+                        help='Comma separated model ID numbers. Defaults to every trained run in the directory.')
+    parser.add_argument('-s', '--samples', default=None, type=parse_ids,
+                        help='Comma separated sample ID numbers. Defaults to every trained run in the directory.')
+    parser.add_argument('-d', '--directory', default=getcwd(),
+                        help="Base directory for the models. Defaults to current directory.")
+    parser.add_argument('--host', default=node(),
+                        help="The local hostname. Defaults to the local hostname.")
+    parser.add_argument('--codec', default=DEFAULT_CODEC, choices=sorted(CODECS),
+                        help=''.join(['Compression of the saved prediction probabilities. Defaults to ',
+                                      DEFAULT_CODEC, '.']))
+    parser.add_argument('--save', default=1, type=int,
+                        help='Whether to save the prediction probabilities of each pair for the charts.'
+                             ' Defaults to true.')
+    parser.add_argument('--lut', default=1, type=int,
+                        help='Whether to predict with the lookup tables compiled by train_model.py --lut when they'
+                             ' are current. Defaults to true.')
+    parser.add_argument('--timing', default=None,
+                        help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+    args = parser.parse_args()
+    if args.timing is not None:
+        timing.configure(args.timing)
+
+    if not path.isdir(args.directory):
+        print('Error:', args.directory, 'is not a directory.', file=sys.stderr, flush=True)
+        exit(1)
+    runs = find_runs(args.directory) if args.models is None or args.samples is None else None
+    scored = 0
+    encoder = JSONEncoder()
+    for output in predict_batch(runs if args.models is None else args.models,
+                                runs if args.samples is None else args.samples,
+                                args.operator_id, directory=args.directory, host=args.host, codec=args.codec,
+                                lut=args.lut == 1, save=args.save == 1):
+        scored += 'error' not in output
+        print(encoder.encode(output), flush=True)
+
+    if scored == 0:
+        print('Error: no pair could be scored.', file=sys.stderr, flush=True)
+        exit(1)
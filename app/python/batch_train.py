@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Train the models of many collection runs with one command, the runs spread across worker processes.
+
+Each worker process imports numpy and scikit-learn once and trains the runs it is given as train_model.py
+does, reusing each run's feature cache, so only samples whose features are out of date are parsed again.
+Every run gets its knn_model and poly2d artifacts. One JSON line per run, the fields train_model.py prints
+plus directory, model-id and seconds or an error, is printed and written to the report.
+"""
+
+import argparse
+import json
+import re
+import sys
+from os import path, getcwd, listdir, cpu_count
+from time import perf_counter
+import timing
+from artifact_lib import CODECS, DEFAULT_CODEC
+from pwm_wave_lib import FEATURE_SETTINGS
+from sample_features import get_executor
+from sample_store import STORE_NAME
+from train_model import train
+
+REPORT_NAME = 'batch_train.jsonl'
+
+
+def has_samples(directory):
+    """ Returns whether a directory is a collection run, with a sample store or ??_duty folders. """
+    return path.isfile(path.join(directory, STORE_NAME)) or any(
+        re.match(r'^\d{2}_duty$', f) and path.isdir(path.join(directory, f)) for f in listdir(directory))
+
+
+def find_runs(directory):
+    """ Returns the collection run directories in directory, oldest first. """
+    return [path.join(directory, f) for f in sorted((f for f in listdir(directory) if re.match(r'^\d+$', f)), key=int)
+            if has_samples(path.join(directory, f))]
+
+
+def get_run(name):
+    """ Returns the run directory of a run directory or sample store path. """
+    return path.dirname(path.abspath(name)) if path.basename(name) == STORE_NAME else name
+
+
+def train_run(directory, options):
+    """ Train one run in a worker process. Returns its report line. """
+    start = perf_counter()
+    result = {'directory': directory, 'model-id': path.basename(path.normpath(directory))}
+    try:
+        if not path.isdir(directory):
+            raise ValueError(' '.join(['Error:', directory, 'is not a directory.']))
+        with timing.span('batch.train', sample=directory):
+            result.update(train(directory, **options))
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+    except Exception as e:
+        # Any other failure of a malformed run is reported with it rather than ending the batch.
+        result['error'] = ' '.join([type(e).__name__, str(e)])
+    result['seconds'] = perf_counter() - start
+    return result
+
+
+def train_batch(directories, workers=cpu_count(), **options):
+    """ Train every run. Yields the report line of each run, in the order given.
+
+    :param directories: The collection run directories.
+    :param workers: The number of processes. Runs are trained in parallel, one per process; a single run is
+        given every process to featurize samples and score folds.
+    :param options: Arguments passed on to train_model.train.
+    """
+    if len(directories) == 0:
+        return
+    processes = max(1, min(workers, len(directories)))
+    # Pools nested inside pool workers can deadlock, so a run's own parallelism is only used without a pool.
+    options['workers'] = workers if processes == 1 else 1
+    with get_executor(processes) as executor:
+        for result in executor.map(train_run, directories, [options] * len(directories)):
+            yield result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('runs', nargs='*',
+                        help=''.join(['Run directories or ', STORE_NAME, ' files to train. Defaults to every run',
+                                      ' in --directory.']))
+    parser.add_argument('-d', '--directory', default=getcwd(),
+                        help='Base directory of the runs. Defaults to current directory.')
+    parser.add_argument('-o', '--report', default=None,
+                        help=''.join(['The JSON-lines report file. Defaults to ', REPORT_NAME, ' in --directory.']))
+    parser.add_argument('-w', '--workers', default=cpu_count(), type=int,
+                        help='The number of processes. Defaults to the CPU count.')
+    parser.add_argument('--pack', default=0, type=int,
+                        help=''.join(['Whether to pack the JSON sample files of each run into ', STORE_NAME,
+                                      ' before training. Defaults to false.']))
+    parser.add_argument('--cache', default=1, type=int,
+                        help='Whether to reuse the features of unchanged samples. Defaults to true.')
+    parser.add_argument('--codec', default=DEFAULT_CODEC, choices=sorted(CODECS),
+                        help=''.join(['Compression of the saved samples and models. Defaults to ', DEFAULT_CODEC,
+                                      '.']))
+    parser.add_argument('--neighbors', default=5, type=int,
+                        help='The number of neighbors the classifiers vote with. Defaults to 5.')
+    parser.add_argument('--folds', default=5, type=int,
+                        help='The number of cross validation folds. Defaults to 5.')
+    parser.add_argument('--bins', default=FEATURE_SETTINGS['bins'], type=int,
+                        help='Histogram bins over the voltage window; one fewer are features. Defaults to 3.')
+    parser.add_argument('--window', default=FEATURE_SETTINGS['window'], type=float,
+                        help='Width of the histogram voltage window above the minimum. Defaults to 0.05.')
+    parser.add_argument('--start', default=FEATURE_SETTINGS['start'], type=int,
+                        help='The first reading of the sample window. Defaults to 45.')
+    parser.add_argument('--periods', default=FEATURE_SETTINGS['sample_size'], type=int,
+                        help='The length of the sample window in PWM periods. Defaults to 8.')
+    parser.add_argument('--lut', default=0, type=int,
+                        help='Whether to also compile each model into a lookup table for fast prediction.'
+                             ' Defaults to false.')
+    parser.add_argument('--timing', default=None,
+                        help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+    args = parser.parse_args()
+    if args.timing is not None:
+        timing.configure(args.timing)
+
+    if len(args.runs) == 0 and not path.isdir(args.directory):
+        print('Error:', args.directory, 'is not a directory.', file=sys.stderr, flush=True)
+        exit(1)
+    runs = [get_run(run) for run in args.runs] if len(args.runs) > 0 else find_runs(args.directory)
+    if len(runs) == 0:
+        print('Error: no collection runs found.', file=sys.stderr, flush=True)
+        exit(1)
+
+    trained = 0
+    encoder = json.JSONEncoder()
+    with open(path.join(args.directory, REPORT_NAME) if args.report is None else args.report, 'w') as report:
+        for output in train_batch(runs, workers=args.workers, cache=args.cache == 1, pack=args.pack == 1,
+                                  codec=args.codec, lut=args.lut == 1, neighbors=args.neighbors, folds=args.folds,
+                                  settings={'bins': args.bins, 'window': args.window, 'start': args.start,
+                                            'sample_size': args.periods}):
+            trained += 'error' not in output
+            line = encoder.encode(output)
+            report.write(line)
+            report.write('\n')
+            report.flush()
+            print(line, flush=True)
+
+    if trained == 0:
+        print('Error: no run could be trained.', file=sys.stderr, flush=True)
+        exit(1)
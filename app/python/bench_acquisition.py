@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Measure collection throughput end to end against a fake light meter and laser host.
+
+The meter runs in its own process on a pseudo-terminal; ReadTerminal, the acquisition engine and the sample
+writers are the ones collect_random_data.py uses. Reports samples per second, per-shot latency percentiles
+and the CPU time of this process.
+"""
+
+import argparse
+import resource
+import shutil
+import sys
+from collections import Counter
+from itertools import product
+from json import JSONEncoder
+from os import path
+from tempfile import mkdtemp
+from time import perf_counter
+import numpy as np
+from acquisition import AcquisitionEngine, get_store_writer, write_sample
+from fake_meter import FakeLaserHost, MeterProcess
+from read_terminal import ReadTerminal
+from capture_log import CaptureLog
+from sample_store import SampleStore, STORE_NAME
+from shot_scheduler import SCHEDULERS, get_scheduler
+import timing
+
+
+def percentiles(seconds):
+    """ Returns the 50th, 90th and 99th percentile and maximum of a list of durations, in milliseconds. """
+    if len(seconds) == 0:
+        return None
+    p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) * 1000
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': max(seconds) * 1000}
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-d', '--data_dir', default=None,
+                    help='Where to keep the collected samples. Defaults to a temporary directory that is removed.')
+parser.add_argument('--min', default=20, type=int,
+                    help='The minimum duty cycle. Defaults to 20.')
+parser.add_argument('--max', default=80, type=int,
+                    help='The maximum duty cycle. Defaults to 80.')
+parser.add_argument('-s', '--samples', default=3, type=int,
+                    help='The number of samples at each duty cycle. Defaults to 3.')
+parser.add_argument('--binary', default=0, type=int,
+                    help='Whether to ask the meter for compact binary frames. Defaults to false.')
+parser.add_argument('--store', default=0, type=int,
+                    help=''.join(['Whether to append samples to ', STORE_NAME, ' instead of JSON files.',
+                                  ' Defaults to false.']))
+parser.add_argument('--noise', default=0.01, type=float,
+                    help='Standard deviation of the reading noise. Defaults to 0.01.')
+parser.add_argument('--garbage', default=0.0, type=float,
+                    help='Probability of line noise ahead of a frame. Defaults to 0.')
+parser.add_argument('--truncate', default=0.0, type=float,
+                    help='Probability of a truncated frame. Defaults to 0.')
+parser.add_argument('--rate', default=0, type=int,
+                    help='Bytes per second the meter tty is paced to. Defaults to 0, unpaced.')
+parser.add_argument('--latency', default=0.05, type=float,
+                    help='Seconds each firing command takes. Defaults to 0.05.')
+parser.add_argument('--fail', default=0.0, type=float,
+                    help='Probability of a firing command failing. Defaults to 0.')
+parser.add_argument('--timeout', default=2.0, type=float,
+                    help='Seconds to wait for a frame before skipping the sample. Defaults to 2.')
+parser.add_argument('--schedule', default='ready', choices=SCHEDULERS,
+                    help='How to pace the shots; see collect_random_data.py. Defaults to ready.')
+parser.add_argument('--delay', default=2.0, type=float,
+                    help='Seconds to wait between samples with --schedule fixed. Defaults to 2.')
+parser.add_argument('--cooldown', default=0.0, type=float,
+                    help='The laser cooldown seconds with --schedule ready. Defaults to 0.')
+parser.add_argument('--quiet', default=0.05, type=float,
+                    help='Seconds the tty must be quiet with --schedule ready. Defaults to 0.05.')
+parser.add_argument('--seed', default=None, type=int,
+                    help='Seed for the readings and injected faults.')
+parser.add_argument('--capture', default=None,
+                    help='Log the raw tty byte stream to this capture file for replay_capture.py.')
+parser.add_argument('--timing', default=None,
+                    help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+args = parser.parse_args()
+if args.timing is not None:
+    timing.configure(args.timing)
+
+if args.min < 10 or args.max > 99 or args.min > args.max:
+    print('Error: the duty cycles must be two digit numbers with --min no more than --max.',
+          file=sys.stderr, flush=True)
+    exit(1)
+
+run_dir = mkdtemp(dir=args.data_dir)
+meter = MeterProcess(noise=args.noise, garbage=args.garbage, truncate=args.truncate, rate=args.rate,
+                     seed=args.seed)
+host = FakeLaserHost(meter, latency=args.latency, fail=args.fail, seed=args.seed)
+tty = ReadTerminal(tty=meter.tty, stty=False, binary=args.binary == 1,
+                   capture=CaptureLog(args.capture) if args.capture is not None else None)
+
+shots = []
+locations = {}
+for duty, serial in product(range(args.min, args.max + 1), range(args.samples)):
+    target = path.join(run_dir, ''.join([str(duty), '_duty']), ''.join(['serial', '{:02d}'.format(serial), '.json']))
+    # The same form as the collector's firing command, so the host can read the duty from the config name.
+    command = ''.join(['cups_driver -j Configs/0', str(duty), '_test.json --fire-laser "0.0150"'])
+    locations[target] = (duty, serial)
+    shots.append((target, command))
+if args.store == 1:
+    persist = get_store_writer(SampleStore(path.join(run_dir, STORE_NAME)), locations)
+else:
+    persist = write_sample
+
+scheduler = get_scheduler(args.schedule, delay=args.delay, cooldown=args.cooldown, quiet=args.quiet)
+engine = AcquisitionEngine(tty, host, timeout=args.timeout, scheduler=scheduler)
+cpu_start = cpu_seconds()
+start = perf_counter()
+outcomes = engine.run(shots, persist)
+engine.close()
+elapsed = perf_counter() - start
+cpu = cpu_seconds() - cpu_start
+
+tty.close()
+host.close()
+meter.close()
+
+statuses = Counter(shot.status for shot in outcomes)
+print(JSONEncoder().encode({
+    'shots': len(outcomes),
+    'statuses': dict(statuses),
+    'frames-written': meter.frames,
+    'format': 'binary' if args.binary == 1 else 'json',
+    'persist': 'store' if args.store == 1 else 'files',
+    'schedule': args.schedule,
+    'seconds': elapsed,
+    'samples-per-second': statuses['ok'] / elapsed,
+    'shot-ms': percentiles([shot.elapsed for shot in outcomes if shot.status == 'ok']),
+    'gap-ms': percentiles([shot.gap for shot in outcomes if shot.gap is not None]),
+    'firing-ms': percentiles([shot.latency for shot in outcomes if shot.latency is not None]),
+    'cpu-seconds': cpu,
+    'cpu-percent': 100 * cpu / elapsed,
+    'data-dir': run_dir if args.data_dir is not None else None}), flush=True)
+
+if args.data_dir is None:
+    shutil.rmtree(run_dir)
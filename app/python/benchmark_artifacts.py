@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Compare the size and load time of a run's model and samples saved with each artifact codec. """
+
+import argparse
+import sys
+import time
+from json import JSONEncoder
+from os import path, getcwd, mkdir
+from statistics import median
+from tempfile import TemporaryDirectory
+import numpy as np
+from artifact_lib import CODECS, dump_artifact, find_artifact, load_artifact
+
+
+def time_call(function, repeat):
+    """ Returns the median wall time in seconds of calling function repeat times, and its last result. """
+    times = []
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return median(times), result
+
+
+def load_and_score(model_file, sample_file):
+    """ Load the model and samples and score the model on them. """
+    knn = load_artifact(model_file)
+    samples = load_artifact(sample_file)
+    return knn.score(np.asarray(samples.data), np.asarray(samples.target))
+
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-d', '--directory', default=getcwd(),
+                    help='Path to a trained run. Defaults to current directory.')
+parser.add_argument('-r', '--repeat', default=5, type=int,
+                    help='The number of times each load is timed. Defaults to 5.')
+args = parser.parse_args()
+
+model_file = find_artifact(args.directory, 'knn_model')
+sample_file = find_artifact(args.directory, 'poly2d')
+for name, file in [('knn_model', model_file), ('poly2d', sample_file)]:
+    if file is None:
+        print('Error: no', name, 'artifact in', args.directory, file=sys.stderr, flush=True)
+        exit(1)
+
+knn = load_artifact(model_file, mmap=False)
+samples = load_artifact(sample_file, mmap=False)
+samples.data = np.asarray(samples.data)
+samples.target = np.asarray(samples.target)
+
+results = {}
+with TemporaryDirectory() as temp:
+    for codec in CODECS:
+        codec_dir = path.join(temp, codec)
+        mkdir(codec_dir)
+        dump_time, files = time_call(lambda: [dump_artifact(knn, codec_dir, 'knn_model', codec),
+                                              dump_artifact(samples, codec_dir, 'poly2d', codec)], 1)
+        load_time, loaded = time_call(lambda: [load_artifact(file) for file in files], args.repeat)
+        # Memory-mapped arrays are only read when used, so also time a first prediction.
+        predict_time, score = time_call(lambda: load_and_score(*files), args.repeat)
+        results[codec] = {
+            'files': [path.basename(file) for file in files],
+            'bytes': sum(path.getsize(file) for file in files),
+            'dump-seconds': dump_time,
+            'load-seconds': load_time,
+            'load-and-score-seconds': predict_time,
+            'score': score}
+
+print(JSONEncoder().encode({'directory': args.directory, 'repeat': args.repeat, 'samples': len(samples.target),
+                            'codecs': results}), flush=True)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" An append-only log of the raw byte stream between the collector and a light meter tty.
+
+Every chunk ReadTerminal reads or writes is kept with its receive time, including noise between frames and
+frames that fail to decode, so a run can be decoded again later by replay_capture.py. The acquisition engine
+adds notes marking where each shot begins and how it ended.
+
+The file starts with CAPTURE_MAGIC followed by records of a RECORD header and its data:
+
+    kind    b'R' bytes read from the tty, b'W' bytes written to it, b'N' a JSON note
+    time    seconds since the epoch, as a double
+    length  the number of data bytes that follow
+"""
+
+import json
+import struct
+import threading
+import time
+from os import path
+
+CAPTURE_NAME = 'capture.log'
+CAPTURE_MAGIC = b'LMCAP\x00\x01\n'
+RECORD = struct.Struct('<cdI')
+
+READ = b'R'
+WRITE = b'W'
+NOTE = b'N'
+
+
+class CaptureLog:
+    """ Appends the records of one tty to a capture file. """
+    def __init__(self, filename):
+        """
+        :param filename: The capture file. It is created, or appended to when it exists.
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        new = not path.isfile(filename) or path.getsize(filename) == 0
+        self.file = open(filename, 'ab')
+        if new:
+            self.file.write(CAPTURE_MAGIC)
+            self.file.flush()
+
+    def write(self, kind, data, at=None):
+        """ Append a record. Each record is flushed so a crash loses at most the one being written. """
+        with self.lock:
+            self.file.write(RECORD.pack(kind, time.time() if at is None else at, len(data)))
+            self.file.write(data)
+            self.file.flush()
+
+    def received(self, data):
+        if len(data) > 0:
+            self.write(READ, data)
+
+    def sent(self, data):
+        self.write(WRITE, data)
+
+    def note(self, **fields):
+        """ Append a note, e.g. note(event='shot', target=...). """
+        self.write(NOTE, json.dumps(fields).encode())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(filename):
+    """ Yields the (kind, time, data) records of a capture file, in order.
+
+        A record cut short by a crash ends the iteration.
+
+    :raises ValueError: When the file is not a capture log.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(' '.join(['Error:', filename, 'is not a capture log.']))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, at, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, at, data
@@ -3,16 +3,24 @@
 """ Collect data from a tty device incident with a remote command. """
 
 import argparse
+import asyncio
 import sys
-import re
-from itertools import product
-from json import JSONEncoder, JSONDecoder, JSONDecodeError
+import json
+from json import JSONEncoder
 from math import floor
-from os import path, mkdir, getcwd, unlink
-from random import seed, shuffle
-from time import time, sleep
+from os import path, mkdir, getcwd
+from time import time
+import active_learning
 from read_terminal import ReadTerminal
-from remote_command import RemoteCommand, CommandThread
+from capture_log import CaptureLog, CAPTURE_NAME
+from remote_command import RemoteCommand
+from acquisition import AcquisitionEngine, get_store_writer, write_sample
+from sample_store import SampleStore, STORE_NAME, sample_name
+from run_manifest import RunManifest, plan_shots
+from online_model import OnlineModel
+from sample_features import load_features
+from shot_scheduler import SCHEDULERS, get_scheduler
+import timing
 
 parser = argparse.ArgumentParser()
 
@@ -45,8 +53,55 @@ parser.add_argument('-s', '--samples', default=50, type=int,
                     help='The number os samples at each duty cycle. Defaults to 50.')
 parser.add_argument('--random', default=1, type=int,
                     help='Whether to collect samples randomly. Defaults to true.')
+parser.add_argument('--binary', default=0, type=int,
+                    help='Whether to ask the light meter for compact binary frames. Defaults to false.')
+parser.add_argument('--store', default=0, type=int,
+                    help=''.join(['Whether to append samples to a single ', STORE_NAME, ' file instead of writing',
+                                  ' a JSON file per sample. Defaults to false.']))
+parser.add_argument('--timeout', default=10.0, type=float,
+                    help='Seconds to wait for the light meter after firing before skipping the sample.'
+                         ' Defaults to 10.')
+parser.add_argument('--schedule', default='ready', choices=SCHEDULERS,
+                    help='How to pace the shots: ready waits for the meter, firmware and laser cooldown; fixed'
+                         ' waits --delay seconds. Defaults to ready.')
+parser.add_argument('--delay', default=2.0, type=float,
+                    help='Seconds to wait between samples with --schedule fixed. Defaults to 2.')
+parser.add_argument('--cooldown', default=0.0, type=float,
+                    help="The laser's minimum seconds between firings with --schedule ready. Defaults to 0.")
+parser.add_argument('--quiet', default=0.05, type=float,
+                    help='Seconds the tty must be quiet before the next shot with --schedule ready.'
+                         ' Defaults to 0.05.')
+parser.add_argument('--pair', default=[], action='append',
+                    help='An additional light meter tty and laser host to collect from concurrently, as TTY,HOST'
+                         ' or TTY,HOST,COOLDOWN. May be repeated. Each pair gets its own run directory.')
+parser.add_argument('--resume', default=[], action='append',
+                    help='The model ID of an interrupted run to finish instead of starting a new one; one per tty'
+                         ' and host pair, in order. Collected samples are kept and only failed or deleted ones'
+                         ' are fired again.')
+parser.add_argument('--capture', default=0, type=int,
+                    help=''.join(['Whether to log the raw tty byte stream to ', CAPTURE_NAME, ' in the run directory',
+                                  ' for replay_capture.py. Defaults to false.']))
+parser.add_argument('--adaptive', default=0, type=int,
+                    help='Whether to collect in rounds, retraining the classifier after each and aiming the next'
+                         ' round at the duty cycles it confuses most, until --target is reached. --samples then'
+                         ' caps the samples per duty cycle. Defaults to false.')
+parser.add_argument('--target', default=0.95, type=float,
+                    help='The cross validated accuracy ending an adaptive run. Defaults to 0.95.')
+parser.add_argument('--initial', default=5, type=int,
+                    help='The samples of each duty cycle in the first round of an adaptive run. Defaults to 5.')
+parser.add_argument('--batch', default=60, type=int,
+                    help='The shots in each later round of an adaptive run. Defaults to 60.')
+parser.add_argument('--online', default=0, type=int,
+                    help='Whether to train the model while collecting, refitting it every --refresh samples, and'
+                         ' save it when collection ends. Defaults to false.')
+parser.add_argument('--refresh', default=20, type=int,
+                    help='The new samples that trigger a refit of the --online model. Defaults to 20.')
+parser.add_argument('--timing', default=None,
+                    help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
 
 args = parser.parse_args()
+if args.timing is not None:
+    timing.configure(args.timing)
 
 
 def get_config_by_duty(duty):
@@ -64,33 +119,223 @@ driver = ''.join([driver_home, 'cups_driver'])
 json_dir = ''.join([' -j ', driver_home, 'CNC/Configs/'])
 fire_time = ' --fire-laser "0.0150"'
 
-tty = ReadTerminal(regex=args.regex, tty=args.tty, baud=args.baud, su_pass=args.su_password)
-rcmd = RemoteCommand(host=args.host, user=args.user, password=args.password)
-
+pairs = [(args.tty, args.host, args.cooldown)]
+for pair in args.pair:
+    fields = pair.split(',')
+    try:
+        if len(fields) not in (2, 3):
+            raise ValueError(pair)
+        pairs.append((fields[0], fields[1], float(fields[2]) if len(fields) == 3 else args.cooldown))
+    except ValueError:
+        print('Error: --pair must be given as TTY,HOST or TTY,HOST,COOLDOWN.', file=sys.stderr, flush=True)
+        exit(1)
 
-def get_file_names(duty_min, duty_max, samples, random=1):
-    """ Return and array of duty, folder, and filename.
 
-        The array will be of size ((duty_max - duty_min) * samples).
-        Shuffle option supports random data collection.
-    """
+def get_file_names(data_dir, plan):
+    """ Return and array of duty, folder, and filename for each planned (duty, serial) shot. """
     file_names = []
-    model_id = repr(floor(time()))
-    data_dir = path.join(args.data_dir, model_id)
-    output = JSONEncoder().encode({'model_id': model_id, 'data_dir': data_dir})
-    print(output, sep='', flush=True)
-    mkdir(data_dir, mode=0o744)
-    for duty, serial in product(range(duty_min, duty_max + 1), range(samples + 1)):
+    for duty, serial in plan:
         folder = ''.join([data_dir, path.sep, str(duty), '_duty'])
         file_names.append([duty, folder, ''.join(['serial', '{:02d}'.format(serial), '.json'])])
-    if random is 1:
-        seed()
-        shuffle(file_names)
     return file_names
 
-samples = get_file_names(args.min, args.max, args.samples, random=args.random)
-no_samples = 1
-end = len(samples)
+
+def new_manifest(model_id, settings):
+    """ Create a run directory and its manifest with a newly shuffled plan. An adaptive run plans its first round.
+
+    :param model_id: The first model ID to try. It is bumped by one while a run directory of that ID exists, e.g.
+        one made by another collector started in the same second.
+    """
+    while True:
+        data_dir = path.join(args.data_dir, repr(model_id))
+        try:
+            mkdir(data_dir, mode=0o744)
+            break
+        except FileExistsError:
+            model_id += 1
+    samples = args.initial - 1 if args.adaptive == 1 else args.samples
+    plan, plan_seed = plan_shots(args.min, args.max, samples, random=args.random)
+    return RunManifest.create(data_dir, plan, plan_seed, settings)
+
+
+def load_manifest(model_id):
+    """ Load the manifest of an interrupted run. """
+    try:
+        return RunManifest.load(path.join(args.data_dir, model_id))
+    except ValueError as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+
+def get_validator(data_dir, store):
+    """ Return a function telling whether a sample logged as collected is still present and readable. """
+    if store == 1:
+        index = SampleStore(path.join(data_dir, STORE_NAME)).index()
+        return lambda duty, serial: (duty, serial) in index
+
+    def valid(duty, serial):
+        filename = path.join(data_dir, sample_name(duty, serial))
+        try:
+            with open(filename) as f:
+                return 'values' in json.load(f)
+        except (OSError, ValueError):
+            return False
+    return valid
+
+
+def get_shot_logger(manifest, locations):
+    """ Return a function appending each finished shot to the run's manifest log. """
+    def log_shot(shot):
+        duty, serial = locations[shot.target]
+        manifest.record(duty, serial, shot.status, exit_status=shot.exit_status, elapsed=shot.elapsed)
+    return log_shot
+
+
+def get_shots(run, samples):
+    """ Return the engine's (target, command) shots for [duty, folder, filename] samples, noting where each goes. """
+    shots = []
+    for duty, folder, filename in samples:
+        command = ''.join([driver, json_dir, get_config_by_duty(duty), fire_time])
+        target = ''.join([folder, '/', filename])
+        run['locations'][target] = (duty, int(filename[len('serial'):-len('.json')]))
+        shots.append((target, command))
+    return shots
+
+
+def next_round(run):
+    """ Retrain on the samples collected so far and return the next round of an adaptive run, or [] when done. """
+    manifest = run['manifest']
+    settings = manifest.settings
+    duties = list(range(settings['min'], settings['max'] + 1))
+    room = active_learning.get_room(manifest.plan, duties, settings['samples'] + 1)
+    y = []
+    try:
+        X, y = load_features(run['data_dir']) if run['model'] is None else run['model'].snapshot()
+        assessment = active_learning.assess(X, y, duties)
+        weights = active_learning.get_weights(assessment)
+    except ValueError as e:
+        # Too few samples to judge the classifier yet, or a sample that can not be featurized; spread the round
+        # evenly rather than stopping every pair's collection.
+        print(e, file=sys.stderr, flush=True)
+        assessment = {'samples': len(y), 'accuracy': None}
+        weights = {duty: 1.0 for duty in duties}
+    done = assessment['accuracy'] is not None and assessment['accuracy'] >= settings['target']
+    allocation = {} if done else active_learning.allocate(weights, room, settings['batch'])
+    plan = active_learning.plan_round(manifest.plan, allocation, random=settings['random'],
+                                      seed=manifest.seed + len(manifest.plan))
+    active_learning.record_round(run['data_dir'], dict(assessment, allocation=allocation))
+    accuracy = 'no' if assessment['accuracy'] is None else '{:.3f}'.format(assessment['accuracy'])
+    message = ''.join(['Cross validated accuracy ', accuracy, ' with ', repr(assessment['samples']), ' samples. ',
+                       'Target reached.' if done else 'Sample limit reached.' if len(plan) == 0
+                       else ''.join(['Next round: ', repr(len(plan)), ' shots.'])])
+    print(message if len(runs) == 1 else ' '.join([message, run['host']]), flush=True)
+    return plan
+
+
+def get_online_writer(persist, model, locations):
+    """ Return a function persisting validated samples and adding them to a run's online model. """
+    def persist_and_learn(target, frame):
+        persist(target, frame)
+        model.add(locations[target][0], frame)
+    return persist_and_learn
+
+
+def get_model_printer(host):
+    """ Return a function printing the running accuracy of an online model after each refit. """
+    def print_model(status):
+        accuracy = status['cross-validation-accuracy']
+        message = ''.join(['Online model: ', 'no' if accuracy is None else '{:.3f}'.format(accuracy),
+                           ' cross validated accuracy with ', repr(status['fitted']), ' samples.'])
+        print(message if len(runs) == 1 else ' '.join([message, host]), flush=True)
+    return print_model
+
+
+async def collect_run(run, persist, progress, done):
+    """ Collect a run's planned shots, then for an adaptive run keep planning rounds until it is done. """
+    await run['engine'].collect(get_shots(run, run['samples']), persist, progress=progress, done=done)
+    if run['manifest'].settings.get('adaptive', 0) != 1:
+        return
+    loop = asyncio.get_event_loop()
+    while True:
+        # Retraining runs off the event loop so the other pairs keep firing.
+        plan = await loop.run_in_executor(None, next_round, run)
+        if len(plan) == 0:
+            return
+        run['manifest'].extend(plan)
+        # The engine only paces the shots within a round; rest the laser before the next one.
+        await asyncio.sleep(args.delay if args.schedule == 'fixed' else run['cooldown'])
+        await run['engine'].collect(get_shots(run, get_file_names(run['data_dir'], plan)), persist,
+                                    progress=progress, done=done)
+
+
+def get_budget(run):
+    """ Return the most shots a run can still fire. """
+    settings = run['manifest'].settings
+    if settings.get('adaptive', 0) != 1:
+        return len(run['samples'])
+    room = active_learning.get_room(run['manifest'].plan, range(settings['min'], settings['max'] + 1),
+                                    settings['samples'] + 1)
+    return len(run['samples']) + sum(room.values())
+
+if len(args.resume) > 0 and len(args.resume) != len(pairs):
+    print('Error: give one --resume model ID per tty and host pair.', file=sys.stderr, flush=True)
+    exit(1)
+if args.adaptive == 1 and (args.samples > 99 or args.initial < 1 or args.initial > args.samples + 1):
+    print('Error: an adaptive run needs 1 <= --initial <= --samples + 1 and --samples below 100.',
+          file=sys.stderr, flush=True)
+    exit(1)
+
+runs = []
+next_id = floor(time())
+for number, (tty_path, host, cooldown) in enumerate(pairs):
+    if len(args.resume) > 0:
+        model_id = args.resume[number]
+        manifest = load_manifest(model_id)
+        store = manifest.settings.get('store', args.store)
+        plan = manifest.remaining(get_validator(manifest.directory, store))
+    else:
+        # Model IDs are timestamps; concurrent runs take the next free second to keep them unique.
+        store = args.store
+        manifest = new_manifest(next_id, {'min': args.min, 'max': args.max, 'samples': args.samples,
+                                           'random': args.random, 'store': store, 'binary': args.binary,
+                                           'tty': tty_path, 'host': host, 'adaptive': args.adaptive,
+                                           'target': args.target, 'initial': args.initial, 'batch': args.batch})
+        plan = manifest.plan
+        model_id = path.basename(manifest.directory)
+        next_id = int(model_id) + 1
+    runs.append({'model_id': model_id,
+                 'data_dir': manifest.directory,
+                 'manifest': manifest,
+                 'store': store,
+                 'tty': ReadTerminal(regex=args.regex, tty=tty_path, baud=args.baud, su_pass=args.su_password,
+                                     binary=args.binary == 1,
+                                     capture=CaptureLog(path.join(manifest.directory, CAPTURE_NAME))
+                                     if args.capture == 1 else None),
+                 'rcmd': RemoteCommand(host=host, user=args.user, password=args.password),
+                 'host': host,
+                 'cooldown': cooldown,
+                 'samples': get_file_names(manifest.directory, plan),
+                 'locations': {},
+                 'model': OnlineModel(refresh=args.refresh, progress=get_model_printer(host))
+                 if args.online == 1 else None})
+    if runs[-1]['model'] is not None and len(args.resume) > 0:
+        try:
+            runs[-1]['model'].add_features(*load_features(manifest.directory))
+        except ValueError as e:
+            # The model starts from the samples collected from here on.
+            print('Online model could not load the samples collected so far.', e, file=sys.stderr, flush=True)
+
+if len(runs) == 1:
+    output = {'model_id': runs[0]['model_id'], 'data_dir': runs[0]['data_dir']}
+else:
+    output = {'model_id': runs[0]['model_id'], 'data_dir': runs[0]['data_dir'],
+              'runs': [{'model_id': run['model_id'], 'data_dir': run['data_dir'], 'tty': run['tty'].tty,
+                        'host': run['host']} for run in runs]}
+end = sum([get_budget(run) for run in runs])
+if len(args.resume) > 0:
+    output['remaining'] = end
+print(JSONEncoder().encode(output), sep='', flush=True)
+no_samples = 0
 
 
 def status_update(filename, no_samples, end):
@@ -106,53 +351,42 @@ print('┌───────────────────────
 print('│ Begin Data Collection │')
 print('└───────────────────────┘\n', flush=True)
 
-json_regex = r"^[\s\S]{1,6}(\{[\s\S]*)$"
-tty.open()
-for duty, folder, filename in samples:
-    if not path.isdir(folder):
-        mkdir(folder, mode=0o744)
-    target = ''.join([folder, '/', filename])
-    print(status_update(target, no_samples, end), flush=True)
-    f = open(target, 'w')
-    result = ''
-    json_file = get_config_by_duty(duty)
-    command = ''.join([driver, json_dir, json_file, fire_time])
-    thread = CommandThread(1, rcmd, command, lambda *args: None).start()
-    while True:
-        if tty.in_waiting() > 0:
-            line = tty.read()
-            result += line
-            if tty.regex.match(line):
-                break
-    try:
-        # Verify the result.
-        result = result.strip()
-        JSONDecoder().decode(result)
-        # Write the result into the file.
-        f.write(result)
-        f.close()
-    except JSONDecodeError as e:
-        json_data = re.search(json_regex, result, re.MULTILINE)
-        if json_data:
-            try:
-                data = json_data.group().strip()
-                JSONDecoder().decode(data)
-                # Write the result into the file.
-                f.write(data)
-                f.close()
-            except JSONDecodeError as e:
-                print('Unrecoverable', e.msg, 'in', target, data, file=sys.stderr, flush=True)
-                f.close()
-                unlink(target)
-        else:
-            print('Unrecoverable', e.msg, 'in', target, result, file=sys.stderr, flush=True)
-            f.close()
-            unlink(target)
-
-    # tty.close()
-    del thread
-    no_samples += 1
-    sleep(2)
-
-tty.close()
 
+def get_status_printer(host):
+    """ Return a progress function printing one status line per sample across all runs. """
+    def print_status(number, target):
+        global no_samples
+        no_samples += 1
+        message = status_update(target, no_samples, end)
+        print(message if len(runs) == 1 else ' '.join([message, host]), flush=True)
+    return print_status
+
+
+collections = []
+for run in runs:
+    if run['store'] == 1:
+        persist = get_store_writer(SampleStore(path.join(run['data_dir'], STORE_NAME)), run['locations'])
+    else:
+        persist = write_sample
+    if run['model'] is not None:
+        persist = get_online_writer(persist, run['model'], run['locations'])
+    run['tty'].open()
+    scheduler = get_scheduler(args.schedule, delay=args.delay, cooldown=run['cooldown'], quiet=args.quiet)
+    run['engine'] = AcquisitionEngine(run['tty'], run['rcmd'], timeout=args.timeout, scheduler=scheduler)
+    collections.append(collect_run(run, persist, get_status_printer(run['host']),
+                                   get_shot_logger(run['manifest'], run['locations'])))
+
+# One event loop drives every meter and laser pair concurrently.
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+loop.run_until_complete(asyncio.gather(*collections))
+loop.close()
+for run in runs:
+    run['engine'].close()
+    run['tty'].close()
+for run in runs:
+    if run['model'] is not None:
+        try:
+            print(JSONEncoder().encode(run['model'].finish(run['data_dir'])), flush=True)
+        except ValueError as e:
+            print(e, file=sys.stderr, flush=True)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Compile a trained run's KNN model into a lookup table model, saved beside it as knn_lut. """
+
+import argparse
+import sys
+from json import JSONEncoder
+from os import getcwd
+from artifact_lib import CODECS, DEFAULT_CODEC
+from lut_model import compile_model
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-d', '--directory', default=getcwd(),
+                    help='Path to a trained run. Defaults to current directory.')
+parser.add_argument('--codec', default=DEFAULT_CODEC, choices=sorted(CODECS),
+                    help=''.join(['Compression of the saved table. Defaults to ', DEFAULT_CODEC, '.']))
+parser.add_argument('--margin', default=0.5, type=float,
+                    help='How far past the largest training feature the grid extends, as a fraction of it.'
+                         ' Defaults to 0.5.')
+args = parser.parse_args()
+
+try:
+    output = compile_model(args.directory, codec=args.codec, margin=args.margin)
+except ValueError as e:
+    print(e, file=sys.stderr, flush=True)
+    exit(1)
+
+print(JSONEncoder().encode(output), flush=True)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Rewrite the model, sample and prediction artifacts of existing runs with another codec. """
+
+import argparse
+import re
+import sys
+from json import JSONEncoder
+from os import path, getcwd, remove, walk
+import numpy as np
+from artifact_lib import ARRAY_EXTENSION, CODECS, artifact_file, artifact_files, artifact_name, dump_artifact, \
+    load_artifact
+
+ARTIFACTS = re.compile(r'^(knn_model|knn_lut|poly2d|predict_proba_\d+_data_by_\d+_model)$')
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('codec', choices=sorted(CODECS), help='The codec to rewrite the artifacts with.')
+parser.add_argument('-d', '--directory', default=getcwd(),
+                    help='A run directory, or a base directory of runs. Defaults to current directory.')
+parser.add_argument('--remove', default=0, type=int,
+                    help='Whether to delete the other copies of each artifact once converted. Defaults to false.')
+args = parser.parse_args()
+
+if not path.isdir(args.directory):
+    print('Error:', args.directory, 'is not a valid directory.', file=sys.stderr, flush=True)
+    exit(1)
+
+converted = []
+for directory, sub_dirs, files in walk(args.directory):
+    names = set()
+    for file in files:
+        artifact = artifact_name(path.join(directory, file))
+        if artifact is not None and ARTIFACTS.match(artifact[1]):
+            names.add(artifact[1])
+    for name in sorted(names):
+        copies = artifact_files(directory, name)
+        filename = copies[0]
+        output = artifact_file(directory, name, args.codec, filename.endswith(ARRAY_EXTENSION))
+        if output != filename:
+            try:
+                value = load_artifact(filename, mmap=False)
+            except (KeyError, ValueError, EOFError) as e:
+                print('Error:', filename, 'is not a valid artifact.', e, file=sys.stderr, flush=True)
+                continue
+            if name == 'poly2d':
+                # Older runs keep the samples as lists; arrays can be memory-mapped when uncompressed.
+                value.data = np.asarray(value.data)
+                value.target = np.asarray(value.target)
+            output = dump_artifact(value, directory, name, args.codec)
+            converted.append({'from': filename, 'to': output, 'from-size': path.getsize(filename),
+                              'to-size': path.getsize(output)})
+        if args.remove == 1:
+            for copy in copies:
+                if copy != output:
+                    remove(copy)
+
+print(JSONEncoder().encode({'codec': args.codec, 'directory': args.directory, 'converted': converted}), flush=True)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Pack a run's ??_duty/serial??.json files into a sample store or unpack a store into files. """
+
+import argparse
+import sys
+from json import JSONEncoder
+from os import path, getcwd
+from sample_store import SampleStore, STORE_NAME
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('action', choices=['import', 'export'],
+                    help='import packs the JSON files into the store; export writes the store out as JSON files.')
+parser.add_argument('-d', '--directory', default=getcwd(),
+                    help='Path to the run directory. Defaults to current directory.')
+parser.add_argument('-s', '--store', default=None,
+                    help=''.join(['Path to the sample store. Defaults to ', STORE_NAME, ' in the run directory.']))
+args = parser.parse_args()
+
+store_file = args.store if args.store is not None else path.join(args.directory, STORE_NAME)
+if args.action == 'export' and not path.isfile(store_file):
+    print('Error:', store_file, 'is not a valid file.', file=sys.stderr, flush=True)
+    exit(1)
+
+try:
+    store = SampleStore(store_file)
+except ValueError as e:
+    print('Error:', e, file=sys.stderr, flush=True)
+    exit(1)
+
+if args.action == 'import':
+    count = store.import_directory(args.directory)
+else:
+    count = store.export_directory(args.directory)
+
+print(JSONEncoder().encode({'action': args.action, 'samples': count, 'store': store_file,
+                            'directory': args.directory}), flush=True)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" A pseudo-terminal light meter and laser host for exercising the acquisition path without hardware.
+
+FakeMeter writes frames in the ATmega32U4 sketch's JSON text or binary format to a pty, and honours the
+sketch's 'B' and 'J' commands. FakeLaserHost takes the place of a RemoteCommand: firing the laser makes
+the meter capture a frame at the duty cycle named in the command's config file.
+
+Run as a script it prints the pty path and emits a frame every --interval seconds.
+"""
+
+import argparse
+import os
+import pty
+import queue
+import random
+import re
+import select
+import sys
+import termios
+import threading
+import time
+import tty as terminal
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pipe, Process
+from time import monotonic
+import numpy as np
+from read_terminal import Frame, FRAME_HEADER, FRAME_MAGIC
+from remote_command import CommandResult
+
+PWM_PERIOD_MS = 1.5
+SAMPLE_RATE_KHZ = 76.9231
+SAMPLE_SIZE = 951
+""" The sketch prints blank lines ahead of each JSON frame. """
+TEXT_PREAMBLE = b'    \n    \n\n'
+DUTY_PATTERN = re.compile(r'0?(\d{2})_test\.json')
+
+
+def synthesize(duty, rng, noise=0.01, sample_rate_khz=SAMPLE_RATE_KHZ, ring_size=1000):
+    """ Returns the raw ring of a capture of a PWM modulated laser: the 0xFF marker then the readings.
+
+    :param duty: The duty cycle in percent.
+    :param rng: A numpy random Generator.
+    :param noise: Standard deviation of the reading noise as a fraction of full scale.
+    """
+    period = sample_rate_khz * PWM_PERIOD_MS
+    t = np.arange(ring_size - 1) + rng.uniform(0, period)
+    on = (t % period) < duty / 100 * period
+    values = np.where(on, 0.02, 0.8) + rng.normal(0, noise, ring_size - 1)
+    raw = np.clip(np.rint(values * 255), 0, 255).astype(np.uint8)
+    return np.concatenate([[0xFF], raw]).astype(np.uint8)
+
+
+def get_meta(sample_rate_khz=SAMPLE_RATE_KHZ, ring_size=1000, meter_id=1):
+    """ Returns the frame metadata the sketch reports alongside the readings. """
+    return {'sample_size': SAMPLE_SIZE,
+            'ring_size': ring_size,
+            'start_sample': ring_size - SAMPLE_SIZE,
+            'sample_rate_khz': sample_rate_khz,
+            'sample_duration_ms': round(SAMPLE_SIZE / sample_rate_khz, 4),
+            'meter_id': meter_id}
+
+
+def encode_frame(raw, meta, binary=False):
+    """ Returns a frame as the sketch writes it to the tty. """
+    if binary:
+        header = FRAME_HEADER.pack(FRAME_MAGIC, len(raw), meta['ring_size'], meta['sample_size'],
+                                   meta['start_sample'], meta['sample_rate_khz'], meta['sample_duration_ms'],
+                                   meta['meter_id'])
+        return b''.join([header, raw.tobytes(), bytes([int(raw.sum()) & 0xFF])])
+    return b''.join([TEXT_PREAMBLE, Frame(raw, meta).to_json().encode(), b'\n'])
+
+
+class FakeMeter:
+    """ A light meter on the slave side of a pseudo-terminal. """
+    def __init__(self, noise=0.01, garbage=0.0, truncate=0.0, rate=0, meter_id=1, seed=None):
+        """
+        :param noise: Standard deviation of the reading noise as a fraction of full scale.
+        :param garbage: Probability of writing line noise ahead of a frame.
+        :param truncate: Probability of cutting a frame short.
+        :param rate: Bytes per second the tty is paced to. Unpaced when 0.
+        :param meter_id: The meter ID reported in each frame.
+        :param seed: Seed for the readings, noise and faults.
+        """
+        self.noise = noise
+        self.garbage = garbage
+        self.truncate = truncate
+        self.rate = rate
+        self.meta = get_meta(meter_id=meter_id)
+        self.rng = np.random.default_rng(seed)
+        self.binary = False
+        self.frames = 0
+        self.master, self.slave = pty.openpty()
+        terminal.setraw(self.slave, termios.TCSANOW)
+        self.tty = os.ttyname(self.slave)
+        self.triggers = queue.Queue()
+        self.wake_read, self.wake_write = os.pipe()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def trigger(self, duty):
+        """ Start a capture, as the laser does when it strikes the photodiode. """
+        self.triggers.put((monotonic() + self.meta['sample_duration_ms'] / 1000, duty))
+        os.write(self.wake_write, b'.')
+
+    def serve(self):
+        """ The meter thread; reads commands from the host and writes frames when captures complete. """
+        pending = []
+        while not self.closed.is_set():
+            timeout = None if len(pending) == 0 else max(0.0, pending[0][0] - monotonic())
+            readable, writable, failed = select.select([self.master, self.wake_read], [], [], timeout)
+            if self.master in readable:
+                try:
+                    commands = os.read(self.master, 1024)
+                except OSError:
+                    return
+                for command in commands:
+                    if command in b'BJ':
+                        self.binary = command == ord('B')
+            if self.wake_read in readable:
+                os.read(self.wake_read, 1024)
+                while not self.triggers.empty():
+                    pending.append(self.triggers.get())
+                pending.sort()
+            while len(pending) > 0 and pending[0][0] <= monotonic():
+                due, duty = pending.pop(0)
+                self.emit(duty)
+
+    def emit(self, duty):
+        """ Write one frame, with any injected faults. """
+        data = encode_frame(synthesize(duty, self.rng, self.noise), self.meta, self.binary)
+        if self.rng.random() < self.garbage:
+            # Noise free of '{' and the binary magic, like the partial lines seen when a meter is plugged in.
+            noise = self.rng.integers(0x20, 0x7B, int(self.rng.integers(1, 64)), dtype=np.uint8).tobytes()
+            data = b''.join([noise, data])
+        if self.rng.random() < self.truncate:
+            data = data[:int(self.rng.integers(1, len(data)))]
+        self.write(data)
+        self.frames += 1
+
+    def write(self, data):
+        chunk = len(data) if self.rate <= 0 else max(1, self.rate // 100)
+        for start in range(0, len(data), chunk):
+            piece = memoryview(data)[start:start + chunk]
+            if self.rate > 0:
+                time.sleep(len(piece) / self.rate)
+            while len(piece) > 0:
+                try:
+                    piece = piece[os.write(self.master, piece):]
+                except OSError:
+                    return
+
+    def close(self):
+        self.closed.set()
+        os.write(self.wake_write, b'.')
+        self.thread.join()
+        for fd in (self.master, self.slave, self.wake_read, self.wake_write):
+            os.close(fd)
+
+
+def serve_meter(connection, settings):
+    """ Run a FakeMeter in a child process, triggered over a multiprocessing connection. """
+    meter = FakeMeter(**settings)
+    connection.send(meter.tty)
+    while True:
+        duty = connection.recv()
+        if duty is None:
+            break
+        meter.trigger(duty)
+    meter.close()
+    connection.send(meter.frames)
+
+
+class MeterProcess:
+    """ A FakeMeter in its own process, so it does not share a CPU budget or the GIL with the collector. """
+    def __init__(self, **settings):
+        """
+        :param settings: FakeMeter keyword arguments.
+        """
+        self.connection, child = Pipe()
+        self.lock = threading.Lock()
+        self.process = Process(target=serve_meter, args=(child, settings), daemon=True)
+        self.process.start()
+        self.tty = self.connection.recv()
+        self.frames = 0
+
+    def trigger(self, duty):
+        with self.lock:
+            self.connection.send(duty)
+
+    def close(self):
+        with self.lock:
+            self.connection.send(None)
+            self.frames = self.connection.recv()
+        self.process.join()
+
+
+class FakeLaserHost:
+    """ Stands in for a laser host's RemoteCommand; firing triggers a fake meter after a network latency. """
+    def __init__(self, meter, latency=0.05, fail=0.0, seed=None):
+        """
+        :param meter: A FakeMeter or MeterProcess.
+        :param latency: Seconds a firing command takes. The meter is triggered half way through.
+        :param fail: Probability of a firing command exiting with status 1 without firing.
+        :param seed: Seed for the failures.
+        """
+        self.meter = meter
+        self.latency = latency
+        self.fail = fail
+        self.random = random.Random(seed)
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def execute(self, command, timeout=None):
+        start = monotonic()
+        if self.random.random() < self.fail:
+            time.sleep(self.latency)
+            return CommandResult(command, 1, b'', b'Simulated firing failure.', monotonic() - start)
+        match = DUTY_PATTERN.search(command)
+        time.sleep(self.latency / 2)
+        self.meter.trigger(int(match.group(1)) if match else 50)
+        time.sleep(self.latency / 2)
+        return CommandResult(command, 0, b'', b'', monotonic() - start)
+
+    def fire(self, command, timeout=None):
+        """ Run command in the background. Returns a Future of its CommandResult. """
+        return self.executor.submit(self.execute, command, timeout)
+
+    def run(self, command, timeout=None):
+        return self.fire(command, timeout).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--duty', default=50, type=int,
+                        help='The duty cycle of the emitted frames. Defaults to 50.')
+    parser.add_argument('--interval', default=1.0, type=float,
+                        help='Seconds between frames. Defaults to 1.')
+    parser.add_argument('--noise', default=0.01, type=float,
+                        help='Standard deviation of the reading noise. Defaults to 0.01.')
+    parser.add_argument('--garbage', default=0.0, type=float,
+                        help='Probability of line noise ahead of a frame. Defaults to 0.')
+    parser.add_argument('--truncate', default=0.0, type=float,
+                        help='Probability of a truncated frame. Defaults to 0.')
+    parser.add_argument('--rate', default=0, type=int,
+                        help='Bytes per second the tty is paced to. Defaults to 0, unpaced.')
+    args = parser.parse_args()
+
+    meter = FakeMeter(noise=args.noise, garbage=args.garbage, truncate=args.truncate, rate=args.rate)
+    print(meter.tty, flush=True)
+    try:
+        while True:
+            meter.trigger(args.duty)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        meter.close()
+        print(meter.frames, 'frames written.', file=sys.stderr, flush=True)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+""" A persistent cache of extracted histogram features so retraining only processes new samples. """
+
+import hashlib
+import inspect
+import json
+import zlib
+from os import path, replace, stat
+import numpy as np
+import pwm_wave_lib as pwlib
+
+CACHE_NAME = 'features.cache.npz'
+
+
+def feature_version(**settings):
+    """ Returns a digest of the feature extraction code and settings.
+
+        Editing get_minima or the histogram functions, or changing a setting, changes the digest and so
+        invalidates every cached feature.
+    """
+    digest = hashlib.sha1()
+    for function in (pwlib.get_minima, pwlib.get_minima_batch, pwlib.get_histogram_features):
+        digest.update(inspect.getsource(function).encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def file_stamp(filename):
+    """ Returns the (size, mtime) stamp of a sample file. """
+    status = stat(filename)
+    return status.st_size, status.st_mtime_ns
+
+
+def record_stamp(records, row):
+    """ Returns the (row, checksum) stamp of a sample store record. """
+    return row, zlib.crc32(records[row].tobytes())
+
+
+class FeatureCache:
+    """ Histogram features keyed by sample identity and a (size, mtime) style stamp. """
+    def __init__(self, filename, version):
+        """
+        :param filename: Path to the cache file. It is written by save().
+        :param version: The feature_version() the cached features must have been computed with.
+        """
+        self.filename = filename
+        self.version = version
+        self.entries = {}
+        if path.isfile(filename):
+            try:
+                with np.load(filename) as cache:
+                    if str(cache['version']) == version:
+                        for key, stamp, features in zip(cache['keys'], cache['stamps'], cache['features']):
+                            self.entries[str(key)] = (tuple(stamp.tolist()), features)
+            except (OSError, KeyError, ValueError):
+                self.entries = {}
+
+    def has(self, key, stamp):
+        """ Whether the features of the sample are cached and still current. """
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] == tuple(stamp)
+
+    def complete(self, keys, stamps, computed):
+        """ Returns the features of every sample and remembers the newly computed ones.
+
+        :param keys: The identity of each sample, in order.
+        :param stamps: The stamp of each sample, in order.
+        :param computed: Features for the samples has() reported missing, in the same order.
+        """
+        computed = iter(computed)
+        features = []
+        for key, stamp in zip(keys, stamps):
+            stamp = tuple(stamp)
+            if self.has(key, stamp):
+                features.append(self.entries[key][1])
+            else:
+                row = next(computed)
+                self.entries[key] = (stamp, row)
+                features.append(row)
+        return np.asarray(features, dtype=np.int64)
+
+    def save(self, keys):
+        """ Write the cache, keeping only the entries of the given samples. """
+        keys = [key for key in keys if key in self.entries]
+        temp = ''.join([self.filename, '.tmp'])
+        with open(temp, 'wb') as f:
+            np.savez(f, version=np.asarray(self.version),
+                     keys=np.asarray(keys, dtype=str),
+                     stamps=np.asarray([self.entries[key][0] for key in keys], dtype=np.int64).reshape(len(keys), 2),
+                     features=np.asarray([self.entries[key][1] for key in keys], dtype=np.int64))
+        replace(temp, self.filename)
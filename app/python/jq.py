@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 """ Execute JQ commands on remote hosts. """
 
-from remote_command import RemoteCommand, CommandThread
+from remote_command import RemoteCommand
 import argparse
+import sys
 
 parser = argparse.ArgumentParser()
 
@@ -18,14 +19,16 @@ parser.add_argument('files', help='The files to filter; e.g. "file1 file2 ..."')
 args = parser.parse_args()
 
 
-def print_result(stdin, stdout, stderr):
+def print_result(result):
     """ Print the results on stdout. """
-    data = stdout.read().splitlines()
+    data = result.stdout.splitlines()
     for line in data:
         print(line.decode("utf-8"))
     print(flush=True)
+    if not result.ok:
+        print(result.stderr.decode("utf-8"), file=sys.stderr, flush=True)
 
 command = ''.join(['jq ', "'", args.filter, "' ", args.files])
 rcmd = RemoteCommand(host=args.host, user=args.user, password=args.password)
 
-thread = CommandThread(1, rcmd, command, print_result).start()
+print_result(rcmd.run(command))
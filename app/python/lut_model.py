@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+""" Compile a trained KNN model into a lookup table over the integer histogram feature grid.
+
+The two features are bin counts, so every sample falls on a small grid of integer cells. The KNN is
+evaluated once per cell; predict and predict_proba then index the table instead of searching for
+neighbours. Cells share rows of a table of distinct (probabilities, class) results, which keeps the model
+small. Samples outside the grid are passed to the KNN, so results are always identical to the KNN's.
+"""
+
+import time
+import numpy as np
+from artifact_lib import DEFAULT_CODEC, dump_artifact, find_artifact, load_artifact
+
+LUT_NAME = 'knn_lut'
+CHUNK_SIZE = 65536
+""" The grid grows geometrically with the number of features; tables are only compiled for the default two. """
+LUT_FEATURES = 2
+
+
+class LookupTableClassifier:
+    """ A KNeighborsClassifier evaluated over every cell of a bounded integer feature grid. """
+    def __init__(self, knn, X, margin=0.5):
+        """
+        :param knn: The fitted KNeighborsClassifier.
+        :param X: The training features; they bound the grid.
+        :param margin: How far past the largest training feature the grid extends, as a fraction of it.
+        :raises ValueError: When X does not have LUT_FEATURES features.
+        """
+        if np.asarray(X).shape[1] != LUT_FEATURES:
+            raise ValueError(''.join(['Error: a lookup table needs ', str(LUT_FEATURES), ' features, i.e. ',
+                                      str(LUT_FEATURES + 1), ' histogram bins.']))
+        self.knn = knn
+        self.classes_ = knn.classes_
+        self.shape = tuple(int(np.ceil(upper * (1 + margin))) + 1 for upper in np.asarray(X).max(axis=0))
+        cells = np.empty(int(np.prod(self.shape)), dtype=np.uint32)
+        rows = {}
+        table = []
+        for start in range(0, len(cells), CHUNK_SIZE):
+            grid = np.column_stack(np.unravel_index(np.arange(start, min(start + CHUNK_SIZE, len(cells))),
+                                                    self.shape))
+            labels = np.searchsorted(self.classes_, knn.predict(grid))
+            results, inverse = np.unique(np.column_stack([knn.predict_proba(grid), labels]), axis=0,
+                                         return_inverse=True)
+            ids = np.empty(len(results), dtype=np.uint32)
+            for number, result in enumerate(results):
+                key = result.tobytes()
+                if key not in rows:
+                    rows[key] = len(table)
+                    table.append(result)
+                ids[number] = rows[key]
+            cells[start:start + len(grid)] = ids[inverse.reshape(-1)]
+        table = np.asarray(table)
+        self.cells = cells.reshape(self.shape)
+        self.proba_table = table[:, :-1]
+        self.label_table = table[:, -1].astype(np.intp)
+
+    def _lookup(self, X):
+        """ Returns the table row of each sample, or -1 for samples off the grid. """
+        X = np.asarray(X)
+        cells = np.rint(X).astype(np.intp)
+        inside = np.all((cells >= 0) & (cells < self.shape) & (cells == X), axis=1)
+        rows = np.full(len(X), -1, dtype=np.intp)
+        rows[inside] = self.cells[tuple(cells[inside].T)]
+        return rows
+
+    def predict_proba(self, X):
+        """ Return probability estimates for the test data, as KNeighborsClassifier.predict_proba. """
+        rows = self._lookup(X)
+        outside = rows < 0
+        proba = self.proba_table[np.where(outside, 0, rows)]
+        if outside.any():
+            proba[outside] = self.knn.predict_proba(np.asarray(X)[outside])
+        return proba
+
+    def predict(self, X):
+        """ Predict the class labels for the provided data, as KNeighborsClassifier.predict. """
+        rows = self._lookup(X)
+        outside = rows < 0
+        labels = self.classes_[self.label_table[np.where(outside, 0, rows)]]
+        if outside.any():
+            labels[outside] = self.knn.predict(np.asarray(X)[outside])
+        return labels
+
+    def score(self, X, y):
+        """ Returns the mean accuracy on the given test data and labels. """
+        return np.mean(self.predict(X) == np.asarray(y))
+
+
+def check_table(lut, knn, X, model_file):
+    """ Raises ValueError unless the table predicts X exactly as the model does. """
+    if not (np.array_equal(lut.predict(X), knn.predict(X)) and
+            np.array_equal(lut.predict_proba(X), knn.predict_proba(X))):
+        raise ValueError(' '.join(['Error: the lookup table for', model_file, 'does not match the model.']))
+
+
+def compile_model(directory, codec=DEFAULT_CODEC, margin=0.5):
+    """ Compile the run's knn_model into a knn_lut artifact. Returns the result dictionary.
+
+    :raises ValueError: When the run has no model or samples, or the table disagrees with the model.
+    """
+    model_file = find_artifact(directory, 'knn_model')
+    sample_file = find_artifact(directory, 'poly2d')
+    if model_file is None or sample_file is None:
+        raise ValueError(' '.join(['Error:', directory, 'has no trained model.']))
+    knn = load_artifact(model_file, mmap=False)
+    X = np.asarray(load_artifact(sample_file, mmap=False).data)
+    start = time.perf_counter()
+    lut = LookupTableClassifier(knn, X, margin=margin)
+    compile_time = time.perf_counter() - start
+    check_table(lut, knn, X, model_file)
+    lut_file = dump_artifact(lut, directory, LUT_NAME, codec)
+    return {'model': model_file,
+            'lut': lut_file,
+            'grid': list(lut.shape),
+            'distinct-results': len(lut.proba_table),
+            'compile-seconds': compile_time}
+
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+""" A KNN model kept current with a collection run while its samples are being collected.
+
+The collector hands each validated frame to add() from its writer thread. The frame's histogram features are
+appended to an in-memory feature matrix, and a background thread refits the KNN and its cross validation
+scores every refresh samples. When collection ends, finish() saves the samples and model the way
+train_model.py does, so the run can be predicted with straight away without ingesting its files again.
+"""
+
+import sys
+import threading
+import numpy as np
+import pwm_wave_lib as pwlib
+import timing
+from artifact_lib import DEFAULT_CODEC
+from pwm_wave_lib import FEATURE_SETTINGS
+from sklearn.neighbors import KNeighborsClassifier
+from train_model import cross_validate, save_model
+
+
+class OnlineModel:
+    """ The features, target and latest fit of one collection run. """
+    def __init__(self, neighbors=5, folds=5, settings=FEATURE_SETTINGS, refresh=20, progress=None):
+        """
+        :param neighbors: The number of neighbors the classifier votes with.
+        :param folds: The number of cross validation folds.
+        :param settings: Histogram settings passed to pwm_wave_lib.get_histogram_features.
+        :param refresh: The number of new samples that trigger a refit.
+        :param progress: Optional function of (status) called after each refit, on the background thread.
+        """
+        self.neighbors = neighbors
+        self.folds = folds
+        self.settings = settings
+        self.refresh = refresh
+        self.progress = progress
+        self.features = []
+        self.target = []
+        self.knn = None
+        self.X = None
+        self.y = None
+        self.scores = None
+        self.error = None
+        self.fitted = 0
+        self.closing = False
+        self.changed = threading.Condition()
+        self.fitting = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add_features(self, X, y):
+        """ Add the features and duty cycles of samples collected earlier, e.g. before a run was resumed. """
+        with self.changed:
+            self.features.extend(np.asarray(X, dtype=np.int64).reshape(len(y), self.settings['bins'] - 1))
+            self.target.extend(int(duty) for duty in y)
+            self.changed.notify()
+
+    def add(self, duty, frame):
+        """ Featurize a validated frame, or decoded sample, and add it to the feature matrix.
+
+            A sample that can not be featurized is left out of the model; it has already been saved.
+        """
+        try:
+            with timing.span('features.histogram', samples=1):
+                row = pwlib.get_histogram_features(*pwlib.stack_samples([frame]), **self.settings)[0]
+        except ValueError as e:
+            print('Online model skipped a', duty, 'duty sample.', e, file=sys.stderr, flush=True)
+            return
+        with self.changed:
+            self.features.append(row)
+            self.target.append(duty)
+            if len(self.target) - self.fitted >= self.refresh:
+                self.changed.notify()
+
+    def snapshot(self):
+        """ Returns copies of the feature matrix and target collected so far. """
+        with self.changed:
+            X = np.array(self.features, dtype=np.int64).reshape(len(self.target), self.settings['bins'] - 1)
+            return X, np.array(self.target)
+
+    def refit(self):
+        """ Fit the KNN and its cross validation scores on every sample added so far. """
+        with self.fitting:
+            X, y = self.snapshot()
+            if len(y) == 0 or len(y) == self.fitted:
+                return
+            knn = KNeighborsClassifier(n_neighbors=self.neighbors, n_jobs=-1)
+            with timing.span('model.fit', samples=len(X)):
+                knn.fit(X, y)
+            try:
+                scores = cross_validate(knn, X, y, folds=self.folds)
+                error = None
+            except ValueError as e:
+                # Too few samples of some duty cycle yet; the fit is still usable.
+                scores = None
+                error = str(e)
+            with self.changed:
+                self.knn, self.scores, self.error, self.fitted = knn, scores, error, len(y)
+                self.X, self.y = X, y
+        if self.progress is not None:
+            self.progress(self.status())
+
+    def status(self):
+        """ Returns the running accuracy estimate of the latest fit. """
+        with self.changed:
+            return {
+                'samples': len(self.target),
+                'fitted': self.fitted,
+                'cross-validation-accuracy': None if self.scores is None else self.scores.mean(),
+                'cross-validation-error': None if self.scores is None else self.scores.std()}
+
+    def run(self):
+        """ The background thread; refits whenever refresh samples have been added since the last fit. """
+        while True:
+            with self.changed:
+                while not self.closing and len(self.target) - self.fitted < self.refresh:
+                    self.changed.wait()
+                if self.closing:
+                    return
+            self.refit()
+
+    def finish(self, directory, codec=DEFAULT_CODEC, lut=False):
+        """ Stop refitting, fit any samples added since the last refit, save the model and return its results.
+
+        :param directory: The collection run directory.
+        :param codec: The artifact_lib codec the samples and model are saved with.
+        :param lut: Whether to also compile the model into a lookup table model for fast prediction.
+        :raises ValueError: When there are no samples or the model can not be cross validated.
+        """
+        with self.changed:
+            self.closing = True
+            self.changed.notify()
+        self.thread.join()
+        self.refit()
+        if self.knn is None:
+            raise ValueError('Data array collection error: no data found.')
+        if self.scores is None:
+            raise ValueError(self.error)
+        return save_model(directory, self.knn, self.X, self.y, self.scores, folds=self.folds, codec=codec, lut=lut,
+                          settings=self.settings)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """ Detect duty cycle values in sample data using a model previously trained on the same laser. """
 
-from os import path, getcwd, listdir
+from os import path, getcwd, replace
 from platform import node
 from json import JSONEncoder
 import time
@@ -10,158 +10,328 @@ import sys
 import argparse
 from datetime import datetime
 from math import floor, pow
+import subprocess
 import numpy as np
-from sklearn.externals import joblib
-from scipy import stats
-import re
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
-
-
-parser = argparse.ArgumentParser()
-
-parser.add_argument('model_id', help='Model ID number for the model.')
-parser.add_argument('sample_id', help='Model ID number for the sample.')
-parser.add_argument('operator_id', help='Operator ID number for the person running the prediction.')
-parser.add_argument('-d', '--directory', default=getcwd(),
-                    help="Base directory for the models. Defaults to current directory.")
-parser.add_argument('--host', default=node(),
-                    help="The local hostname. Defaults to the local hostname.")
-args = parser.parse_args()
-
-""" Retrieve the stored model and sample data. """
-model_file = path.join(args.directory, args.model_id, 'knn_model.pkl.xz')
-sample_file = path.join(args.directory, args.sample_id, 'poly2d.pkl.xz')
-
-for file in [model_file, sample_file]:
-    if not path.isfile(file):
-        print('Error:', file, 'is not a valid file.', file=sys.stderr, flush=True)
-        exit(1)
+from numpy.lib.format import dtype_to_descr, write_array_header_1_0
+from artifact_lib import CODECS, DEFAULT_CODEC, artifact_file, dump_artifact, find_artifact, load_artifact
+import timing
+from lut_model import LUT_NAME
+from run_manifest import RunManifest
+from pwm_wave_lib import FEATURE_SETTINGS
+
+CHARTS = ['inline', 'background', 'none']
+
+""" Samples scored per pass in streaming mode. """
+CHUNK_SIZE = 65536
+
+
+def get_model(directory, model_id, loader=load_artifact, lut=True):
+    """ Retrieve a stored model. Returns the model and the feature settings of its training samples.
+
+    :param loader: The function loading an artifact file; the worker passes a caching loader.
+    :param lut: Whether to use the model's lookup table when it was compiled from the current model.
+    :raises ValueError: When the model is missing or invalid.
+    """
+    model_file = find_artifact(path.join(directory, model_id), 'knn_model')
+    if model_file is None:
+        raise ValueError(' '.join(['Error:', artifact_file(path.join(directory, model_id), 'knn_model'),
+                                   'is not a valid file.']))
+    if lut:
+        lut_file = find_artifact(path.join(directory, model_id), LUT_NAME)
+        # A table older than the model was compiled from a previous training and would give stale results.
+        if lut_file is not None and path.getmtime(lut_file) >= path.getmtime(model_file):
+            model_file = lut_file
+
+    try:
+        with timing.span('artifact.load', sample=model_file):
+            knn = loader(model_file)
+    except KeyError as e:
+        raise ValueError(' '.join(['Error:', model_file, 'is not a valid model.']))
+
+    settings = None
+    training_file = find_artifact(path.join(directory, model_id), 'poly2d')
+    if training_file is not None:
+        with timing.span('artifact.load', sample=training_file):
+            settings = getattr(loader(training_file), 'settings', FEATURE_SETTINGS)
+    return knn, settings
+
+
+def get_samples(directory, sample_id, loader=load_artifact):
+    """ Retrieve stored sample data. Returns X, y and the feature settings the samples were made with.
+
+    :param loader: The function loading an artifact file; the worker passes a caching loader.
+    :raises ValueError: When the samples are missing or invalid.
+    """
+    sample_file = find_artifact(path.join(directory, sample_id), 'poly2d')
+    if sample_file is None:
+        raise ValueError(' '.join(['Error:', artifact_file(path.join(directory, sample_id), 'poly2d'),
+                                   'is not a valid file.']))
+    try:
+        with timing.span('artifact.load', sample=sample_file):
+            samples = loader(sample_file)
+        X = np.asarray(samples.data)
+        y = np.asarray(samples.target)
+    except KeyError as e:
+        raise ValueError(' '.join(['Error:', sample_file, 'is not a valid sample.']))
+    return X, y, getattr(samples, 'settings', FEATURE_SETTINGS)
+
+
+def check_settings(model_id, sample_id, model_settings, sample_settings):
+    """ Runs featurized with other settings, e.g. by sweep_model.py, can not be scored by each other's models.
+
+    :param model_settings: The feature settings of the model's training samples, or None when unknown.
+    :raises ValueError: When the settings differ.
+    """
+    if model_settings is not None and model_settings != sample_settings:
+        raise ValueError(' '.join(['Error: sample', sample_id, 'was featurized with different settings than the',
+                                   model_id, 'model. Retrain it with the same settings.']))
+
+
+def get_artifacts(directory, model_id, sample_id, loader=load_artifact, lut=True):
+    """ Retrieve the stored model and sample data. Returns the model, X and y.
+
+    :param loader: The function loading an artifact file; the worker passes a caching loader.
+    :param lut: Whether to use the model's lookup table when it was compiled from the current model.
+    :raises ValueError: When an artifact is missing or invalid.
+    """
+    knn, model_settings = get_model(directory, model_id, loader=loader, lut=lut)
+    X, y, sample_settings = get_samples(directory, sample_id, loader=loader)
+    check_settings(model_id, sample_id, model_settings, sample_settings)
+    return knn, X, y
+
+
+def get_file_name(directory, model_id, sample_id, prefix, extension):
+    """ Returns the path of a prediction artifact stored with the model. """
+    return ''.join([
+        directory, path.sep,
+        model_id, path.sep,
+        get_artifact_name(model_id, sample_id, prefix),
+        extension])
+
+
+def get_artifact_name(model_id, sample_id, prefix):
+    """ Returns the name of a prediction artifact without its extension. """
+    return ''.join([prefix, sample_id, '_data_by_', model_id, '_model'])
+
+
+def get_title(model_id, sample_id):
+    """ Returns the chart title. """
+    return ' '.join([
+        datetime.fromtimestamp(int(sample_id)).strftime('%Y-%m-%d %H:%M %p'),
+        'data by',
+        datetime.fromtimestamp(int(model_id)).strftime('%Y-%m-%d %H:%M %p'),
+        'model.'])
+
+
+def get_range(directory, model_id, loader=load_artifact):
+    """ Returns the duty cycles the model scores, the columns of its prediction probabilities.
+
+        They are the labels of the model's training samples, or the duty range in its run manifest. Runs
+        collected into a sample store have no duty folders to list.
+
+    :param loader: The function loading an artifact file; the worker passes a caching loader.
+    :raises ValueError: When the model run has neither.
+    """
+    training_file = find_artifact(path.join(directory, model_id), 'poly2d')
+    if training_file is not None:
+        with timing.span('artifact.load', sample=training_file):
+            return np.unique(np.asarray(loader(training_file).target)).tolist()
+    settings = RunManifest.load(path.join(directory, model_id)).settings
+    return list(range(settings['min'], settings['max'] + 1))
+
+
+def get_statistics(predict_proba):
+    """ Returns the mean, standard deviation, SEM, variance and histogram bin count of the summed probabilities. """
+    return get_sum_statistics(predict_proba.sum(axis=0))
 
-try:
-    knn = joblib.load(model_file)
-except KeyError as e:
-    print('Error:', model_file, 'is not a valid model.', file=sys.stderr, flush=True)
-    exit(1)
-
-try:
-    samples = joblib.load(sample_file)
-    X = np.asarray(samples.data)
-    y = np.asarray(samples.target)
-except KeyError as e:
-    print('Error:', sample_file, 'is not a valid sample.', file=sys.stderr, flush=True)
-    exit(1)
-
-predict = knn.predict(X)              # Predict the class labels for the provided data.
-predict_proba = knn.predict_proba(X)  # Return probability estimates for the test data.
-score = knn.score(X, y)               # Returns the mean accuracy on the given test data and labels.
-
-predict_proba_file = ''.join([
-    args.directory, path.sep,
-    args.model_id, path.sep,
-    'predict_proba_',
-    args.sample_id,
-    '_data_by_',
-    args.model_id,
-    '_model.pkl.xz'])
-joblib.dump(predict_proba, predict_proba_file)
-
-""" Chart probability distribution. """
-title = ' '.join([
-    datetime.fromtimestamp(int(args.sample_id)).strftime('%Y-%m-%d %H:%M %p'),
-    'data by',
-    datetime.fromtimestamp(int(args.model_id)).strftime('%Y-%m-%d %H:%M %p'),
-    'model.'])
-
-
-def get_range(directory):
-    """ Determine the range for the samples by inspecting the samples directory. """
-    regex = '[\d]{2}_duty'
-    sub_dirs = sorted([f for f in listdir(directory) if path.isdir(path.join(directory, f)) and re.match(regex, f)])
-    min_range = sub_dirs[0].split('_')[0]
-    max_range = sub_dirs[len(sub_dirs) - 1].split('_')[0]
-    return range(int(min_range), int(max_range) + 1)
-
-
-series = list(get_range(path.join(args.directory, args.sample_id)))
-values = np.sum(predict_proba, axis=0)
-plt.plot(series, values, label='Probability')
-plt.title('Probability Distribution')
-z = np.polyfit(series, values, 1)
-p = np.poly1d(z)
-coef = z.tolist()
-plt.plot(series, p(series), label='\n'.join(map(repr, coef)))
-plt.ylabel('Sum')
-plt.xlabel('\n'.join(['Category', title]))
-plt.axis([20, 80, 20, 80])
-plt.legend(loc='upper right')
-prob_dist_file = ''.join([
-    args.directory, path.sep,
-    args.model_id, path.sep,
-    'prob_dist_',
-    args.sample_id,
-    '_data_by_',
-    args.model_id,
-    '_model.svg'])
-plt.tight_layout()
-plt.savefig(prob_dist_file, papertype='letter', orientation='landscape')
-
-""" Chart mean variance histogram. """
-hist, axh = plt.subplots()
-hist.subplots_adjust(bottom=0.2)
-a = predict_proba.sum(axis=0)
-var = np.var(a, axis=0)
-mu = a.mean(axis=0)    # mean of distribution
-sigma = a.std(axis=0)  # standard deviation of distribution
-sem = stats.sem(a, axis=None, ddof=0)
-# the histogram of the data
-n, bins, patches = axh.hist(a, bins='auto', normed=1)
-no_bins = len(bins)
-# add a 'best fit' line
-y = mlab.normpdf(bins, mu, sigma)
-axh.plot(bins, y, '--', color='orange', label='Sigma')
-# add sem line
-r = mlab.normpdf(bins, mu, sem)
-axh.plot(bins, r, '--', color='red', label='SEM')
-axh.set_xlabel('\n'.join(['Variation about the Mean', title]))
-axh.set_ylabel('Probability Density')
-axh.set_title(r'Histogram: $\mu=$%0.2f, $\sigma=$%0.2f, bins=%2u, sem=%0.2f, var=%0.2f'
-              % (mu, sigma, no_bins, sem, var))
-plt.legend(loc='upper right')
-hist_file = ''.join([
-    args.directory, path.sep,
-    args.model_id, path.sep,
-    'mean_variance_',
-    args.sample_id,
-    '_data_by_',
-    args.model_id,
-    '_model.svg'])
-plt.savefig(hist_file, papertype='letter', orientation='landscape')
-
-
-sum_sq = 0
-for guess, target in zip(predict, y):
-    sum_sq += pow(guess - target, 2)
-
-std_err_estimate = sum_sq / len(X)
-
-output = JSONEncoder().encode({
-    'sample-model-id': args.sample_id,
-    'knn-model-id': args.model_id,
-    'operator-id': args.operator_id,
-    'host-name': args.host.split('.')[0],
-    'date': floor(time.time()),
-    'error-proba-mean': mu,
-    'error-proba-std-dev': sigma,
-    'error-proba-std-err-mean': sem,
-    'error-proba-variance': var,
-    'error-proba-bins': no_bins,
-    'predict-proba': predict_proba_file,
-    'prediction-score': score,
-    'std-err-estimate': std_err_estimate,
-    'proba-dist-chart': prob_dist_file,
-    'mean-variance-chart': hist_file})
-
-print()
-print(output, flush=True)
 
+def get_sum_statistics(a):
+    """ Returns the statistics of get_statistics from the column sums of the prediction probabilities. """
+    var = np.var(a, axis=0)
+    mu = a.mean(axis=0)    # mean of distribution
+    sigma = a.std(axis=0)  # standard deviation of distribution
+    sem = sigma / np.sqrt(a.size)
+    no_bins = len(np.histogram_bin_edges(a, bins='auto'))
+    return mu, sigma, sem, var, no_bins
+
+
+def render_charts_later(directory, model_id, sample_id):
+    """ Render the charts in a detached process so the result is not held up by matplotlib. """
+    script = path.join(path.dirname(path.abspath(__file__)), 'prediction_charts.py')
+    subprocess.Popen([sys.executable, script, model_id, sample_id, '-d', directory],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, start_new_session=True)
+
+
+def save_predict_proba(directory, model_id, sample_id, predict_proba, codec=DEFAULT_CODEC):
+    """ Save the prediction probabilities with the model for the charts. Returns the artifact file. """
+    with timing.span('artifact.dump', sample=sample_id, artifact='predict_proba', codec=codec) as dump:
+        predict_proba_file = dump_artifact(predict_proba, path.join(directory, model_id),
+                                           get_artifact_name(model_id, sample_id, 'predict_proba_'), codec)
+        dump.bytes = path.getsize(predict_proba_file)
+    return predict_proba_file
+
+
+def get_result(model_id, sample_id, operator_id, directory, host, column_sums, score, std_err_estimate,
+               predict_proba_file):
+    """ Returns the result dictionary of a prediction.
+
+    :param column_sums: The column sums of the prediction probabilities.
+    :param score: The mean accuracy of the predictions.
+    :param std_err_estimate: The mean squared error of the predicted duty cycles.
+    """
+    mu, sigma, sem, var, no_bins = get_sum_statistics(column_sums)
+    prob_dist_file = get_file_name(directory, model_id, sample_id, 'prob_dist_', '.svg')
+    hist_file = get_file_name(directory, model_id, sample_id, 'mean_variance_', '.svg')
+
+    return {
+        'sample-model-id': sample_id,
+        'knn-model-id': model_id,
+        'operator-id': operator_id,
+        'host-name': host.split('.')[0],
+        'date': floor(time.time()),
+        'error-proba-mean': mu,
+        'error-proba-std-dev': sigma,
+        'error-proba-std-err-mean': sem,
+        'error-proba-variance': var,
+        'error-proba-bins': no_bins,
+        'predict-proba': predict_proba_file,
+        'prediction-score': score,
+        'std-err-estimate': std_err_estimate,
+        'proba-dist-chart': prob_dist_file,
+        'mean-variance-chart': hist_file}
+
+
+def get_std_err_estimate(predict, y):
+    """ Returns the mean squared error of the predicted duty cycles. """
+    sum_sq = 0
+    for guess, target in zip(predict, y):
+        sum_sq += pow(guess - target, 2)
+    return sum_sq / len(y)
+
+
+def predict_streaming(knn, X, y, filename, chunk=CHUNK_SIZE, sample=None):
+    """ Score the samples chunk by chunk, appending the prediction probabilities to a .npy file as they are made.
+
+        Only one chunk of probabilities is held in memory; the file can be memory-mapped by load_artifact
+        afterwards. Returns their column sums, the mean accuracy and the mean squared error of the predicted
+        duty cycles.
+
+    :param filename: The .npy file to write. It is replaced only once every chunk has been written.
+    :param chunk: Samples scored per pass.
+    :param sample: The sample ID recorded in timing events.
+    """
+    temp = ''.join([filename, '.tmp'])
+    column_sums = np.zeros(len(knn.classes_))
+    correct = 0
+    sum_sq = 0
+    with open(temp, 'wb') as f:
+        write_array_header_1_0(f, {'descr': dtype_to_descr(np.dtype(np.float64)), 'fortran_order': False,
+                                   'shape': (len(X), len(knn.classes_))})
+        for start in range(0, len(X), chunk):
+            rows = slice(start, start + chunk)
+            with timing.span('model.predict_proba', sample=sample, samples=len(X[rows]), chunk=start // chunk):
+                proba = knn.predict_proba(X[rows])
+            # The class with the highest probability, as KNeighborsClassifier.predict chooses it.
+            guess = knn.classes_[proba.argmax(axis=1)]
+            column_sums += proba.sum(axis=0)
+            correct += np.count_nonzero(guess == y[rows])
+            sum_sq += np.sum((guess - y[rows]) ** 2)
+            f.write(np.ascontiguousarray(proba, dtype=np.float64).tobytes())
+    replace(temp, filename)
+    return column_sums, correct / len(y), sum_sq / len(y)
+
+
+def predict(model_id, sample_id, operator_id, directory=getcwd(), host=node(), loader=load_artifact,
+            codec=DEFAULT_CODEC, charts='inline', lut=True, chunk=0):
+    """ Score the sample data with the model, chart the results and return the result dictionary.
+
+    :param model_id: Model ID number for the model.
+    :param sample_id: Model ID number for the sample.
+    :param operator_id: Operator ID number for the person running the prediction.
+    :param directory: Base directory for the models.
+    :param host: The local hostname.
+    :param loader: The function loading an artifact file.
+    :param codec: The artifact_lib codec the prediction probabilities are saved with.
+    :param charts: One of CHARTS. inline renders the charts before returning, background leaves them to a
+        detached prediction_charts.py process and none leaves them to be rendered on demand.
+    :param lut: Whether to predict with the model's lookup table when there is a current one.
+    :param chunk: Score this many samples at a time with predict_streaming, saving the probabilities as an
+        uncompressed .npy file whatever the codec. 0 scores every sample at once.
+    :raises ValueError: When an artifact is missing or invalid.
+    """
+    knn, X, y = get_artifacts(directory, model_id, sample_id, loader=loader, lut=lut)
+
+    if chunk > 0:
+        predict_proba_file = artifact_file(path.join(directory, model_id),
+                                           get_artifact_name(model_id, sample_id, 'predict_proba_'), 'none', True)
+        column_sums, score, std_err_estimate = predict_streaming(knn, X, y, predict_proba_file, chunk=chunk,
+                                                                 sample=sample_id)
+        if charts == 'inline':
+            with timing.span('charts.render', sample=sample_id):
+                from prediction_charts import render_charts
+                render_charts(directory, model_id, sample_id, series=knn.classes_.tolist())
+        elif charts == 'background':
+            render_charts_later(directory, model_id, sample_id)
+        return get_result(model_id, sample_id, operator_id, directory, host, column_sums, score, std_err_estimate,
+                          predict_proba_file)
+
+    with timing.span('model.predict', sample=sample_id, samples=len(X)):
+        predict = knn.predict(X)              # Predict the class labels for the provided data.
+    with timing.span('model.predict_proba', sample=sample_id, samples=len(X)):
+        predict_proba = knn.predict_proba(X)  # Return probability estimates for the test data.
+    with timing.span('model.score', sample=sample_id, samples=len(X)):
+        score = knn.score(X, y)               # Returns the mean accuracy on the given test data and labels.
+
+    predict_proba_file = save_predict_proba(directory, model_id, sample_id, predict_proba, codec)
+
+    if charts == 'inline':
+        # Imported here so the other modes never load matplotlib.
+        with timing.span('charts.render', sample=sample_id):
+            from prediction_charts import render_charts
+            render_charts(directory, model_id, sample_id, predict_proba, knn.classes_.tolist())
+    elif charts == 'background':
+        render_charts_later(directory, model_id, sample_id)
+
+    return get_result(model_id, sample_id, operator_id, directory, host, predict_proba.sum(axis=0), score,
+                      get_std_err_estimate(predict, y), predict_proba_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('model_id', help='Model ID number for the model.')
+    parser.add_argument('sample_id', help='Model ID number for the sample.')
+    parser.add_argument('operator_id', help='Operator ID number for the person running the prediction.')
+    parser.add_argument('-d', '--directory', default=getcwd(),
+                        help="Base directory for the models. Defaults to current directory.")
+    parser.add_argument('--host', default=node(),
+                        help="The local hostname. Defaults to the local hostname.")
+    parser.add_argument('--codec', default=DEFAULT_CODEC, choices=sorted(CODECS),
+                        help=''.join(['Compression of the saved prediction probabilities. Defaults to ',
+                                      DEFAULT_CODEC, '.']))
+    parser.add_argument('--charts', default='inline', choices=CHARTS,
+                        help=''.join(['When to render the charts: before printing the result, in a background',
+                                      ' process after it, or not at all. Defaults to inline.']))
+    parser.add_argument('--no-charts', dest='charts', action='store_const', const='none',
+                        help='Print the result without rendering the charts. Same as --charts none.')
+    parser.add_argument('--lut', default=1, type=int,
+                        help='Whether to predict with the lookup table compiled by train_model.py --lut when it'
+                             ' is current. Defaults to true.')
+    parser.add_argument('--chunk', default=0, type=int,
+                        help='Score this many samples at a time, writing the prediction probabilities to an'
+                             ' uncompressed .npy file so memory use stays flat. Defaults to 0, all at once.')
+    parser.add_argument('--timing', default=None,
+                        help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+    args = parser.parse_args()
+    if args.timing is not None:
+        timing.configure(args.timing)
+
+    try:
+        output = predict(args.model_id, args.sample_id, args.operator_id, directory=args.directory, host=args.host,
+                         codec=args.codec, charts=args.charts, lut=args.lut == 1, chunk=args.chunk)
+    except ValueError as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+    print()
+    print(JSONEncoder().encode(output), flush=True)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Render the probability distribution and mean variance charts of a prediction.
+
+prediction.py runs this in the background, or leaves it to be run when the charts are opened, so the
+prediction result does not wait on matplotlib.
+"""
+
+import argparse
+import sys
+from json import JSONEncoder
+from os import path, getcwd
+import numpy as np
+import matplotlib.mlab as mlab
+import matplotlib.pyplot as plt
+from artifact_lib import find_artifact, load_artifact
+from prediction import get_artifact_name, get_file_name, get_range, get_statistics, get_title
+
+
+def chart_probability_distribution(predict_proba, series, title, prob_dist_file):
+    """ Chart probability distribution. """
+    values = np.sum(predict_proba, axis=0)
+    plt.plot(series, values, label='Probability')
+    plt.title('Probability Distribution')
+    z = np.polyfit(series, values, 1)
+    p = np.poly1d(z)
+    coef = z.tolist()
+    plt.plot(series, p(series), label='\n'.join(map(repr, coef)))
+    plt.ylabel('Sum')
+    plt.xlabel('\n'.join(['Category', title]))
+    plt.axis([20, 80, 20, 80])
+    plt.legend(loc='upper right')
+    plt.tight_layout()
+    plt.savefig(prob_dist_file, papertype='letter', orientation='landscape')
+
+
+def chart_mean_variance(predict_proba, title, hist_file):
+    """ Chart mean variance histogram. """
+    hist, axh = plt.subplots()
+    hist.subplots_adjust(bottom=0.2)
+    a = predict_proba.sum(axis=0)
+    mu, sigma, sem, var, no_bins = get_statistics(predict_proba)
+    # the histogram of the data
+    n, bins, patches = axh.hist(a, bins='auto', normed=1)
+    # add a 'best fit' line
+    y = mlab.normpdf(bins, mu, sigma)
+    axh.plot(bins, y, '--', color='orange', label='Sigma')
+    # add sem line
+    r = mlab.normpdf(bins, mu, sem)
+    axh.plot(bins, r, '--', color='red', label='SEM')
+    axh.set_xlabel('\n'.join(['Variation about the Mean', title]))
+    axh.set_ylabel('Probability Density')
+    axh.set_title(r'Histogram: $\mu=$%0.2f, $\sigma=$%0.2f, bins=%2u, sem=%0.2f, var=%0.2f'
+                  % (mu, sigma, no_bins, sem, var))
+    plt.legend(loc='upper right')
+    plt.savefig(hist_file, papertype='letter', orientation='landscape')
+    plt.close('all')
+
+
+def render_charts(directory, model_id, sample_id, predict_proba=None, series=None):
+    """ Render both charts and return their paths.
+
+    :param predict_proba: The prediction probabilities. Loaded from the saved artifact when omitted.
+    :param series: The duty cycles of the model's classes. Read from the model run when omitted.
+    :raises ValueError: When the prediction probabilities have not been saved or the duty cycles are unknown.
+    """
+    if predict_proba is None:
+        predict_proba_file = find_artifact(path.join(directory, model_id),
+                                           get_artifact_name(model_id, sample_id, 'predict_proba_'))
+        if predict_proba_file is None:
+            raise ValueError(' '.join(['Error: no prediction of', sample_id, 'data by', model_id, 'model.']))
+        predict_proba = np.asarray(load_artifact(predict_proba_file))
+    title = get_title(model_id, sample_id)
+    if series is None:
+        series = get_range(directory, model_id)
+    prob_dist_file = get_file_name(directory, model_id, sample_id, 'prob_dist_', '.svg')
+    chart_probability_distribution(predict_proba, series, title, prob_dist_file)
+    hist_file = get_file_name(directory, model_id, sample_id, 'mean_variance_', '.svg')
+    chart_mean_variance(predict_proba, title, hist_file)
+    return prob_dist_file, hist_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('model_id', help='Model ID number for the model.')
+    parser.add_argument('sample_id', help='Model ID number for the sample.')
+    parser.add_argument('-d', '--directory', default=getcwd(),
+                        help="Base directory for the models. Defaults to current directory.")
+    args = parser.parse_args()
+
+    try:
+        prob_dist_file, hist_file = render_charts(args.directory, args.model_id, args.sample_id)
+    except ValueError as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+    print(JSONEncoder().encode({'proba-dist-chart': prob_dist_file, 'mean-variance-chart': hist_file}), flush=True)
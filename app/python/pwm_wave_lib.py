@@ -2,6 +2,11 @@
 """ A function library for massaging ADC data generated by PWM. """
 import numpy as np
 
+""" The default histogram feature settings, get_histogram_features' bins and window and get_minima_batch's start
+    and sample_size. Kept here so that predicting needs no tty or sample store imports.
+"""
+FEATURE_SETTINGS = {'bins': 3, 'window': 0.05, 'start': 45, 'sample_size': 8}
+
 
 def get_minima(a):
     """ Returns the indexes of the first and last minimum values in an array. """
@@ -22,3 +27,112 @@ def get_voltage(f):
 def get_firing_time(pwm_period=0.0015, sample_size=7):
     """ Returns laser firing time. """
     return sample_size * pwm_period
+
+
+def get_minima_batch(sample_rate_khz, ring_size, start=45, pwm_period=0.0015, sample_size=8):
+    """ Returns arrays of the first and last indexes of the get_minima window for many samples. """
+    wave_length = np.round(np.asarray(sample_rate_khz, dtype=np.float64) * np.asarray(ring_size) * pwm_period)
+    sample_length = np.round(sample_size * wave_length)
+    first = np.full(wave_length.shape, start, dtype=np.intp)
+    return first, (first + sample_length).astype(np.intp)
+
+
+def stack_samples(samples):
+    """ Stack decoded samples into the arguments of get_histogram_features.
+
+        Returns a (n_samples x longest) values matrix, the sample_rate_khz and ring_size of each sample,
+        and the number of values in each row.
+    """
+    counts = np.asarray([len(s['values']) for s in samples], dtype=np.intp)
+    values = np.zeros((len(samples), counts.max() if len(samples) > 0 else 0))
+    for row, s in enumerate(samples):
+        values[row, :counts[row]] = s['values']
+    sample_rate_khz = np.asarray([s['sample_rate_khz'] for s in samples], dtype=np.float64)
+    ring_size = np.asarray([s['ring_size'] for s in samples], dtype=np.intp)
+    return values, sample_rate_khz, ring_size, counts
+
+
+def get_histogram_features(values, sample_rate_khz, ring_size, counts=None, bins=3, window=0.05, chunk=4096,
+                           **minima):
+    """ Returns the low voltage histogram features of many samples at once.
+
+        Row for row the result equals the first bins - 1 counts of
+        np.histogram(round(values[get_minima]), bins=bins, range=(min, min + window)).
+
+    :param values: A (n_samples x ring_size) array of readings.
+    :param sample_rate_khz: The sample rate of each row.
+    :param ring_size: The ring size of each row.
+    :param counts: The number of valid readings in each row. Defaults to every column.
+    :param chunk: Rows processed per pass; bounds the size of the temporary arrays.
+    :param minima: Window settings passed on to get_minima_batch.
+    """
+    values = np.asarray(values)
+    n_samples, width = values.shape
+    first, last = get_minima_batch(sample_rate_khz, ring_size, **minima)
+    if counts is not None:
+        last = np.minimum(last, counts)
+    features = np.empty((n_samples, bins - 1), dtype=np.int64)
+    columns = np.arange(width)
+    for begin in range(0, n_samples, chunk):
+        rows = slice(begin, begin + chunk)
+        volts = np.round(values[rows], 4)
+        inside = (columns >= first[rows, None]) & (columns < last[rows, None])
+        if not inside.any(axis=1).all():
+            raise ValueError('A sample has no readings in its get_minima window.')
+        low = np.where(inside, volts, np.inf).min(axis=1)
+        edges = np.linspace(low, low + window, bins + 1, axis=1)
+        for b in range(bins - 1):
+            features[rows, b] = (inside & (volts >= edges[:, b, None]) & (volts < edges[:, b + 1, None])).sum(axis=1)
+    return features
+
+
+def estimate_duty(values, counts=None, start=0, band=0.02, spread=6, debounce=3, chunk=4096):
+    """ Measures the duty cycle of many samples at once from the waveform itself, without a trained model.
+
+        While the laser is on it holds the meter at its floor voltage. Readings less than band, or spread times
+        the reading noise, above the floor count as on. A falling edge is an on reading after debounce readings
+        that are not. The duty cycle is the share of on readings from the first falling edge to the last, which
+        spans a whole number of PWM periods.
+
+        Returns the duty cycle in percent and the PWM period in readings of each row; NaN for rows with fewer
+        than two falling edges.
+
+    :param values: A (n_samples x ring_size) array of readings.
+    :param counts: The number of valid readings in each row. Defaults to every column.
+    :param start: The first reading to consider.
+    :param band: The smallest on threshold above the floor, in ADC native units (1/255 is one step).
+    :param spread: The on threshold above the floor in multiples of the noise, when that is more than band.
+    :param debounce: Readings that must be off before a falling edge; keeps noise from adding edges.
+    :param chunk: Rows processed per pass; bounds the size of the temporary arrays.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_samples, width = values.shape
+    counts = np.full(n_samples, width) if counts is None else np.asarray(counts)
+    duty = np.full(n_samples, np.nan)
+    period = np.full(n_samples, np.nan)
+    columns = np.arange(width)
+    for begin in range(0, n_samples, chunk):
+        rows = slice(begin, begin + chunk)
+        inside = (columns >= start) & (columns < counts[rows, None])
+        readings = np.where(inside, values[rows], np.nan)
+        floor = np.nanpercentile(readings, 2, axis=1)
+        # The median step between neighbouring readings estimates the noise; edges are too rare to move it.
+        noise = np.nanmedian(np.abs(np.diff(readings, axis=1)), axis=1) / (0.6745 * np.sqrt(2))
+        on = inside & (readings < (floor + np.maximum(band, spread * noise))[:, None])
+        # Off readings before each column, so off_before[:, i] - off_before[:, i - debounce] counts a run.
+        off_before = np.zeros((len(on), width + 1), dtype=np.intp)
+        np.cumsum(inside & ~on, axis=1, out=off_before[:, 1:])
+        edges = np.zeros(on.shape, dtype=bool)
+        edges[:, debounce:] = on[:, debounce:] & (off_before[:, debounce:width] - off_before[:, :width - debounce]
+                                                  == debounce)
+        no_edges = edges.sum(axis=1)
+        first = edges.argmax(axis=1)
+        last = width - 1 - edges[:, ::-1].argmax(axis=1)
+        on_before = np.zeros((len(on), width + 1), dtype=np.intp)
+        np.cumsum(on, axis=1, out=on_before[:, 1:])
+        span = last - first
+        on_count = on_before[np.arange(len(on)), last] - on_before[np.arange(len(on)), first]
+        found = no_edges >= 2
+        duty[rows] = np.where(found, 100 * on_count / np.maximum(span, 1), np.nan)
+        period[rows] = np.where(found, span / np.maximum(no_edges - 1, 1), np.nan)
+    return duty, period
@@ -6,28 +6,196 @@ See the PySerial Documentation: http://pyserial.readthedocs.io/en/latest/pyseria
 
 from subprocess import call, Popen, PIPE, TimeoutExpired
 from getpass import getpass
+from json import loads, JSONDecodeError
+from time import monotonic
+import numpy as np
 import serial
+import struct
+import timing
 import re
 import sys
 import os
 
 nul = open(os.devnull, 'w')
 
+""" Compact binary frame layout written by the ATmega32U4 sketch after it receives a 'B' command.
+
+    magic, count, ring_size, sample_size, start_sample, sample_rate_khz, sample_duration_ms, meter_id
+    followed by count raw ADC bytes (the first is the 0xFF marker) and a one byte additive checksum.
+"""
+FRAME_MAGIC = b'\xa5\x5aLM'
+FRAME_HEADER = struct.Struct('<4sHHIhffB')
+
+
+class FrameError(ValueError):
+    """ Raised when a frame read from the tty is truncated or fails to decode. """
+    def __init__(self, msg, data):
+        """
+        :param msg: Description of the decoding failure.
+        :param data: The offending frame as received.
+        """
+        ValueError.__init__(self, msg)
+        self.msg = msg
+        self.data = data
+
+
+class Frame:
+    """ One light meter sample: the ADC readings as an array plus the firmware's metadata. """
+    def __init__(self, raw, meta, values=None, text=None):
+        """
+        :param raw: The 8-bit ADC readings as a numpy uint8 array.
+        :param meta: Dictionary of sample_size, ring_size, sample_rate_khz, etc.
+        :param values: The readings as fractions of full scale. Computed from raw when omitted.
+        :param text: The JSON text of the frame when it was received in text mode.
+        """
+        self.raw = raw
+        self.meta = meta
+        self.values = np.round(raw / 255, 4) if values is None else values
+        self.text = text
+
+    def __getitem__(self, key):
+        """ Dictionary style access so a Frame can stand in for the decoded JSON sample. """
+        if key == 'values':
+            return self.values
+        return self.meta[key]
+
+    @property
+    def sample_size(self):
+        return self.meta['sample_size']
+
+    @property
+    def sample_rate_khz(self):
+        return self.meta['sample_rate_khz']
+
+    @property
+    def ring_size(self):
+        return self.meta['ring_size']
+
+    def to_json(self):
+        """ Return the sample in the JSON file format written by the firmware in text mode. """
+        if self.text is not None:
+            return self.text
+        lines = ['{', '  "values": [', ',\n'.join(['    {:.4f}'.format(v) for v in self.values]), '  ],']
+        for key, value in self.meta.items():
+            lines.append('  "{}": {},'.format(key, round(value, 4) if isinstance(value, float) else value))
+        lines[-1] = lines[-1].rstrip(',')
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+class FrameDecoder:
+    """ Incrementally find and decode JSON text and binary frames in a stream of tty bytes. """
+    def __init__(self, regex=re.compile('^\\}$')):
+        """
+        :param regex: A compiled regex matching the closing curly brace of a JSON frame.
+        """
+        self.end = re.compile(regex.pattern.encode(), re.MULTILINE)
+        self.buffer = bytearray()
+        self.scan = 0
+
+    def feed(self, data):
+        """ Append bytes received from the tty. """
+        self.buffer.extend(data)
+
+    def discard(self, length):
+        """ Drop length bytes from the front of the buffer. """
+        del self.buffer[:length]
+        self.scan = 0
+
+    def next_frame(self):
+        """ Return the next complete Frame in the buffer or None if more data is needed.
+
+            Raises FrameError for a truncated or undecodable frame; the frame is consumed so the
+            next call resumes with the data that follows it, or at the next binary frame's magic number.
+        """
+        buf = self.buffer
+        text_start = buf.find(b'{')
+        binary_start = buf.find(FRAME_MAGIC)
+        if text_start < 0 and binary_start < 0:
+            # Keep a possible partial magic number; everything else is inter-frame noise.
+            self.discard(max(0, len(buf) - len(FRAME_MAGIC) + 1))
+            return None
+        if binary_start >= 0 and (text_start < 0 or binary_start < text_start):
+            self.discard(binary_start)
+            return self._next_binary_frame()
+        self.discard(text_start)
+        return self._next_text_frame()
+
+    def _next_text_frame(self):
+        buf = self.buffer
+        match = self.end.search(buf, self.scan)
+        restart = buf.find(b'{', max(1, self.scan), match.start() if match else len(buf))
+        if restart > 0:
+            data = bytes(buf[:restart])
+            self.discard(restart)
+            raise FrameError('Truncated frame', data.decode(errors='replace'))
+        if match is None:
+            # The closing brace can not start before the last partial line.
+            self.scan = max(0, len(buf) - 2)
+            return None
+        data = bytes(buf[:match.end()])
+        self.discard(match.end())
+        with timing.span('frame.decode.json', len(data)):
+            text = data.decode(errors='replace')
+            try:
+                sample = loads(text)
+                values = np.asarray(sample.pop('values'), dtype=np.float64)
+            except (JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                raise FrameError(getattr(e, 'msg', str(e)), text)
+            raw = np.rint(values * 255).astype(np.uint8)
+        return Frame(raw, sample, values=values, text=text)
+
+    def _next_binary_frame(self):
+        buf = self.buffer
+        if len(buf) < FRAME_HEADER.size:
+            return None
+        magic, count, ring_size, sample_size, start_sample, rate, duration, meter_id = FRAME_HEADER.unpack_from(buf)
+        end = FRAME_HEADER.size + count + 1
+        if count > ring_size + 1:
+            self.discard(len(FRAME_MAGIC))
+            raise FrameError('Invalid binary frame length', bytes(buf[:FRAME_HEADER.size]))
+        if len(buf) < end:
+            return None
+        with timing.span('frame.decode.binary', end):
+            raw = np.frombuffer(bytes(buf[FRAME_HEADER.size:end - 1]), dtype=np.uint8)
+            if int(raw.sum()) & 0xFF != buf[end - 1]:
+                # A truncated frame runs into the header of the next, so resync at the next magic number
+                # inside what was taken for its payload rather than dropping the whole frame.
+                header = bytes(buf[:FRAME_HEADER.size])
+                resync = buf.find(FRAME_MAGIC, len(FRAME_MAGIC))
+                self.discard(resync if resync > 0 else len(buf) - len(FRAME_MAGIC) + 1)
+                raise FrameError('Binary frame checksum mismatch', header)
+            self.discard(end)
+        meta = {'sample_size': sample_size,
+                'ring_size': ring_size,
+                'start_sample': start_sample,
+                'sample_rate_khz': round(rate, 4),
+                'sample_duration_ms': round(duration, 4),
+                'meter_id': meter_id}
+        return Frame(raw, meta)
+
 
 class ReadTerminal:
     """ Provide USB serial TTY connection to a micro-controller device. """
-    def __init__(self, regex='^\}$', tty='/dev/ttyACM0', baud=230400, su_pass=''):
+    def __init__(self, regex='^\}$', tty='/dev/ttyACM0', baud=230400, su_pass='', binary=False, stty=True,
+                 capture=None):
         """
         :param regex: Assuming your device sends back JSON, this regex matches the closing curly brace.
         :param tty: Path to the tty device.
         :param baud: Baud rate.
+        :param binary: Ask the firmware to send compact binary frames instead of JSON text.
+        :param stty: Set the terminal characteristics first. Pseudo-terminals, such as fake_meter's, are
+            configured by their owner and need no root password.
+        :param capture: An optional capture_log.CaptureLog recording every byte read from and written to the tty.
         """
+        self.capture = capture
         self.regex = re.compile(regex)
+        self.decoder = FrameDecoder(self.regex)
         self.tty = tty
         self.baud = baud
         self.su_pass = su_pass
         f_flag = ''
-        if sys.platform.startswith('linux') or sys.platform.startswith('darwin'):
+        if stty and (sys.platform.startswith('linux') or sys.platform.startswith('darwin')):
             from os import getuid
             if sys.platform.startswith('linux'):
                 f_flag = '-F'
@@ -78,7 +246,7 @@ class ReadTerminal:
                 except OSError as e:
                     print(e.strerror.split(sep="'")[0], self.tty, file=sys.stderr, flush=True)
                     exit(1)
-        elif sys.platform.startswith('win32'):
+        elif stty and sys.platform.startswith('win32'):
             try:
                 call(''.join(['C:\Windows\System32\mode.com ', self.tty, ' baud=', repr(self.baud),
                               ' parity=n data=8 stop=1 dtr=on rts=on to=off xon=off odsr=off octs=off idsr=off']),
@@ -94,7 +262,11 @@ class ReadTerminal:
                 exit(1)
         # Drain the buffer of any crufty data it may hold.
         while self.in_waiting() > 0:
-            self.dev.read()
+            data = self.dev.read(self.in_waiting())
+            if self.capture is not None:
+                self.capture.received(data)
+        if binary:
+            self.set_binary(True)
 
     def open(self):
         """ Wrapper for Serial.open. """
@@ -103,7 +275,62 @@ class ReadTerminal:
 
     def read(self):
         """ Wrapper for Serial.readline. """
-        return self.dev.readline().decode()
+        data = self.dev.readline()
+        if self.capture is not None:
+            self.capture.received(data)
+        return data.decode()
+
+    def read_frame(self, timeout=None):
+        """ Read the tty in large chunks until a complete sample frame has arrived.
+
+        :param timeout: Seconds to wait for the frame. Waits indefinitely when None.
+        :return: A Frame, or None if the timeout expired first.
+        :raises FrameError: When a truncated or undecodable frame is received.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        # Setting the timeout reconfigures the port, so it is only changed when a call asks for another one
+        # and shortened, by halves, as the deadline nears.
+        if self.dev.timeout != timeout:
+            self.dev.timeout = timeout
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return None
+                if remaining < self.dev.timeout / 2:
+                    self.dev.timeout = remaining
+            with timing.span('tty.read') as read:
+                data = self.dev.read(max(1, self.in_waiting()))
+                read.bytes = len(data)
+            if self.capture is not None:
+                self.capture.received(data)
+            self.decoder.feed(data)
+
+    def read_available(self):
+        """ Feed whatever the tty holds to the frame decoder without blocking. """
+        waiting = self.in_waiting()
+        if waiting > 0:
+            with timing.span('tty.read', waiting):
+                data = self.dev.read(waiting)
+            if self.capture is not None:
+                self.capture.received(data)
+            self.decoder.feed(data)
+        return waiting
+
+    def fileno(self):
+        """ Wrapper for Serial.fileno so the tty can be watched by a selector. """
+        return self.dev.fileno()
+
+    def set_binary(self, enabled=True):
+        """ Switch the firmware between compact binary frames and JSON text frames. """
+        command = b'B' if enabled else b'J'
+        self.dev.write(command)
+        self.dev.flush()
+        if self.capture is not None:
+            self.capture.sent(command)
 
     def in_waiting(self):
         """ Wrapper for Serial.in_waiting. """
@@ -112,5 +339,7 @@ class ReadTerminal:
     def close(self):
         """ Wrapper for Serial.close. """
         self.dev.close()
+        if self.capture is not None:
+            self.capture.close()
 
 
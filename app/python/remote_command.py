@@ -2,9 +2,196 @@
 """ Provides multi-threaded remote command execution. """
 import paramiko
 import threading
+import select
 import sys
 import socket
+import timing
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
+from time import monotonic
+
+pools = {}
+READ_SIZE = 32768
+
+
+class CommandResult:
+    """ The outcome of a remote command. """
+    def __init__(self, command, exit_status, stdout, stderr, elapsed):
+        """
+        :param command: The command that was executed.
+        :param exit_status: The remote exit status.
+        :param stdout: The command's standard output as bytes.
+        :param stderr: The command's standard error as bytes.
+        :param elapsed: Round trip time in seconds.
+        """
+        self.command = command
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.exit_status == 0
+
+
+def read_output(channel, timeout=None):
+    """ Returns the stdout and stderr of a command channel as bytes.
+
+        Both streams are read as data arrives, so a command filling one while the other is read can not stall.
+
+    :param channel: A paramiko.Channel the command was started on.
+    :param timeout: Seconds to wait for more output. Waits indefinitely when None.
+    :raises socket.timeout: When no output arrives in time.
+    """
+    stdout = bytearray()
+    stderr = bytearray()
+    while True:
+        if channel.recv_stderr_ready():
+            stderr.extend(channel.recv_stderr(READ_SIZE))
+        elif channel.recv_ready():
+            stdout.extend(channel.recv(READ_SIZE))
+        elif channel.eof_received or channel.closed:
+            return bytes(stdout), bytes(stderr)
+        elif len(select.select([channel], [], [], timeout)[0]) == 0:
+            raise socket.timeout('Timed out waiting for the output of the remote command.')
+
+
+class SessionPool:
+    """ A keep-alive SSH connection to one host with a bounded executor for running commands.
+
+        A spare session channel is opened ahead of time so the next command starts without a round trip,
+        and a dropped connection is re-established on the next command.
+    """
+    def __init__(self, host, user, password, size=2, keepalive=30, client=None):
+        """
+        :param host: The hostname or IP address of the remote host.
+        :param user: The login username.
+        :param password: The login password.
+        :param size: The most commands run at once.
+        :param keepalive: Seconds between keep-alive packets.
+        :param client: An already connected paramiko.SSHClient to start with.
+        """
+        self.hostname = host
+        self.username = user
+        self.password = password
+        self.keepalive = keepalive
+        self.client = client
+        self.spare = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=size)
+        if client is not None:
+            client.get_transport().set_keepalive(keepalive)
+
+    def connect(self):
+        """ Open a new connection, replacing the current one. Only called once the current one has dropped. """
+        client = paramiko.SSHClient()
+        """ Notice: AutoAddPolicy is not secure. Do not use outside of a lab environment. """
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        with timing.span('ssh.connect', host=self.hostname):
+            client.connect(self.hostname, username=self.username, password=self.password)
+        client.get_transport().set_keepalive(self.keepalive)
+        if self.client is not None:
+            self.client.close()
+        self.client = client
+        self.spare = None
+
+    def open(self):
+        """ Connect unless the pool already holds a live connection. """
+        with self.lock:
+            transport = self.client.get_transport() if self.client is not None else None
+            if transport is None or not transport.is_active():
+                self.connect()
+
+    def session(self):
+        """ Return an open session channel, reconnecting if the connection has dropped. """
+        with self.lock:
+            if self.spare is not None and not self.spare.closed and self.spare.get_transport().is_active():
+                channel, self.spare = self.spare, None
+                return channel
+            self.spare = None
+            transport = self.client.get_transport() if self.client is not None else None
+            if transport is None or not transport.is_active():
+                self.connect()
+                transport = self.client.get_transport()
+            return transport.open_session()
+
+    def prepare(self):
+        """ Open the spare channel the next command will use. """
+        try:
+            channel = self.session()
+        except (paramiko.SSHException, socket.error, EOFError):
+            return
+        with self.lock:
+            if self.spare is None:
+                self.spare = channel
+            else:
+                channel.close()
+
+    def start(self, command):
+        """ Return a session channel running command, on a new channel if the first one went stale.
+
+            Only the failed channel is replaced. The connection is shared with commands still running on it and
+            is only replaced by session() once it has dropped.
+        """
+        for attempt in range(2):
+            channel = None
+            try:
+                with timing.span('ssh.session', host=self.hostname):
+                    channel = self.session()
+                channel.exec_command(command)
+                return channel
+            except (paramiko.SSHException, socket.error, EOFError):
+                if channel is not None:
+                    channel.close()
+                if attempt > 0:
+                    raise
+
+    def execute(self, command, timeout=None):
+        """ Run command on the remote host and return a CommandResult. Blocks until it exits.
+
+        :raises socket.timeout: When no output arrives for timeout seconds.
+        """
+        start = monotonic()
+        channel = self.start(command)
+        with timing.span('ssh.command', host=self.hostname) as remote:
+            try:
+                stdout, stderr = read_output(channel, timeout)
+                exit_status = channel.recv_exit_status()
+                remote.bytes = len(stdout) + len(stderr)
+            finally:
+                channel.close()
+        result = CommandResult(command, exit_status, stdout, stderr, monotonic() - start)
+        try:
+            self.executor.submit(self.prepare)
+        except RuntimeError:
+            # The pool is closing; no further command needs a spare channel.
+            pass
+        return result
+
+    def fire(self, command, timeout=None):
+        """ Run command in the background. Returns a Future of its CommandResult. """
+        return self.executor.submit(self.execute, command, timeout)
+
+    def run(self, command, timeout=None):
+        """ Run command and return its CommandResult. """
+        return self.fire(command, timeout).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            if self.spare is not None:
+                self.spare.close()
+            if self.client is not None:
+                self.client.close()
+
+
+def get_pool(host, user, password, size=2):
+    """ Return the shared SessionPool for user@host, connecting on first use. """
+    key = (host, user)
+    if key not in pools:
+        pools[key] = SessionPool(host, user, password, size=size)
+    return pools[key]
 
 
 class RemoteCommand:
@@ -20,11 +207,13 @@ class RemoteCommand:
         if len(self.username) > 0 and len(self.hostname) > 0:
             if self.password is None:
                 self.password = getpass(''.join(['SSH password for ', self.username, '@', self.hostname, ': ']))
-            self.ssh = paramiko.SSHClient()
-            """ Notice: AutoAddPolicy is not secure. Do not use outside of a lab environment. """
-            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            key = (self.hostname, self.username)
+            if key not in pools:
+                pools[key] = SessionPool(self.hostname, self.username, self.password)
+            self.pool = pools[key]
             try:
-                self.ssh.connect(self.hostname, username=self.username, password=self.password)
+                # Borrow the pool's connection when it already has a live one.
+                self.pool.open()
             except paramiko.AuthenticationException as error:
                 print(error, self.username, file=sys.stderr, flush=True)
                 exit(1)
@@ -38,6 +227,19 @@ class RemoteCommand:
             print('Error: hostname, username, or password not provided to RemoteCommand().',
                   file=sys.stderr, flush=True)
 
+    @property
+    def ssh(self):
+        """ The pool's current paramiko.SSHClient. """
+        return self.pool.client
+
+    def fire(self, command, timeout=None):
+        """ Run command on the host's session pool. Returns a Future of its CommandResult. """
+        return self.pool.fire(command, timeout)
+
+    def run(self, command, timeout=None):
+        """ Run command on the host's session pool and return its CommandResult. """
+        return self.pool.run(command, timeout)
+
 
 class CommandThread (threading.Thread):
     """ Thread support for RemoteCommand. """
@@ -57,8 +259,3 @@ class CommandThread (threading.Thread):
         """ Method representing the thread’s activity. """
         stdin, stdout, stderr = self.rcmd.ssh.exec_command(self.command)
         self.callback(stdin, stdout, stderr)
-
-
-
-
-
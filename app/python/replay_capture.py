@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Feed a tty capture log back through the frame decoder at full speed, without firing the laser.
+
+Frames are matched to shots the way the acquisition engine matched them: frames that were complete before a
+shot began are stale, and the first frame after it is the shot's sample. Samples can be extracted again into
+a new run directory, e.g. after improving the decoder, and each shot's outcome is compared with the one
+recorded during collection. With --timing the decoder's per-frame timing events are recorded too.
+"""
+
+import argparse
+import json
+import re
+import sys
+from collections import Counter
+from os import path
+from time import perf_counter
+from acquisition import write_sample
+from capture_log import NOTE, READ, read_capture
+from read_terminal import FrameDecoder, FrameError
+from sample_features import get_duty
+from sample_store import SampleStore, STORE_NAME
+import timing
+
+
+def get_target(data_dir, target):
+    """ Returns where a shot's sample goes in data_dir; the ??_duty/serial??.json part of its path is kept. """
+    return path.join(data_dir, path.basename(path.dirname(target)), path.basename(target))
+
+
+def get_location(target):
+    """ Returns the (duty, serial) of a ??_duty/serial??.json sample path. """
+    return get_duty(target), int(re.search(r'serial(\d+)\.json$', target).group(1))
+
+
+def replay(filename, persist=None, regex='^\\}$'):
+    """ Decode a capture log and return the replay summary.
+
+    :param filename: The capture log.
+    :param persist: Optional function of (target, frame) called with each shot's sample.
+    :param regex: A regular expression matching the end of a JSON frame.
+    :raises ValueError: When the file is not a capture log.
+    """
+    decoder = FrameDecoder(re.compile(regex))
+    records = 0
+    nbytes = 0
+    frames = 0
+    stale = 0
+    errors = Counter()
+    recorded = {}
+    outcomes = {}
+    pending = None
+
+    def decode():
+        """ Take every complete frame from the decoder, giving the first to the pending shot. """
+        nonlocal frames, stale, pending
+        while True:
+            try:
+                frame = decoder.next_frame()
+            except FrameError as e:
+                errors[e.msg] += 1
+                if pending is not None:
+                    outcomes[pending] = 'invalid'
+                    pending = None
+                continue
+            if frame is None:
+                return
+            frames += 1
+            if pending is None:
+                stale += 1
+                continue
+            outcomes[pending] = 'ok'
+            if persist is not None:
+                persist(pending, frame)
+            pending = None
+
+    start = perf_counter()
+    for kind, at, data in read_capture(filename):
+        records += 1
+        if kind == READ:
+            nbytes += len(data)
+            decoder.feed(data)
+            decode()
+        elif kind == NOTE:
+            note = json.loads(data.decode())
+            if note.get('event') == 'shot':
+                pending = note['target']
+                outcomes[pending] = 'timeout'
+            elif note.get('event') == 'done':
+                recorded[note['target']] = note['status']
+                if pending == note['target']:
+                    pending = None
+    seconds = perf_counter() - start
+
+    # A shot that failed to fire never had a frame to find; keep its recorded status.
+    statuses = {target: recorded.get(target) if recorded.get(target) == 'failed' else outcome
+                for target, outcome in outcomes.items()}
+    return {
+        'capture': filename,
+        'records': records,
+        'bytes': nbytes,
+        'seconds': seconds,
+        'mb-per-second': nbytes / seconds / 1e6 if seconds > 0 else None,
+        'frames': frames,
+        'frames-per-second': frames / seconds if seconds > 0 else None,
+        'frame-errors': dict(errors),
+        'stale-frames': stale,
+        'shots': len(statuses),
+        'statuses': dict(Counter(statuses.values())),
+        'recovered': sorted(t for t, status in statuses.items() if status == 'ok' and recorded.get(t, 'ok') != 'ok'),
+        'lost': sorted(t for t, status in statuses.items() if status != 'ok' and recorded.get(t) == 'ok')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('capture', help='The capture log to replay.')
+    parser.add_argument('-d', '--data_dir', default=None,
+                        help='Extract the samples into this run directory. By default they are only decoded.')
+    parser.add_argument('--store', default=0, type=int,
+                        help=''.join(['Whether to append the extracted samples to ', STORE_NAME, ' instead of',
+                                      ' writing a JSON file per sample. Defaults to false.']))
+    parser.add_argument('-r', '--regex', default='^\\}$',
+                        help='A regular expression matching the end of data from the light meter.'
+                             ' Defaults to ^\\}$')
+    parser.add_argument('--timing', default=None,
+                        help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+    args = parser.parse_args()
+    if args.timing is not None:
+        timing.configure(args.timing)
+
+    persist = None
+    if args.data_dir is not None:
+        if not path.isdir(args.data_dir):
+            print('Error:', args.data_dir, 'is not a directory.', file=sys.stderr, flush=True)
+            exit(1)
+        if args.store == 1:
+            store = SampleStore(path.join(args.data_dir, STORE_NAME))
+
+            def persist(target, frame):
+                duty, serial = get_location(target)
+                with timing.span('disk.append', len(frame.raw), sample=target):
+                    store.append(duty, serial, frame)
+        else:
+            def persist(target, frame):
+                write_sample(get_target(args.data_dir, target), frame)
+
+    try:
+        output = replay(args.capture, persist=persist, regex=args.regex)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+    print(json.JSONEncoder().encode(output), flush=True)
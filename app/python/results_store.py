@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" An on-disk SQLite store of training and prediction results for laser degradation trends.
+
+The model and compare tables have the columns of app/db/light_meter.sql, so rows can be imported from the
+controller's database and result dictionaries from train_model.py and prediction.py are inserted as they are
+printed. Rows are inserted in batches, one transaction each. Indexes on the laser, model, sample and date
+columns let trend() aggregate over time in SQLite without loading the history.
+
+A comparison's laser is the laser of its sample run: the sample is the laser's latest measurement, scored
+against the model of its earlier, known good condition.
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+from os import path
+
+MODEL_COLUMNS = ['model-id', 'laser-id', 'meter-id', 'operator-id', 'laser-host-id', 'model-host-name', 'min-duty',
+                 'max-duty', 'series', 'cross-validation-accuracy', 'cross-validation-error',
+                 'cross-validation-neighbors', 'cross-validation-folds', 'standard-error-estimate', 'samples', 'model']
+COMPARE_COLUMNS = ['sample-model-id', 'knn-model-id', 'operator-id', 'host-name', 'date', 'error-proba-mean',
+                   'error-proba-std-dev', 'error-proba-std-err-mean', 'error-proba-variance', 'error-proba-bins',
+                   'prediction-score', 'std-err-estimate', 'predict-proba', 'proba-dist-chart', 'mean-variance-chart']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS "model" (
+     "model-id" INTEGER NOT NULL PRIMARY KEY,
+     "laser-id" INTEGER NOT NULL,
+     "meter-id" INTEGER,
+     "operator-id" INTEGER,
+     "laser-host-id" INTEGER,
+     "model-host-name" TEXT,
+     "min-duty" INTEGER,
+     "max-duty" INTEGER,
+     "series" INTEGER,
+     "cross-validation-accuracy" REAL,
+     "cross-validation-error" REAL,
+     "cross-validation-neighbors" INTEGER,
+     "cross-validation-folds" INTEGER,
+     "standard-error-estimate" REAL,
+     "samples" TEXT,
+     "model" TEXT
+);
+CREATE TABLE IF NOT EXISTS "compare" (
+     "sample-model-id" INTEGER NOT NULL,
+     "knn-model-id" INTEGER NOT NULL,
+     "operator-id" INTEGER,
+     "host-name" TEXT,
+     "date" INTEGER NOT NULL,
+     "error-proba-mean" REAL,
+     "error-proba-std-dev" REAL,
+     "error-proba-std-err-mean" REAL,
+     "error-proba-variance" REAL,
+     "error-proba-bins" INTEGER,
+     "prediction-score" REAL,
+     "std-err-estimate" REAL,
+     "predict-proba" TEXT,
+     "proba-dist-chart" TEXT,
+     "mean-variance-chart" TEXT,
+    PRIMARY KEY ("sample-model-id", "knn-model-id", "date")
+);
+CREATE INDEX IF NOT EXISTS "model-laser" ON "model" ("laser-id", "model-id");
+CREATE INDEX IF NOT EXISTS "compare-sample-date" ON "compare" ("sample-model-id", "date");
+CREATE INDEX IF NOT EXISTS "compare-model" ON "compare" ("knn-model-id");
+CREATE INDEX IF NOT EXISTS "compare-date" ON "compare" ("date");
+"""
+
+TREND_FIELDS = ['laser-id', 'date', 'predictions', 'mean-prediction-score', 'mean-error-proba-mean', 'first-date',
+                'last-date']
+
+
+def quote(columns):
+    return ', '.join(''.join(['"', column, '"']) for column in columns)
+
+
+class ResultsStore:
+    """ The results database. """
+    def __init__(self, filename):
+        """
+        :param filename: The SQLite database file. It is created with the tables and indexes when missing.
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        # Readers such as the controller are not blocked while a batch is written.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def insert(self, table, columns, rows):
+        """ Insert or replace rows, given as result dictionaries, in one transaction. Returns the row count.
+
+            Keys that are not columns are ignored and missing columns are NULL.
+        """
+        query = ''.join(['INSERT OR REPLACE INTO "', table, '" (', quote(columns), ') VALUES (',
+                         ', '.join(['?'] * len(columns)), ')'])
+        values = [tuple(row.get(column) for column in columns) for row in rows]
+        with self.connection:
+            self.connection.executemany(query, values)
+        return len(values)
+
+    def add_models(self, rows):
+        """ Add training results. Each needs its model-id and laser-id besides the fields train_model.py prints. """
+        return self.insert('model', MODEL_COLUMNS, rows)
+
+    def add_comparisons(self, rows):
+        """ Add the result dictionaries of prediction.py or batch_prediction.py. Error results are skipped. """
+        return self.insert('compare', COMPARE_COLUMNS, [row for row in rows if 'error' not in row])
+
+    def import_database(self, filename):
+        """ Copy the model and compare rows of the controller's light_meter.db. Returns the row counts. """
+        if not path.isfile(filename):
+            raise ValueError(' '.join(['Error:', filename, 'is not a file.']))
+        self.connection.execute('ATTACH DATABASE ? AS "source"', (filename,))
+        try:
+            with self.connection:
+                models = self.connection.execute(''.join([
+                    'INSERT OR REPLACE INTO "model" (', quote(MODEL_COLUMNS), ') SELECT ', quote(MODEL_COLUMNS),
+                    ' FROM "source"."model"'])).rowcount
+                comparisons = self.connection.execute(''.join([
+                    'INSERT OR REPLACE INTO "compare" (', quote(COMPARE_COLUMNS), ') SELECT ', quote(COMPARE_COLUMNS),
+                    ' FROM "source"."compare"'])).rowcount
+        except sqlite3.DatabaseError as e:
+            raise ValueError(' '.join(['Error importing', filename, str(e)]))
+        finally:
+            self.connection.execute('DETACH DATABASE "source"')
+        return models, comparisons
+
+    @staticmethod
+    def get_filter(laser_id=None, model_id=None, sample_id=None, start=None, end=None):
+        """ Returns the WHERE clause and parameters selecting comparisons. Only given filters are added. """
+        clauses = []
+        parameters = []
+        for column, value, test in [('"model"."laser-id"', laser_id, ' = ?'),
+                                    ('"compare"."knn-model-id"', model_id, ' = ?'),
+                                    ('"compare"."sample-model-id"', sample_id, ' = ?'),
+                                    ('"compare"."date"', start, ' >= ?'),
+                                    ('"compare"."date"', end, ' < ?')]:
+            if value is not None:
+                clauses.append(''.join([column, test]))
+                parameters.append(value)
+        return (' WHERE ' + ' AND '.join(clauses) if len(clauses) > 0 else ''), parameters
+
+    def trend(self, laser_id=None, start=None, end=None, bucket=86400):
+        """ Returns the mean prediction score and error probability mean of each laser per period, oldest first.
+
+        :param laser_id: Only this laser. Defaults to every laser.
+        :param start: The first date, in seconds since the epoch.
+        :param end: The date the trend ends before.
+        :param bucket: The length of a period in seconds.
+        """
+        where, parameters = self.get_filter(laser_id=laser_id, start=start, end=end)
+        query = ''.join([
+            'SELECT "model"."laser-id", "compare"."date" - "compare"."date" % ? AS "period", COUNT(*),',
+            ' AVG("compare"."prediction-score"), AVG("compare"."error-proba-mean"), MIN("compare"."date"),',
+            ' MAX("compare"."date")',
+            ' FROM "compare" JOIN "model" ON "model"."model-id" = "compare"."sample-model-id"', where,
+            ' GROUP BY "model"."laser-id", "period" ORDER BY "model"."laser-id", "period"'])
+        return [dict(zip(TREND_FIELDS, row)) for row in self.connection.execute(query, [bucket] + parameters)]
+
+    def comparisons(self, laser_id=None, model_id=None, sample_id=None, start=None, end=None, limit=None):
+        """ Returns the matching comparisons as result dictionaries, newest first. """
+        where, parameters = self.get_filter(laser_id, model_id, sample_id, start, end)
+        query = ''.join([
+            'SELECT ', ', '.join(''.join(['"compare"."', column, '"']) for column in COMPARE_COLUMNS),
+            ' FROM "compare" JOIN "model" ON "model"."model-id" = "compare"."sample-model-id"', where,
+            ' ORDER BY "compare"."date" DESC'])
+        if limit is not None:
+            query = ''.join([query, ' LIMIT ?'])
+            parameters.append(limit)
+        return [dict(zip(COMPARE_COLUMNS, row)) for row in self.connection.execute(query, parameters)]
+
+    def close(self):
+        self.connection.close()
+
+
+def read_results(filename):
+    """ Returns the result dictionaries of a JSON-lines file, or of stdin for -. """
+    with (sys.stdin if filename == '-' else open(filename)) as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('database', help='The results database file. It is created when missing.')
+    parser.add_argument('--import-db', default=None,
+                        help="Copy the model and compare rows of the controller's light_meter.db.")
+    parser.add_argument('--models', default=None,
+                        help='A JSON-lines file of training results with model-id and laser-id, or - for stdin.')
+    parser.add_argument('--comparisons', default=None,
+                        help='A JSON-lines file of prediction results, e.g. the output of batch_prediction.py,'
+                             ' or - for stdin.')
+    parser.add_argument('--trend', default=1, type=int,
+                        help='Whether to print the trend of each laser, one JSON line per period.'
+                             ' Defaults to true.')
+    parser.add_argument('--laser', default=None, type=int,
+                        help='Only the trend of this laser ID. Defaults to every laser.')
+    parser.add_argument('--start', default=None, type=int,
+                        help='The first date of the trend in seconds since the epoch.')
+    parser.add_argument('--end', default=None, type=int,
+                        help='The date the trend ends before in seconds since the epoch.')
+    parser.add_argument('--bucket', default=86400, type=int,
+                        help='The length of a trend period in seconds. Defaults to 86400, a day.')
+    args = parser.parse_args()
+
+    try:
+        store = ResultsStore(args.database)
+        output = {'database': args.database}
+        if args.import_db is not None:
+            output['imported-models'], output['imported-comparisons'] = store.import_database(args.import_db)
+        if args.models is not None:
+            output['models'] = store.add_models(read_results(args.models))
+        if args.comparisons is not None:
+            output['comparisons'] = store.add_comparisons(read_results(args.comparisons))
+    except (OSError, ValueError, sqlite3.DatabaseError) as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+    encoder = json.JSONEncoder()
+    print(encoder.encode(output), flush=True)
+    if args.trend == 1:
+        for period in store.trend(laser_id=args.laser, start=args.start, end=args.end, bucket=args.bucket):
+            print(encoder.encode(period), flush=True)
+    store.close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+""" A collection run's shot plan and shot log, so an interrupted run can be resumed where it stopped.
+
+manifest.json holds the planned duty and serial order, the shuffle seed and the collection settings. It is
+written when the run starts, and again each time an adaptive run plans another round. manifest.log gets one
+JSON line per finished shot; the last line for a sample is its status.
+"""
+
+import json
+import threading
+import time
+from itertools import product
+from os import path, replace, fsync
+from random import Random, SystemRandom
+
+MANIFEST_NAME = 'manifest.json'
+LOG_NAME = 'manifest.log'
+
+
+def plan_shots(duty_min, duty_max, samples, random=1, seed=None):
+    """ Returns the (duty, serial) order of a run and the seed it was shuffled with.
+
+    :param random: Whether to shuffle the order.
+    :param seed: The shuffle seed. A new one is drawn when None.
+    """
+    plan = list(product(range(duty_min, duty_max + 1), range(samples + 1)))
+    if seed is None:
+        seed = SystemRandom().randrange(2 ** 32)
+    if random == 1:
+        Random(seed).shuffle(plan)
+    return plan, seed
+
+
+class RunManifest:
+    """ The manifest and shot log of one run directory. """
+    def __init__(self, directory, plan, seed, settings):
+        """
+        :param directory: The run directory.
+        :param plan: The (duty, serial) shot order.
+        :param seed: The seed the plan was shuffled with.
+        :param settings: The collection settings the run was started with.
+        """
+        self.directory = directory
+        self.plan = [tuple(shot) for shot in plan]
+        self.seed = seed
+        self.settings = settings
+        self.created = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, directory, plan, seed, settings):
+        """ Write a new run's manifest and return it. """
+        manifest = cls(directory, plan, seed, settings)
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, directory):
+        """ Read the manifest of an existing run.
+
+        :raises ValueError: When the run has no readable manifest.
+        """
+        filename = path.join(directory, MANIFEST_NAME)
+        try:
+            with open(filename) as f:
+                manifest = json.load(f)
+            run = cls(directory, manifest['plan'], manifest['seed'], manifest['settings'])
+            run.created = manifest.get('created', run.created)
+            return run
+        except (OSError, KeyError, TypeError, ValueError):
+            raise ValueError(' '.join(['Error:', filename, 'is not a valid run manifest.']))
+
+    def save(self):
+        filename = path.join(self.directory, MANIFEST_NAME)
+        temp = ''.join([filename, '.tmp'])
+        with open(temp, 'w') as f:
+            json.dump({'plan': self.plan, 'seed': self.seed, 'settings': self.settings, 'created': self.created}, f)
+        replace(temp, filename)
+
+    def extend(self, shots):
+        """ Add (duty, serial) shots to the end of the plan and rewrite the manifest. """
+        self.plan.extend(tuple(shot) for shot in shots)
+        self.save()
+
+    def record(self, duty, serial, status, **fields):
+        """ Append a shot's outcome to the log. The line is synced so a crash can not lose it. """
+        entry = {'duty': duty, 'serial': serial, 'status': status, 'time': time.time()}
+        entry.update(fields)
+        with self.lock:
+            with open(path.join(self.directory, LOG_NAME), 'a') as f:
+                f.write(json.dumps(entry))
+                f.write('\n')
+                f.flush()
+                fsync(f.fileno())
+
+    def statuses(self):
+        """ Returns the latest logged status of each (duty, serial). """
+        statuses = {}
+        filename = path.join(self.directory, LOG_NAME)
+        if not path.isfile(filename):
+            return statuses
+        with open(filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    statuses[(entry['duty'], entry['serial'])] = entry['status']
+                except (KeyError, TypeError, ValueError):
+                    # A line cut short by a crash.
+                    continue
+        return statuses
+
+    def remaining(self, valid):
+        """ Returns the planned shots still to collect, in plan order.
+
+        :param valid: A function of (duty, serial) telling whether a sample logged as ok is still present
+            and readable. Samples that were deleted or damaged since are collected again.
+        """
+        statuses = self.statuses()
+        return [(duty, serial) for duty, serial in self.plan
+                if statuses.get((duty, serial)) != 'ok' or not valid(duty, serial)]
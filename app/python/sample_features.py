@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+""" Ingest the samples of a collection run into the histogram features a model is trained on.
+
+Samples are read from the run's sample store when it has one, otherwise from the ??_duty/serial??.json
+files. Unchanged samples are taken from the feature cache and the rest may be spread across a process pool.
+"""
+
+import json
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from itertools import chain
+from os import path
+import numpy as np
+import pwm_wave_lib as pwlib
+import timing
+from pwm_wave_lib import FEATURE_SETTINGS
+from sample_store import SampleStore, STORE_NAME, sample_name
+from feature_cache import FeatureCache, CACHE_NAME, feature_version, file_stamp, record_stamp
+
+CHUNK_SIZE = 64
+
+
+class SerialExecutor:
+    """ Stands in for a process pool when a single worker is requested. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    @staticmethod
+    def map(fn, *iterables):
+        return map(fn, *iterables)
+
+
+def get_executor(workers):
+    """ Returns a process pool of workers processes, or a SerialExecutor for one. """
+    return ProcessPoolExecutor(max_workers=workers) if workers > 1 else SerialExecutor()
+
+
+def get_duty(filename):
+    """ Returns the duty cycle encoded in a sample's ??_duty folder name. """
+    return int(re.search(r'([\d]{2})_duty', path.dirname(filename)).group(1))
+
+
+def parse_files(filenames):
+    """ Parse sample files. Returns the decoded sample, or None for an invalid sample, per file. """
+    samples = []
+    for filename in filenames:
+        with timing.span('features.parse', sample=filename) as parse:
+            text = open(filename).read()
+            json_data = json.loads(text)
+            parse.bytes = len(text)
+        samples.append(json_data if hasattr(json_data, 'values') else None)
+    return samples
+
+
+def featurize_files(filenames, settings):
+    """ Parse and featurize sample files. Returns a feature row, or None for an invalid sample, per file. """
+    parsed = parse_files(filenames)
+    valid = [json_data is not None for json_data in parsed]
+    samples = [json_data for json_data in parsed if json_data is not None]
+    with timing.span('features.histogram', samples=len(samples)):
+        features = iter(pwlib.get_histogram_features(*pwlib.stack_samples(samples), **settings))
+    return [next(features) if ok else None for ok in valid]
+
+
+def featurize_records(store_file, rows, settings):
+    """ Featurize rows of a sample store. Returns a feature row per record. """
+    records = SampleStore(store_file).records()
+    with timing.span('features.histogram', samples=len(rows)):
+        return list(pwlib.get_histogram_features(records['raw'][rows] / 255, records['sample_rate_khz'][rows],
+                                                 records['ring_size'][rows], counts=records['count'][rows],
+                                                 **settings))
+
+
+def chunks(items, size=CHUNK_SIZE):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def load_features(directory, cache=True, workers=1, settings=FEATURE_SETTINGS, progress=None):
+    """ Returns the feature matrix and target duty cycles of the samples in directory.
+
+    :param directory: The collection run directory.
+    :param cache: Whether to reuse and update the run's feature cache.
+    :param workers: The number of processes parsing and featurizing samples.
+    :param settings: Histogram settings passed to pwm_wave_lib.get_histogram_features.
+    :param progress: Optional function of (filename, number, end) called for each sample, in order.
+    """
+    with timing.span('features.cache.load'):
+        feature_cache = FeatureCache(path.join(directory, CACHE_NAME), feature_version(**settings)) if cache else None
+    store_file = path.join(directory, STORE_NAME)
+    keys = []
+    stamps = []
+    target = []
+    computed = []
+    with get_executor(workers) as executor:
+        if path.isfile(store_file):
+            store = SampleStore(store_file)
+            records = store.records()
+            rows = store.rows()
+            filenames = [path.join(directory, sample_name(records[row]['duty'], records[row]['serial']))
+                         for row in rows]
+            target = records['duty'][rows].tolist()
+            keys = [''.join([STORE_NAME, ':', path.relpath(filename, directory)]) for filename in filenames]
+            stamps = [record_stamp(records, row) for row in rows]
+            cached = [feature_cache is not None and feature_cache.has(key, stamp) for key, stamp in zip(keys, stamps)]
+            parts = chunks([row for row, ok in zip(rows, cached) if not ok])
+            results = chain.from_iterable(executor.map(featurize_records, [store_file] * len(parts), parts,
+                                                       [settings] * len(parts)))
+            for number, (filename, ok) in enumerate(zip(filenames, cached), start=1):
+                if not ok:
+                    computed.append(next(results))
+                if progress is not None:
+                    progress(filename, number, len(filenames))
+        else:
+            filenames = glob(''.join([directory, '/??_duty/serial??.json']))
+            entries = []
+            for filename in filenames:
+                if path.isfile(filename):
+                    key = path.relpath(filename, directory)
+                    stamp = file_stamp(filename)
+                    entries.append((filename, key, stamp, feature_cache is not None and feature_cache.has(key, stamp)))
+                else:
+                    entries.append((filename, None, None, None))
+            parts = chunks([filename for filename, key, stamp, cached in entries if cached is False])
+            results = chain.from_iterable(executor.map(featurize_files, parts, [settings] * len(parts)))
+            for number, (filename, key, stamp, cached) in enumerate(entries, start=1):
+                if key is None:
+                    print(filename, 'is not a regular file.', file=sys.stderr, flush=True)
+                else:
+                    row = None if cached else next(results)
+                    if cached or row is not None:
+                        target.append(get_duty(filename))
+                        keys.append(key)
+                        stamps.append(stamp)
+                        if row is not None:
+                            computed.append(row)
+                    else:
+                        print('Extracted JSON data has no attribute "values".', file=sys.stderr, flush=True)
+                if progress is not None:
+                    progress(filename, number, len(entries))
+    if feature_cache is not None:
+        features = feature_cache.complete(keys, stamps, computed)
+        with timing.span('features.cache.save', samples=len(keys)):
+            feature_cache.save(keys)
+    else:
+        features = np.asarray(computed, dtype=np.int64)
+    return features.reshape(len(target), settings['bins'] - 1), target
+
+
+def load_samples(directory, workers=1):
+    """ Returns every sample of a run stacked as the arguments of pwm_wave_lib.get_histogram_features.
+
+        The result is (values, sample_rate_khz, ring_size, counts, target). Featurizing these arrays under many
+        settings avoids parsing the samples again for each.
+
+    :param directory: The collection run directory.
+    :param workers: The number of processes parsing sample files.
+    """
+    store_file = path.join(directory, STORE_NAME)
+    if path.isfile(store_file):
+        store = SampleStore(store_file)
+        records = store.records()
+        rows = store.rows()
+        return (records['raw'][rows] / 255,
+                np.asarray(records['sample_rate_khz'][rows], dtype=np.float64),
+                np.asarray(records['ring_size'][rows], dtype=np.intp),
+                np.asarray(records['count'][rows], dtype=np.intp),
+                records['duty'][rows].tolist())
+    filenames = sorted(filename for filename in glob(''.join([directory, '/??_duty/serial??.json']))
+                       if path.isfile(filename))
+    samples = []
+    target = []
+    with get_executor(workers) as executor:
+        parsed = chain.from_iterable(executor.map(parse_files, chunks(filenames)))
+        for filename, json_data in zip(filenames, parsed):
+            if json_data is None:
+                print(filename, 'has no attribute "values".', file=sys.stderr, flush=True)
+            else:
+                samples.append(json_data)
+                target.append(get_duty(filename))
+    return pwlib.stack_samples(samples) + (target,)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+""" An append-only, memory-mappable container for the light meter samples of one collection run.
+
+Each record holds the raw 8-bit ADC readings and the firmware metadata of one sample in a fixed width
+numpy structured layout, so a whole run is read back with a single sequential memory map.
+"""
+
+import struct
+import re
+import sys
+from glob import glob
+from json import loads
+from os import path, mkdir
+import numpy as np
+from read_terminal import Frame
+
+STORE_NAME = 'samples.lms'
+STORE_MAGIC = b'LMSTORE1'
+STORE_HEADER = struct.Struct('<8sHH4x')
+
+
+def record_dtype(capacity):
+    """ Returns the structured dtype of a record holding up to capacity readings. """
+    return np.dtype([('duty', '<u1'),
+                     ('serial', '<u2'),
+                     ('count', '<u2'),
+                     ('sample_size', '<u4'),
+                     ('ring_size', '<u2'),
+                     ('start_sample', '<i2'),
+                     ('meter_id', '<u1'),
+                     ('sample_rate_khz', '<f8'),
+                     ('sample_duration_ms', '<f8'),
+                     ('raw', '<u1', (capacity,))])
+
+
+def sample_name(duty, serial):
+    """ Returns the relative file name of a sample in the directory layout. """
+    return path.join(''.join([str(duty), '_duty']), ''.join(['serial', '{:02d}'.format(serial), '.json']))
+
+
+class SampleStore:
+    """ A single file store of samples indexed by duty cycle and serial number. """
+    def __init__(self, filename, capacity=1000):
+        """
+        :param filename: Path to the store. It is created when it does not exist.
+        :param capacity: Readings per record for a new store; an existing store keeps its own.
+        """
+        self.filename = filename
+        if path.isfile(filename):
+            with open(filename, 'rb') as f:
+                magic, version, capacity = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+            if magic != STORE_MAGIC:
+                raise ValueError(' '.join([filename, 'is not a sample store.']))
+        else:
+            with open(filename, 'wb') as f:
+                f.write(STORE_HEADER.pack(STORE_MAGIC, 1, capacity))
+        self.capacity = capacity
+        self.dtype = record_dtype(capacity)
+
+    def __len__(self):
+        """ The number of complete records; a record torn by a crash is ignored. """
+        return (path.getsize(self.filename) - STORE_HEADER.size) // self.dtype.itemsize
+
+    def append(self, duty, serial, frame):
+        """ Append a sample. A later record for the same duty and serial supersedes earlier ones.
+
+        :param duty: The duty cycle the laser was fired at.
+        :param serial: The sample's serial number within the duty cycle.
+        :param frame: A read_terminal.Frame, or any mapping with values and the firmware metadata.
+        """
+        raw = frame.raw if isinstance(frame, Frame) else np.rint(np.asarray(frame['values']) * 255)
+        if len(raw) > self.capacity:
+            raise ValueError(' '.join(['Sample has', str(len(raw)), 'readings; the store holds',
+                                       str(self.capacity)]))
+        record = np.zeros(1, dtype=self.dtype)
+        record['duty'] = duty
+        record['serial'] = serial
+        record['count'] = len(raw)
+        for key in ('sample_size', 'ring_size', 'start_sample', 'meter_id', 'sample_rate_khz',
+                    'sample_duration_ms'):
+            record[key] = frame[key]
+        record['raw'][0, :len(raw)] = raw
+        with open(self.filename, 'ab') as f:
+            f.write(record.tobytes())
+
+    def records(self):
+        """ Returns a read-only memory map of every complete record. """
+        length = len(self)
+        if length == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=STORE_HEADER.size, shape=(length,))
+
+    def index(self):
+        """ Returns a dictionary of (duty, serial) to the row of the current record. """
+        records = self.records()
+        return {(int(duty), int(serial)): row
+                for row, (duty, serial) in enumerate(zip(records['duty'], records['serial']))}
+
+    def rows(self):
+        """ Returns the rows of the current records in file order, skipping superseded ones. """
+        return sorted(self.index().values())
+
+    def frame(self, row, records=None):
+        """ Returns the record at row as a read_terminal.Frame. """
+        record = (self.records() if records is None else records)[row]
+        meta = {'sample_size': int(record['sample_size']),
+                'ring_size': int(record['ring_size']),
+                'start_sample': int(record['start_sample']),
+                'sample_rate_khz': round(float(record['sample_rate_khz']), 4),
+                'sample_duration_ms': round(float(record['sample_duration_ms']), 4),
+                'meter_id': int(record['meter_id'])}
+        return Frame(np.array(record['raw'][:record['count']]), meta)
+
+    def import_directory(self, directory):
+        """ Append every ??_duty/serial??.json sample in directory. Returns the number imported. """
+        imported = 0
+        for filename in sorted(glob(path.join(directory, '??_duty', 'serial??.json'))):
+            duty = int(re.search(r'([\d]{2})_duty', path.dirname(filename)).group(1))
+            serial = int(re.search(r'serial([\d]{2})', path.basename(filename)).group(1))
+            try:
+                self.append(duty, serial, loads(open(filename).read()))
+                imported += 1
+            except (ValueError, KeyError) as e:
+                print('Skipped', filename, e, file=sys.stderr, flush=True)
+        return imported
+
+    def export_directory(self, directory):
+        """ Write every current record as a ??_duty/serial??.json file. Returns the number exported. """
+        records = self.records()
+        rows = self.rows()
+        for row in rows:
+            target = path.join(directory, sample_name(records[row]['duty'], records[row]['serial']))
+            if not path.isdir(path.dirname(target)):
+                mkdir(path.dirname(target), mode=0o744)
+            with open(target, 'w') as f:
+                f.write(self.frame(row, records).to_json())
+        return len(rows)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" Policies deciding how long the acquisition engine waits between one shot and the next.
+
+A scheduler's wait() coroutine runs after a shot's firing command has exited and its frame has been handled,
+and returns the seconds it waited. The engine records that as the shot's gap.
+"""
+
+import asyncio
+from time import monotonic
+
+""" A ring of 1000 readings at the sketch's 76.9 KHz; the firmware needs this long to refill the ring. """
+REARM_SECONDS = 1000 / 76.9231 / 1000
+
+
+class FixedDelay:
+    """ Wait the same number of seconds after every shot. The conservative original behaviour. """
+    def __init__(self, delay=2.0):
+        """
+        :param delay: Seconds to wait between shots.
+        """
+        self.delay = delay
+
+    async def wait(self, shot, reader):
+        await asyncio.sleep(self.delay)
+        return self.delay
+
+
+class Readiness:
+    """ Wait only until the light meter and laser are ready for the next shot.
+
+        Ready means the tty has been quiet for a moment, the firmware has had time to re-arm after sending its
+        frame, and the laser's cooldown interval has passed since its firing command exited.
+    """
+    def __init__(self, cooldown=0.0, quiet=0.05, rearm=REARM_SECONDS, limit=5.0):
+        """
+        :param cooldown: The laser's minimum seconds between the end of one firing and the next.
+        :param quiet: Seconds without tty data that count as quiet.
+        :param rearm: Seconds the firmware needs after a frame before it can capture again.
+        :param limit: The most seconds to wait for a quiet tty; stale data is drained by the engine anyway.
+        """
+        self.cooldown = cooldown
+        self.quiet = quiet
+        self.rearm = rearm
+        self.limit = limit
+
+    async def wait(self, shot, reader):
+        start = monotonic()
+        ready = start
+        if shot.fired_at is not None:
+            ready = max(ready, shot.fired_at + self.cooldown)
+        if shot.captured_at is not None:
+            ready = max(ready, shot.captured_at + self.rearm)
+        while True:
+            now = monotonic()
+            quiet_at = reader.last_data + self.quiet
+            # The limit only cuts the quiet wait short; the laser cooldown and firmware rearm are always honoured.
+            if now >= ready and (now >= quiet_at or now - start >= self.limit):
+                break
+            await asyncio.sleep(max(ready, min(quiet_at, start + self.limit)) - now)
+        return monotonic() - start
+
+
+""" Scheduler names accepted by the collection scripts' --schedule option. """
+SCHEDULERS = ['ready', 'fixed']
+
+
+def get_scheduler(name, delay=2.0, cooldown=0.0, quiet=0.05):
+    """ Returns the scheduler called name.
+
+    :param delay: The fixed policy's seconds between shots.
+    :param cooldown: The readiness policy's laser cooldown seconds.
+    :param quiet: The readiness policy's quiet tty seconds.
+    """
+    if name == 'fixed':
+        return FixedDelay(delay)
+    return Readiness(cooldown=cooldown, quiet=quiet)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Search neighbors, histogram bins, voltage window and sample window for the best cross validated model.
+
+The samples are parsed once. Each combination of feature settings is featurized once and scored with every
+neighbor count, the cross validation folds running in parallel. The ranked results are written to sweep.json
+in the run directory. With --train 1 the best configuration is also trained and saved there as the run's model;
+runs whose samples are featurized with other settings can then no longer be scored by it.
+"""
+
+import argparse
+import json
+import sys
+from itertools import product
+from os import path, getcwd, replace, cpu_count
+import numpy as np
+from sklearn.model_selection import cross_val_score
+from sklearn.neighbors import KNeighborsClassifier
+import pwm_wave_lib as pwlib
+import timing
+from artifact_lib import CODECS, DEFAULT_CODEC
+from pwm_wave_lib import FEATURE_SETTINGS
+from sample_features import load_samples
+from train_model import train
+
+SWEEP_NAME = 'sweep.json'
+
+
+def parse_list(kind):
+    """ Returns an argparse type reading a comma separated list of kind. """
+    def parse(text):
+        return [kind(value) for value in text.split(',')]
+    return parse
+
+
+def feature_grid(bins, windows, starts, periods):
+    """ Returns the settings dictionary of every combination of feature parameters. """
+    return [{'bins': b, 'window': w, 'start': s, 'sample_size': p} for b, w, s, p in product(bins, windows, starts,
+                                                                                              periods)]
+
+
+def rank(results):
+    """ Sort results best first: highest accuracy, then lowest spread across folds, then fewest neighbors.
+
+        Configurations that could not be scored go last. Each result gets its rank.
+    """
+    scored = sorted((r for r in results if 'error' not in r),
+                    key=lambda r: (-r['cross-validation-accuracy'], r['cross-validation-error'], r['neighbors']))
+    ranked = scored + [r for r in results if 'error' in r]
+    for number, result in enumerate(ranked, start=1):
+        result['rank'] = number
+    return ranked
+
+
+def sweep(directory, neighbors, settings_grid, folds=5, workers=1, progress=None):
+    """ Cross validate every combination of neighbors and feature settings. Returns the ranked results.
+
+    :param directory: Path to model training samples.
+    :param neighbors: The neighbor counts to try.
+    :param settings_grid: The histogram settings to try, as passed to pwm_wave_lib.get_histogram_features.
+    :param folds: The number of cross validation folds.
+    :param workers: The number of processes parsing samples and scoring folds.
+    :param progress: Optional function of (result, number, end) called after each configuration.
+    :raises ValueError: When there are no samples.
+    """
+    with timing.span('features.load', workers=workers) as loading:
+        values, sample_rate_khz, ring_size, counts, target = load_samples(directory, workers=workers)
+        loading.fields['samples'] = len(target)
+    if len(target) == 0:
+        raise ValueError('Data array collection error: no data found.')
+    y = np.asarray(target)
+
+    results = []
+    end = len(settings_grid) * len(neighbors)
+    for settings in settings_grid:
+        try:
+            with timing.span('features.histogram', samples=len(y), **settings):
+                X = pwlib.get_histogram_features(values, sample_rate_khz, ring_size, counts=counts, **settings)
+        except ValueError as e:
+            X = None
+            error = str(e)
+        for n_neighbors in neighbors:
+            result = {'neighbors': n_neighbors, 'feature-settings': settings}
+            if X is None:
+                result['error'] = error
+            else:
+                try:
+                    with timing.span('model.cross_val_score', samples=len(y), folds=folds, neighbors=n_neighbors,
+                                     **settings):
+                        scores = cross_val_score(KNeighborsClassifier(n_neighbors=n_neighbors), X, y, cv=folds,
+                                                 n_jobs=workers)
+                    result['cross-validation-accuracy'] = scores.mean()
+                    result['cross-validation-error'] = scores.std()
+                except ValueError as e:
+                    result['error'] = ' '.join(['Error computing cross_val_score.', str(e)])
+            results.append(result)
+            if progress is not None:
+                progress(result, len(results), end)
+    return rank(results)
+
+
+def save_results(directory, results, folds):
+    """ Write the ranked results to sweep.json in the run directory. Returns its path. """
+    filename = path.join(directory, SWEEP_NAME)
+    temp = ''.join([filename, '.tmp'])
+    with open(temp, 'w') as f:
+        json.dump({'folds': folds, 'results': results}, f, indent=1)
+    replace(temp, filename)
+    return filename
+
+
+def describe(result):
+    settings = result['feature-settings']
+    return '{:>4}{:>6}{:>8}{:>7}{:>9}'.format(result['neighbors'], settings['bins'], settings['window'],
+                                               settings['start'], settings['sample_size'])
+
+
+def print_progress(result, number, end):
+    score = result.get('error', '{:.4f}'.format(result.get('cross-validation-accuracy', 0)))
+    print(''.join([str(number), '/', str(end), ' ', describe(result), '  ', score]), flush=True)
+
+
+def print_table(results, top=10):
+    print('{:>5}{:>4}{:>6}{:>8}{:>7}{:>9}{:>11}{:>9}'.format('rank', 'k', 'bins', 'window', 'start', 'periods',
+                                                            'accuracy', 'std'))
+    for result in results[:top]:
+        if 'error' in result:
+            break
+        print('{:>5}{}{:>11.4f}{:>9.4f}'.format(result['rank'], describe(result),
+                                                 result['cross-validation-accuracy'],
+                                                 result['cross-validation-error']))
+    print(flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d', '--directory', default=getcwd(),
+                        help='Path to model training samples. Defaults to current directory.')
+    parser.add_argument('--neighbors', default=[1, 3, 5, 7, 9, 11], type=parse_list(int),
+                        help='Comma separated neighbor counts to try. Defaults to 1,3,5,7,9,11.')
+    parser.add_argument('--bins', default=[3, 4, 5], type=parse_list(int),
+                        help='Comma separated histogram bin counts to try. Defaults to 3,4,5.')
+    parser.add_argument('--window', default=[0.03, 0.05, 0.08], type=parse_list(float),
+                        help='Comma separated histogram voltage windows to try. Defaults to 0.03,0.05,0.08.')
+    parser.add_argument('--start', default=[FEATURE_SETTINGS['start']], type=parse_list(int),
+                        help='Comma separated first readings of the sample window to try. Defaults to 45.')
+    parser.add_argument('--periods', default=[6, 8, 10], type=parse_list(int),
+                        help='Comma separated sample window lengths in PWM periods to try. Defaults to 6,8,10.')
+    parser.add_argument('--folds', default=5, type=int,
+                        help='The number of cross validation folds. Defaults to 5.')
+    parser.add_argument('-w', '--workers', default=cpu_count(), type=int,
+                        help='The number of processes parsing samples and scoring folds. Defaults to the CPU count.')
+    parser.add_argument('--train', default=0, type=int,
+                        help='Whether to train and save the best configuration as the run\'s model, replacing it.'
+                             ' Samples featurized with the default settings can then not be scored by it.'
+                             ' Defaults to false.')
+    parser.add_argument('--codec', default=DEFAULT_CODEC, choices=sorted(CODECS),
+                        help=''.join(['Compression of the saved samples and model. Defaults to ', DEFAULT_CODEC, '.']))
+    parser.add_argument('--timing', default=None,
+                        help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+    args = parser.parse_args()
+    if args.timing is not None:
+        timing.configure(args.timing)
+
+    if min(args.bins) < 2 or min(args.neighbors) < 1:
+        print('Error: --bins must be at least 2 and --neighbors at least 1.', file=sys.stderr, flush=True)
+        exit(1)
+
+    try:
+        results = sweep(args.directory, args.neighbors, feature_grid(args.bins, args.window, args.start, args.periods),
+                        folds=args.folds, workers=args.workers, progress=print_progress)
+    except ValueError as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+    print()
+    print_table(results)
+    output = {'results': save_results(args.directory, results, args.folds), 'best': results[0]}
+    if 'error' in results[0]:
+        print('Error: no configuration could be cross validated.', file=sys.stderr, flush=True)
+        exit(1)
+
+    if args.train == 1:
+        best = results[0]
+        try:
+            # The feature cache only holds one settings version; keep it for the default features.
+            output['model'] = train(args.directory, workers=args.workers, neighbors=best['neighbors'],
+                                    folds=args.folds, settings=best['feature-settings'], codec=args.codec,
+                                    cache=best['feature-settings'] == FEATURE_SETTINGS)
+        except ValueError as e:
+            print(e, file=sys.stderr, flush=True)
+            exit(1)
+
+    print(json.JSONEncoder().encode(output), flush=True)
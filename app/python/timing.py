@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+""" Opt-in per-stage timing for finding where a collection, training or prediction run spends its time.
+
+Nothing is recorded until configure() is called. Each completed span is then written as one JSON line,
+
+    {"stage": "ssh.command", "duration": 0.0512, "bytes": 0, "sample": ".../42_duty/serial07.json", ...}
+
+and totals per stage are printed as a table on stderr when the process exits.
+
+    with timing.span('tty.read') as s:
+        data = dev.read(n)
+        s.bytes = len(data)
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from time import perf_counter
+
+""" Set to a JSON-lines file name, or - for stdout, to enable timing in processes started without --timing. """
+ENVIRONMENT = 'LASER_METER_TIMING'
+
+_lock = threading.Lock()
+_sink = None
+_totals = {}
+
+
+class Span:
+    """ Times a with block and records it as a stage event. """
+    __slots__ = ('stage', 'bytes', 'sample', 'fields', 'start')
+
+    def __init__(self, stage, nbytes=None, sample=None, **fields):
+        """
+        :param stage: Dotted stage name, e.g. ssh.command.
+        :param nbytes: Bytes moved by the stage. May be set on the span before the block ends.
+        :param sample: The sample the stage worked on.
+        :param fields: Other values to include in the event.
+        """
+        self.stage = stage
+        self.bytes = nbytes
+        self.sample = sample
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if _sink is not None:
+            if kind is not None:
+                self.fields['error'] = kind.__name__
+            record(self.stage, perf_counter() - self.start, self.bytes, self.sample, **self.fields)
+        return False
+
+
+def span(stage, nbytes=None, sample=None, **fields):
+    """ Returns a Span context manager for stage. """
+    return Span(stage, nbytes, sample, **fields)
+
+
+def enabled():
+    return _sink is not None
+
+
+def record(stage, duration, nbytes=None, sample=None, **fields):
+    """ Record a stage that was timed by other means. Does nothing unless timing is configured. """
+    if _sink is None:
+        return
+    event = {'stage': stage, 'duration': duration, 'time': time.time(), 'pid': os.getpid()}
+    if nbytes is not None:
+        event['bytes'] = nbytes
+    if sample is not None:
+        event['sample'] = sample
+    event.update(fields)
+    with _lock:
+        totals = _totals.setdefault(stage, [0, 0.0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] = max(totals[2], duration)
+        totals[3] += nbytes or 0
+        if _sink is not None:
+            _sink(event)
+
+
+def configure(destination=None, sink=None, summary=True):
+    """ Start recording stage events.
+
+    :param destination: A JSON-lines file to append events to, or - for stdout.
+    :param sink: Alternatively, a function called with each event dictionary.
+    :param summary: Whether to print the table of stage totals to stderr at exit.
+    """
+    global _sink
+    if sink is None:
+        stream = sys.stdout if destination == '-' else open(destination, 'a', buffering=1)
+
+        def sink(event):
+            stream.write(json.dumps(event))
+            stream.write('\n')
+            stream.flush()
+    _sink = sink
+    if summary:
+        atexit.register(print_summary)
+
+
+def configure_from_environment(sink=None):
+    """ Configure timing from LASER_METER_TIMING when it is set. Returns whether timing is enabled. """
+    destination = os.environ.get(ENVIRONMENT, '')
+    if destination != '':
+        configure(destination, sink=sink if destination == '-' else None)
+    return enabled()
+
+
+def summary():
+    """ Returns a (stage, count, total seconds, mean seconds, max seconds, bytes) row per stage. """
+    with _lock:
+        return [(stage, count, total, total / count, longest, nbytes)
+                for stage, (count, total, longest, nbytes) in sorted(_totals.items())]
+
+
+def print_summary(file=None):
+    rows = summary()
+    if len(rows) == 0:
+        return
+    file = sys.stderr if file is None else file
+    print('{:<28}{:>8}{:>12}{:>12}{:>12}{:>14}'.format('stage', 'count', 'total s', 'mean ms', 'max ms', 'bytes'),
+          file=file)
+    for stage, count, total, mean, longest, nbytes in rows:
+        print('{:<28}{:>8}{:>12.3f}{:>12.2f}{:>12.2f}{:>14}'.format(stage, count, total, mean * 1000,
+                                                                    longest * 1000, nbytes), file=file)
+    file.flush()
@@ -7,27 +7,18 @@ import sys
 from math import pow, floor
 from os import path, getcwd
 import numpy as np
-import pwm_wave_lib as pwlib
+from sample_store import SampleStore, STORE_NAME
+from feature_cache import CACHE_NAME
+from pwm_wave_lib import FEATURE_SETTINGS
+from sample_features import load_features
+import timing
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.externals import joblib
+from artifact_lib import CODECS, DEFAULT_CODEC, dump_artifact
+from lut_model import LUT_FEATURES, LUT_NAME, LookupTableClassifier, check_table
 from sklearn.datasets.base import Bunch
 from sklearn.model_selection import cross_val_score
-import re
-from glob import glob
 import argparse
 
-parser = argparse.ArgumentParser()
-
-parser.add_argument('-d', '--directory', default=getcwd(),
-                    help='Path to model training samples. Defaults to current directory.')
-args = parser.parse_args()
-
-data = []
-target = []
-samples = glob(''.join([args.directory, '/??_duty/serial??.json']))
-no_samples = 1
-end = len(samples)
-
 
 def status_update(filename, no_samples, end):
     """ Return a status update message. """
@@ -37,72 +28,166 @@ def status_update(filename, no_samples, end):
     return ''.join([percent_complete, '% complete. ', directory, '/', tail])
 
 
-print()
-print('┌──────────────────────┐')
-print('│ Begin Model Training │')
-print('└──────────────────────┘\n', flush=True)
-
-for filename in samples:
-    if path.isfile(filename):
-        json_data = json.loads(open(filename).read())
-        if hasattr(json_data, 'values'):
-            p = re.search('([\d]{2})_duty', path.dirname(filename))
-            target.append(int(p.group(1)))
-            limits = pwlib.get_minima(json_data)
-            volts = np.asarray([round(v, 4) for v in json_data['values'][limits[0]:limits[1]]])
-            histogram = np.histogram(volts, bins=3, range=(volts.min(), volts.min() + 0.05))
-            data.append((histogram[0][0], histogram[0][1]))
-        else:
-            print('Extracted JSON data has no attribute "values".', file=sys.stderr, flush=True)
-    else:
-        print(filename, 'is not a regular file.', file=sys.stderr, flush=True)
+def print_status(filename, no_samples, end):
     print(status_update(filename, no_samples, end), flush=True)
-    no_samples += 1
-
-
-if len(data) is 0 or len(target) is 0:
-    print('Data array collection error: no data found.', file=sys.stderr, flush=True)
-    exit(1)
-
-X = np.asarray(data)
-y = np.asarray(target)
-
-samples = Bunch()
-samples.data = data
-samples.target = target
-samples_file = path.join(args.directory, 'poly2d.pkl.xz')
-joblib.dump(samples, samples_file)
-
-cv_neighbors = 5
-knn = KNeighborsClassifier(n_neighbors=cv_neighbors, n_jobs=-1)
-knn.fit(X, y)
-model_file = path.join(args.directory, 'knn_model.pkl.xz')
-joblib.dump(knn, model_file)
-
-cv_folds = 5
-try:
-    scores = cross_val_score(knn, X, y, cv=cv_folds)
-except ValueError as e:
-    message = 'Error computing cross_val_score.'
-    print(message, e, file=sys.stderr, flush=True)
-    exit(1)
-
-
-sum_sq = 0
-p = knn.predict(X)
-for guess, target in zip(p, y):
-    sum_sq += pow(guess - target, 2)
-
-standard_error_estimate = sum_sq / len(X)
-
-output = json.JSONEncoder().encode({
-    'cross-validation-accuracy': scores.mean(),
-    'cross-validation-error': scores.std(),
-    'cross-validation-neighbors': cv_neighbors,
-    'cross-validation-folds': cv_folds,
-    'standard-error-estimate': standard_error_estimate,
-    'samples': samples_file,
-    'model': model_file})
-
-print()
-print(output, flush=True)
+
+
+def train(directory, workers=1, cache=True, pack=False, codec=DEFAULT_CODEC, lut=False, neighbors=5, folds=5,
+          settings=FEATURE_SETTINGS, progress=None):
+    """ Train a model on the samples in directory, save it there and return the results.
+
+    :param directory: Path to model training samples.
+    :param workers: The number of processes parsing and featurizing samples and scoring cross validation folds.
+    :param cache: Whether to reuse the features of unchanged samples.
+    :param pack: Whether to pack the JSON sample files into a sample store first.
+    :param codec: The artifact_lib codec the samples and model are saved with.
+    :param lut: Whether to also compile the model into a lookup table model for fast prediction.
+    :param neighbors: The number of neighbors the classifier votes with.
+    :param folds: The number of cross validation folds.
+    :param settings: Histogram settings passed to pwm_wave_lib.get_histogram_features.
+    :param progress: Optional function of (filename, number, end) called for each sample.
+    :raises ValueError: When there are no samples or the model can not be cross validated.
+    """
+    store_file = path.join(directory, STORE_NAME)
+    if pack and not path.isfile(store_file):
+        SampleStore(store_file).import_directory(directory)
+    with timing.span('features.load', workers=workers) as loading:
+        features, target = load_features(directory, cache=cache, workers=workers, settings=settings,
+                                         progress=progress)
+        loading.fields['samples'] = len(target)
+    data = [tuple(f) for f in features]
+
+    if len(data) == 0 or len(target) == 0:
+        raise ValueError('Data array collection error: no data found.')
+
+    X = np.asarray(data)
+    y = np.asarray(target)
+
+    knn = KNeighborsClassifier(n_neighbors=neighbors, n_jobs=-1)
+    with timing.span('model.fit', samples=len(X)):
+        knn.fit(X, y)
+    scores = cross_validate(knn, X, y, folds=folds, workers=workers)
+    return save_model(directory, knn, X, y, scores, folds=folds, codec=codec, lut=lut, settings=settings)
+
+
+def cross_validate(knn, X, y, folds=5, workers=1):
+    """ Returns the cross validation scores of an unfitted copy of knn.
+
+    :raises ValueError: When the model can not be cross validated.
+    """
+    try:
+        with timing.span('model.cross_val_score', samples=len(X), folds=folds):
+            return cross_val_score(knn, X, y, cv=folds, n_jobs=workers)
+    except ValueError as e:
+        raise ValueError(' '.join(['Error computing cross_val_score.', str(e)]))
+
+
+def save_model(directory, knn, X, y, scores, folds=5, codec=DEFAULT_CODEC, lut=False, settings=FEATURE_SETTINGS):
+    """ Save the samples and a fitted model in directory and return the training results.
+
+    :param knn: The KNeighborsClassifier fitted on X and y.
+    :param scores: The cross validation scores of the model.
+    :param folds: The number of cross validation folds the scores come from.
+    :param codec: The artifact_lib codec the samples and model are saved with.
+    :param lut: Whether to also compile the model into a lookup table model for fast prediction. It is skipped
+        unless there are lut_model.LUT_FEATURES features.
+    :param settings: The histogram settings the features were computed with.
+    :raises ValueError: When the lookup table does not match the model.
+    """
+    samples = Bunch()
+    samples.data = X
+    samples.target = y
+    samples.settings = settings
+    with timing.span('artifact.dump', sample=directory, artifact='poly2d', codec=codec) as dump:
+        samples_file = dump_artifact(samples, directory, 'poly2d', codec)
+        dump.bytes = path.getsize(samples_file)
+
+    with timing.span('artifact.dump', sample=directory, artifact='knn_model', codec=codec) as dump:
+        model_file = dump_artifact(knn, directory, 'knn_model', codec)
+        dump.bytes = path.getsize(model_file)
+
+    lut_file = None
+    if lut and X.shape[1] != LUT_FEATURES:
+        print('Skipping the lookup table: it is only compiled for', LUT_FEATURES, 'features.', file=sys.stderr,
+              flush=True)
+    elif lut:
+        with timing.span('model.compile', samples=len(X)):
+            table = LookupTableClassifier(knn, X)
+            check_table(table, knn, X, model_file)
+        with timing.span('artifact.dump', sample=directory, artifact=LUT_NAME, codec=codec) as dump:
+            lut_file = dump_artifact(table, directory, LUT_NAME, codec)
+            dump.bytes = path.getsize(lut_file)
+
+    sum_sq = 0
+    with timing.span('model.predict', samples=len(X)):
+        p = knn.predict(X)
+    for guess, actual in zip(p, y):
+        sum_sq += pow(guess - actual, 2)
+
+    standard_error_estimate = sum_sq / len(X)
+
+    return {
+        'cross-validation-accuracy': scores.mean(),
+        'cross-validation-error': scores.std(),
+        'cross-validation-neighbors': knn.n_neighbors,
+        'cross-validation-folds': folds,
+        'standard-error-estimate': standard_error_estimate,
+        'feature-settings': settings,
+        'samples': samples_file,
+        'model': model_file,
+        'lut': lut_file}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d', '--directory', default=getcwd(),
+                        help='Path to model training samples. Defaults to current directory.')
+    parser.add_argument('--pack', default=0, type=int,
+                        help=''.join(['Whether to pack the JSON sample files into ', STORE_NAME,
+                                      ' before training. Defaults to false.']))
+    parser.add_argument('--cache', default=1, type=int,
+                        help=''.join(['Whether to reuse the features of unchanged samples from ', CACHE_NAME,
+                                      '. Defaults to true.']))
+    parser.add_argument('--codec', default=DEFAULT_CODEC, choices=sorted(CODECS),
+                        help=''.join(['Compression of the saved samples and model. Defaults to ', DEFAULT_CODEC, '.']))
+    parser.add_argument('--neighbors', default=5, type=int,
+                        help='The number of neighbors the classifier votes with. Defaults to 5.')
+    parser.add_argument('--folds', default=5, type=int,
+                        help='The number of cross validation folds. Defaults to 5.')
+    parser.add_argument('--bins', default=FEATURE_SETTINGS['bins'], type=int,
+                        help='Histogram bins over the voltage window; one fewer are features. Defaults to 3.')
+    parser.add_argument('--window', default=FEATURE_SETTINGS['window'], type=float,
+                        help='Width of the histogram voltage window above the minimum. Defaults to 0.05.')
+    parser.add_argument('--start', default=FEATURE_SETTINGS['start'], type=int,
+                        help='The first reading of the sample window. Defaults to 45.')
+    parser.add_argument('--periods', default=FEATURE_SETTINGS['sample_size'], type=int,
+                        help='The length of the sample window in PWM periods. Defaults to 8.')
+    parser.add_argument('--lut', default=0, type=int,
+                        help='Whether to also compile the model into a lookup table for fast prediction.'
+                             ' Defaults to false.')
+    parser.add_argument('--timing', default=None,
+                        help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='The number of processes featurizing samples and scoring folds. Defaults to 1.')
+    args = parser.parse_args()
+    if args.timing is not None:
+        timing.configure(args.timing)
+
+    print()
+    print('┌──────────────────────┐')
+    print('│ Begin Model Training │')
+    print('└──────────────────────┘\n', flush=True)
+
+    try:
+        output = train(args.directory, workers=args.workers, cache=args.cache == 1, pack=args.pack == 1,
+                       codec=args.codec, lut=args.lut == 1, neighbors=args.neighbors, folds=args.folds,
+                       settings={'bins': args.bins, 'window': args.window, 'start': args.start,
+                                 'sample_size': args.periods},
+                       progress=print_status)
+    except ValueError as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+    print()
+    print(json.JSONEncoder().encode(output), flush=True)
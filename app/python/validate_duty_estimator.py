@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Validate pwm_wave_lib.estimate_duty against the duty cycle labels of a collection run and the KNN.
+
+The KNN is scored with cross validated predictions on the run's histogram features, so neither method sees
+the samples it is judged on. The report gives the error of each against the labels, how often they agree,
+a linear calibration of the estimator and the mean errors per duty cycle. It is printed and written to
+duty_validation.json in the run directory.
+"""
+
+import argparse
+import json
+import sys
+from os import path, getcwd, replace
+from time import perf_counter
+import numpy as np
+from sklearn.model_selection import cross_val_predict
+from sklearn.neighbors import KNeighborsClassifier
+import pwm_wave_lib as pwlib
+import timing
+from pwm_wave_lib import FEATURE_SETTINGS
+from sample_features import load_samples
+
+REPORT_NAME = 'duty_validation.json'
+
+
+def get_errors(estimate, target):
+    """ Returns the error statistics of duty cycle estimates against the labels. NaN estimates are left out. """
+    found = ~np.isnan(estimate)
+    error = estimate[found] - target[found]
+    if len(error) == 0:
+        return {'samples': 0}
+    return {
+        'samples': int(found.sum()),
+        'mean-absolute-error': float(np.mean(np.abs(error))),
+        'root-mean-square-error': float(np.sqrt(np.mean(error ** 2))),
+        'bias': float(np.mean(error)),
+        'max-absolute-error': float(np.max(np.abs(error))),
+        'exact': float(np.mean(np.rint(estimate[found]) == target[found])),
+        'within-1': float(np.mean(np.abs(error) <= 1)),
+        'within-2': float(np.mean(np.abs(error) <= 2)),
+        'within-5': float(np.mean(np.abs(error) <= 5))}
+
+
+def validate(directory, workers=1, neighbors=5, folds=5, **settings):
+    """ Returns the validation report of a run.
+
+    :param directory: The collection run directory.
+    :param workers: The number of processes parsing samples and scoring folds.
+    :param neighbors: The number of neighbors of the KNN compared with.
+    :param folds: The number of cross validation folds of the KNN.
+    :param settings: Settings passed on to pwm_wave_lib.estimate_duty.
+    :raises ValueError: When there are no samples or the KNN can not be cross validated.
+    """
+    with timing.span('features.load', workers=workers):
+        values, sample_rate_khz, ring_size, counts, target = load_samples(directory, workers=workers)
+    if len(target) == 0:
+        raise ValueError('Data array collection error: no data found.')
+    y = np.asarray(target)
+
+    start = perf_counter()
+    with timing.span('duty.estimate', samples=len(y)):
+        estimate, period = pwlib.estimate_duty(values, counts=counts, **settings)
+    estimate_time = perf_counter() - start
+
+    start = perf_counter()
+    with timing.span('features.histogram', samples=len(y)):
+        X = pwlib.get_histogram_features(values, sample_rate_khz, ring_size, counts=counts, **FEATURE_SETTINGS)
+    try:
+        with timing.span('model.cross_val_predict', samples=len(y), folds=folds):
+            knn = cross_val_predict(KNeighborsClassifier(n_neighbors=neighbors), X, y, cv=folds, n_jobs=workers)
+    except ValueError as e:
+        raise ValueError(' '.join(['Error computing cross_val_predict.', str(e)]))
+    knn_time = perf_counter() - start
+
+    found = ~np.isnan(estimate)
+    report = {
+        'directory': directory,
+        'samples': len(y),
+        'estimator': get_errors(estimate, y),
+        'knn': get_errors(knn.astype(np.float64), y),
+        'agreement': float(np.mean(np.rint(estimate[found]) == knn[found])) if found.any() else None,
+        'undetected': int((~found).sum()),
+        'period-readings': float(np.median(period[found])) if found.any() else None,
+        'estimator-seconds': estimate_time,
+        'knn-seconds': knn_time}
+
+    if len(np.unique(estimate[found])) > 1:
+        # Labels as a straight line of the estimates; a waveform that rises slowly after the laser turns off
+        # biases the estimator in a way this corrects.
+        slope, intercept = np.polyfit(estimate[found], y[found], 1)
+        report['calibration'] = {'slope': slope, 'intercept': intercept}
+        report['calibrated-estimator'] = get_errors(slope * estimate + intercept, y)
+
+    per_duty = []
+    for duty in np.unique(y):
+        rows = y == duty
+        estimated = rows & found
+        per_duty.append({
+            'duty': int(duty),
+            'samples': int(rows.sum()),
+            'estimator-mean-error': float(np.mean(estimate[estimated] - duty)) if estimated.any() else None,
+            'knn-mean-error': float(np.mean(knn[rows] - duty))})
+    report['per-duty'] = per_duty
+    return report
+
+
+def save_report(directory, report):
+    filename = path.join(directory, REPORT_NAME)
+    temp = ''.join([filename, '.tmp'])
+    with open(temp, 'w') as f:
+        json.dump(report, f, indent=1)
+    replace(temp, filename)
+    return filename
+
+
+def print_report(report):
+    print('{:<26}{:>12}{:>12}'.format('', 'estimator', 'knn'))
+    for key in ['samples', 'mean-absolute-error', 'root-mean-square-error', 'bias', 'max-absolute-error', 'exact',
+                'within-1', 'within-2', 'within-5']:
+        print('{:<26}{:>12.4g}{:>12.4g}'.format(key, report['estimator'].get(key, np.nan),
+                                                 report['knn'].get(key, np.nan)))
+    print('{:<26}{:>12.4g}{:>12.4g}'.format('seconds', report['estimator-seconds'], report['knn-seconds']))
+    print(flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d', '--directory', default=getcwd(),
+                        help='Path to a collection run. Defaults to current directory.')
+    parser.add_argument('--band', default=0.02, type=float,
+                        help='The smallest on threshold above the floor reading, in ADC native units. Defaults to'
+                             ' 0.02.')
+    parser.add_argument('--spread', default=6, type=float,
+                        help='The on threshold above the floor in multiples of the reading noise. Defaults to 6.')
+    parser.add_argument('--debounce', default=3, type=int,
+                        help='Readings that must be off before a falling edge. Defaults to 3.')
+    parser.add_argument('--neighbors', default=5, type=int,
+                        help='The number of neighbors of the KNN compared with. Defaults to 5.')
+    parser.add_argument('--folds', default=5, type=int,
+                        help='The number of cross validation folds of the KNN. Defaults to 5.')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='The number of processes parsing samples and scoring folds. Defaults to 1.')
+    parser.add_argument('--timing', default=None,
+                        help='Append per-stage timing events to this JSON-lines file, or - for stdout.')
+    args = parser.parse_args()
+    if args.timing is not None:
+        timing.configure(args.timing)
+
+    try:
+        report = validate(args.directory, workers=args.workers, neighbors=args.neighbors, folds=args.folds,
+                          band=args.band, spread=args.spread, debounce=args.debounce)
+    except ValueError as e:
+        print(e, file=sys.stderr, flush=True)
+        exit(1)
+
+    print_report(report)
+    report['report'] = save_report(args.directory, report)
+    print(json.JSONEncoder().encode(report), flush=True)
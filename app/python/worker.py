@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" A resident worker that runs training, prediction, chart, results and JQ jobs for the Electron controller.
+
+Requests and responses are JSON-RPC 2.0 objects, one per line, on stdin and stdout. Jobs run one at a time
+from a queue; numpy, scikit-learn and matplotlib stay imported and recently used models stay loaded.
+
+    {"jsonrpc": "2.0", "id": 1, "method": "predict", "params": {"model_id": "...", ...}}
+    {"jsonrpc": "2.0", "method": "progress", "params": {"id": 1, "message": "50% complete. ..."}}
+    {"jsonrpc": "2.0", "id": 1, "result": {...}}
+
+The cancel method removes a queued job, or stops a running one at its next progress update.
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+import traceback
+from functools import lru_cache
+from os import stat
+from artifact_lib import DEFAULT_CODEC, load_artifact
+import batch_prediction
+import prediction
+import timing
+import train_model
+from remote_command import get_pool
+from results_store import ResultsStore
+
+MODEL_CACHE_SIZE = 8
+
+""" The JSON-RPC error codes used by the worker. """
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+JOB_FAILED = -32000
+JOB_CANCELLED = -32001
+
+
+def parse_jq(text):
+    """ Returns the value jq printed, or the list of values when it printed a stream of several. """
+    decoder = json.JSONDecoder()
+    values = []
+    end = 0
+    text = text.strip()
+    while end < len(text):
+        value, end = decoder.raw_decode(text, end)
+        values.append(value)
+        while end < len(text) and text[end].isspace():
+            end += 1
+    return values[0] if len(values) == 1 else values
+
+
+class JobCancelled(Exception):
+    """ Raised inside a running job when its cancellation is requested. """
+
+
+class Job:
+    """ One queued request. """
+    def __init__(self, job_id, method, params):
+        self.id = job_id
+        self.method = method
+        self.params = params
+        self.cancelled = threading.Event()
+
+
+class Worker:
+    """ Read requests from stdin, run them on a job thread and write responses to stdout. """
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.output_lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.methods = {'train': self.train, 'predict': self.predict, 'jq': self.jq, 'ping': self.ping,
+                        'charts': self.charts, 'batch': self.batch, 'results': self.results, 'trend': self.trend}
+
+    def send(self, message):
+        message['jsonrpc'] = '2.0'
+        with self.output_lock:
+            self.stdout.write(json.dumps(message, default=float))
+            self.stdout.write('\n')
+            self.stdout.flush()
+
+    def respond(self, job_id, result=None, code=None, message=None):
+        if code is None:
+            self.send({'id': job_id, 'result': result})
+        else:
+            self.send({'id': job_id, 'error': {'code': code, 'message': message}})
+
+    def progress(self, job, message):
+        """ Stream a progress event, and stop the job here if it has been cancelled. """
+        if job.cancelled.is_set():
+            raise JobCancelled()
+        self.send({'method': 'progress', 'params': {'id': job.id, 'message': message}})
+
+    @staticmethod
+    @lru_cache(maxsize=MODEL_CACHE_SIZE)
+    def load_cached(filename, mtime):
+        return load_artifact(filename)
+
+    def load(self, filename):
+        """ Load an artifact, reusing the decompressed copy until the file changes. """
+        return self.load_cached(filename, stat(filename).st_mtime_ns)
+
+    def train(self, job):
+        params = job.params
+        return train_model.train(params['directory'], workers=params.get('workers', 1),
+                                 cache=params.get('cache', True), pack=params.get('pack', False),
+                                 codec=params.get('codec', DEFAULT_CODEC), lut=params.get('lut', False),
+                                 neighbors=params.get('neighbors', 5), folds=params.get('folds', 5),
+                                 settings=params.get('settings', train_model.FEATURE_SETTINGS),
+                                 progress=lambda filename, number, end: self.progress(
+                                     job, train_model.status_update(filename, number, end)))
+
+    def predict(self, job):
+        params = job.params
+        return prediction.predict(params['model_id'], params['sample_id'], params['operator_id'],
+                                  directory=params['directory'], host=params.get('host', prediction.node()),
+                                  loader=self.load, codec=params.get('codec', DEFAULT_CODEC),
+                                  charts=params.get('charts', 'inline'), lut=params.get('lut', True),
+                                  chunk=params.get('chunk', 0))
+
+    def batch(self, job):
+        """ Score sample runs against models; each pair's result is also streamed as a progress event. """
+        params = job.params
+        results = []
+        for output in batch_prediction.predict_batch(params['model_ids'], params['sample_ids'], params['operator_id'],
+                                                     directory=params['directory'],
+                                                     host=params.get('host', prediction.node()), loader=self.load,
+                                                     codec=params.get('codec', DEFAULT_CODEC),
+                                                     lut=params.get('lut', True), save=params.get('save', True)):
+            self.progress(job, output)
+            results.append(output)
+        return results
+
+    @staticmethod
+    def charts(job):
+        """ Render the charts of a prediction made with charts set to none. """
+        from prediction_charts import render_charts
+        params = job.params
+        prob_dist_file, hist_file = render_charts(params['directory'], params['model_id'], params['sample_id'])
+        return {'proba-dist-chart': prob_dist_file, 'mean-variance-chart': hist_file}
+
+    @staticmethod
+    def results(job):
+        """ Add batches of training and prediction results to a results database. """
+        params = job.params
+        store = ResultsStore(params['database'])
+        try:
+            return {'models': store.add_models(params.get('models', [])),
+                    'comparisons': store.add_comparisons(params.get('comparisons', []))}
+        finally:
+            store.close()
+
+    @staticmethod
+    def trend(job):
+        """ Return the per-period prediction trend of each laser from a results database. """
+        params = job.params
+        store = ResultsStore(params['database'])
+        try:
+            return store.trend(laser_id=params.get('laser_id'), start=params.get('start'), end=params.get('end'),
+                               bucket=params.get('bucket', 86400))
+        finally:
+            store.close()
+
+    def jq(self, job):
+        params = job.params
+        command = ''.join(['jq ', "'", params['filter'], "' ", params['files']])
+        result = get_pool(params['host'], params['user'], params['password']).run(command)
+        if not result.ok:
+            raise ValueError(result.stderr.decode('utf-8'))
+        return parse_jq(result.stdout.decode('utf-8'))
+
+    @staticmethod
+    def ping(job):
+        return 'pong'
+
+    def run_jobs(self):
+        """ The job thread; runs queued jobs in order. """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                if job.cancelled.is_set():
+                    raise JobCancelled()
+                result = self.methods[job.method](job)
+                self.respond(job.id, result)
+            except JobCancelled:
+                self.respond(job.id, code=JOB_CANCELLED, message='Job cancelled.')
+            except ValueError as e:
+                self.respond(job.id, code=JOB_FAILED, message=str(e))
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                self.respond(job.id, code=JOB_FAILED, message=str(e))
+            finally:
+                with self.pending_lock:
+                    self.pending.pop(job.id, None)
+
+    def serve(self):
+        """ Read requests until stdin closes or a shutdown request arrives. """
+        runner = threading.Thread(target=self.run_jobs, daemon=True)
+        runner.start()
+        for line in self.stdin:
+            if line.strip() == '':
+                continue
+            try:
+                request = json.loads(line)
+                job_id = request.get('id')
+                method = request['method']
+                params = request.get('params', {})
+            except (ValueError, KeyError, AttributeError):
+                self.respond(None, code=PARSE_ERROR, message='Invalid JSON-RPC request.')
+                continue
+            if method == 'shutdown':
+                self.respond(job_id, True)
+                break
+            if method == 'cancel':
+                with self.pending_lock:
+                    job = self.pending.get(params.get('id'))
+                if job is not None:
+                    job.cancelled.set()
+                self.respond(job_id, job is not None)
+            elif method in self.methods:
+                job = Job(job_id, method, params)
+                with self.pending_lock:
+                    self.pending[job_id] = job
+                self.jobs.put(job)
+            else:
+                self.respond(job_id, code=METHOD_NOT_FOUND, message=''.join(['Unknown method ', method, '.']))
+        self.jobs.put(None)
+        runner.join()
+
+
+if __name__ == '__main__':
+    # Inline charts are drawn on the job thread, where only a non-interactive backend is safe.
+    os.environ['MPLBACKEND'] = 'Agg'
+    # Only JSON-RPC messages go to stdout; anything the jobs print is diverted to stderr.
+    protocol = sys.stdout
+    sys.stdout = sys.stderr
+    worker = Worker(sys.stdin, protocol)
+    # With LASER_METER_TIMING=- the timing events are sent as notifications on the protocol stream.
+    timing.configure_from_environment(sink=lambda event: worker.send({'method': 'timing', 'params': event}))
+    worker.serve()